@@ -2,9 +2,18 @@ import asyncio
 import sys
 import uvicorn
 
+from tanin.core.config import settings
+
 if sys.platform == "win32":
     asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
 
 
 if __name__ == '__main__':
-    uvicorn.run("src.tanin.main:app", host="0.0.0.0", port=8000, reload=True, )
+    uvicorn.run(
+        "src.tanin.main:app",
+        host="0.0.0.0",
+        port=8000,
+        reload=True,
+        ws="tanin.websocket.compression:CompressionThresholdProtocol",
+        ws_max_size=settings.WS_MAX_SDP_FRAME_BYTES,
+    )
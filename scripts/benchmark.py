@@ -0,0 +1,795 @@
+import asyncio
+import gc
+import json
+import logging
+import resource
+import random
+import time
+import uuid
+from typing import Annotated
+from uuid import UUID
+
+import httpx
+import msgpack
+import pydantic
+import typer
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+from redis.asyncio import Redis
+from starlette.middleware.base import BaseHTTPMiddleware
+
+from tanin.api.endpoints import session_router
+
+from tanin.core.database import get_redis_client, get_matching_redis_client
+from tanin.middlewares.process_time import ProcessTimeMiddleware
+from tanin.middlewares.token_bucket import TokenBucketManager, TwoTierTokenBucketManager, GcraRateLimiter, \
+    RateLimitMiddleware
+from tanin.schemas.chat_schema import ChatMessage, NewTextMessageEvent, PartnerWebRTCOfferEvent, ClientEvent, \
+    WebRTCOfferEvent, SendTextMessageEvent
+from tanin.websocket.connection_manager import ConnectionManager, Connection, ENVELOPE_HEADER_SIZE, room_change_size
+from tanin.schemas.user_schema import ActiveUser
+from tanin.websocket.matcher import BatchMatcher, matched_events
+from tanin.websocket.matching_service import MatchingService
+from tanin.websocket.memory_backend import InMemoryConnectionManager, InMemoryMatchingService
+from tanin.utils import logger
+from tanin.utils.logger import Module
+from tanin.websocket.stream_manager import StreamConnectionManager
+
+benchmark = typer.Typer(
+    name="benchmark",
+    help="Micro-benchmarks for the real-time delivery path."
+)
+
+# Trimmed Chrome offer with one audio and one video section, close to what clients really send
+SAMPLE_SDP = (
+    "v=0\r\no=- 4611731400430051336 2 IN IP4 127.0.0.1\r\ns=-\r\nt=0 0\r\n"
+    "a=group:BUNDLE 0 1\r\na=extmap-allow-mixed\r\na=msid-semantic: WMS stream\r\n"
+    "m=audio 9 UDP/TLS/RTP/SAVPF 111 63 9 0 8 13 110 126\r\nc=IN IP4 0.0.0.0\r\n"
+    "a=rtcp:9 IN IP4 0.0.0.0\r\na=ice-ufrag:Kx3v\r\na=ice-pwd:6Z0gCjQ8qW2y7mD3bF1nR5tH\r\n"
+    "a=ice-options:trickle\r\na=fingerprint:sha-256 "
+    "5B:3C:9A:1E:77:0D:42:AF:8E:61:C4:2B:93:5F:D0:18:7A:E6:3F:21:B4:0C:95:6D:88:4A:1F:E2:73:5C:09:BD\r\n"
+    "a=setup:actpass\r\na=mid:0\r\na=extmap:1 urn:ietf:params:rtp-hdrext:ssrc-audio-level\r\n"
+    "a=extmap:2 http://www.webrtc.org/experiments/rtp-hdrext/abs-send-time\r\n"
+    "a=sendrecv\r\na=msid:stream audio-track\r\na=rtcp-mux\r\n"
+    "a=rtpmap:111 opus/48000/2\r\na=rtcp-fb:111 transport-cc\r\na=fmtp:111 minptime=10;useinbandfec=1\r\n"
+    "a=rtpmap:63 red/48000/2\r\na=fmtp:63 111/111\r\na=rtpmap:9 G722/8000\r\n"
+    "a=rtpmap:0 PCMU/8000\r\na=rtpmap:8 PCMA/8000\r\na=rtpmap:13 CN/8000\r\n"
+    "a=ssrc:3735928559 cname:4TOk42mSjXCkVIa6\r\n"
+    "m=video 9 UDP/TLS/RTP/SAVPF 96 97 102 103 104 105 106 107 108 109 127 125\r\n"
+    "c=IN IP4 0.0.0.0\r\na=rtcp:9 IN IP4 0.0.0.0\r\na=ice-ufrag:Kx3v\r\n"
+    "a=ice-pwd:6Z0gCjQ8qW2y7mD3bF1nR5tH\r\na=ice-options:trickle\r\na=setup:actpass\r\na=mid:1\r\n"
+    "a=extmap:14 urn:ietf:params:rtp-hdrext:toffset\r\na=extmap:13 urn:3gpp:video-orientation\r\n"
+    "a=sendrecv\r\na=msid:stream video-track\r\na=rtcp-mux\r\na=rtcp-rsize\r\n"
+    "a=rtpmap:96 VP8/90000\r\na=rtcp-fb:96 goog-remb\r\na=rtcp-fb:96 transport-cc\r\n"
+    "a=rtcp-fb:96 ccm fir\r\na=rtcp-fb:96 nack\r\na=rtcp-fb:96 nack pli\r\n"
+    "a=rtpmap:97 rtx/90000\r\na=fmtp:97 apt=96\r\na=rtpmap:102 H264/90000\r\n"
+    "a=fmtp:102 level-asymmetry-allowed=1;packetization-mode=1;profile-level-id=42001f\r\n"
+    "a=rtpmap:103 rtx/90000\r\na=fmtp:103 apt=102\r\na=rtpmap:104 VP9/90000\r\n"
+    "a=fmtp:104 profile-id=0\r\na=rtpmap:105 rtx/90000\r\na=fmtp:105 apt=104\r\n"
+    "a=rtpmap:106 AV1/90000\r\na=rtpmap:107 rtx/90000\r\na=fmtp:107 apt=106\r\n"
+    "a=ssrc-group:FID 2882400001 2882400002\r\na=ssrc:2882400001 cname:4TOk42mSjXCkVIa6\r\n"
+    "a=ssrc:2882400002 cname:4TOk42mSjXCkVIa6\r\n"
+)
+
+
+class NullWebSocket:
+    async def accept(self, *args, **kwargs):
+        pass
+
+    async def send_json(self, data):
+        pass
+
+    async def send_text(self, data):
+        pass
+
+    async def send_bytes(self, data):
+        pass
+
+    async def close(self, *args, **kwargs):
+        pass
+
+
+class CountingWebSocket(NullWebSocket):
+    def __init__(self, expected: int):
+        self.expected = expected
+        self.received = 0
+        self.done = asyncio.Event()
+
+    async def send_text(self, data):
+        self.received += 1
+        if self.received >= self.expected:
+            self.done.set()
+
+
+def _build_node(node_index: int, users_per_node: int, mode: str) -> ConnectionManager:
+    # The delivery handler never talks to Redis, an unconnected client is enough
+    manager = ConnectionManager(Redis(), node_id=f"node-{node_index}", delivery_mode=mode)
+    for _ in range(users_per_node):
+        user_id = uuid.uuid4()
+        # Unbounded queues and no writer task: only the listener side is measured
+        manager.active_connections[user_id] = Connection(NullWebSocket(), user_id, queue_size=0)
+    return manager
+
+
+def _drain(manager: ConnectionManager, messages: list[str]) -> float:
+    start = time.process_time()
+    for message in messages:
+        manager.handle_pubsub_message(message)
+    return time.process_time() - start
+
+
+class CountingListener(ConnectionManager):
+    """ConnectionManager that counts every envelope its pub/sub listener receives, for us or not."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.ingress = 0
+
+    def handle_pubsub_message(self, raw_message: bytes):
+        self.ingress += 1
+        super().handle_pubsub_message(raw_message)
+
+
+async def _live_routing(node_count: int, mode: str, users_per_node: int, messages_per_node: int):
+    event = NewTextMessageEvent(
+        message=ChatMessage(id=uuid.uuid4(), sender_id=uuid.uuid4(), content="hello stranger")
+    )
+    redis_client = get_redis_client(decode_responses=False)
+    nodes = [
+        CountingListener(redis_client, node_id=f"bench-node-{i}", delivery_mode=mode, outbound_queue_size=0)
+        for i in range(node_count)
+    ]
+    # Publishes from outside every node, so each event really crosses Redis
+    publisher = ConnectionManager(redis_client, node_id="bench-publisher", delivery_mode=mode, local_delivery=False)
+    websocket = CountingWebSocket(node_count * messages_per_node)
+
+    listeners = [asyncio.create_task(node.listen()) for node in nodes]
+    events = []
+    for node in nodes:
+        recipients = [uuid.uuid4() for _ in range(users_per_node)]
+        for user_id in recipients:
+            await node.connect(websocket, user_id)
+        events.extend((event, random.choice(recipients)) for _ in range(messages_per_node))
+    random.shuffle(events)
+    await asyncio.sleep(0.5)
+
+    start, cpu_start = time.perf_counter(), time.process_time()
+    await publisher.broadcast_events(events)
+    await asyncio.wait_for(websocket.done.wait(), timeout=120)
+    elapsed, cpu = time.perf_counter() - start, time.process_time() - cpu_start
+
+    for node in nodes:
+        for user_id in list(node.active_connections):
+            await node.disconnect(user_id)
+    for listener in listeners:
+        listener.cancel()
+    await asyncio.gather(*listeners, return_exceptions=True)
+    await redis_client.aclose()
+    return sum(node.ingress for node in nodes) / node_count, elapsed, cpu
+
+
+def _run_live_routing(users_per_node: int, messages_per_node: int):
+    typer.echo(f"{'nodes':>5} {'mode':>10} {'msgs/node':>10} {'events/s':>10} {'cpu total (ms)':>15}")
+    for node_count in (1, 4, 16):
+        for mode in ("broadcast", "routed"):
+            ingress, elapsed, cpu = asyncio.run(
+                _live_routing(node_count, mode, users_per_node, messages_per_node)
+            )
+            rate = node_count * messages_per_node / elapsed
+            typer.echo(f"{node_count:>5} {mode:>10} {ingress:>10.0f} {rate:>10.0f} {cpu * 1000:>15.2f}")
+
+
+@benchmark.command(
+    "routing",
+    help="Listener cost in broadcast vs routed delivery mode. By default only the envelope decode and "
+         "recipient filtering of handle_pubsub_message is timed on synthetic input; --live runs real "
+         "listen() subscribers against Redis."
+)
+def routing(
+    users_per_node: Annotated[int, typer.Option(help="Connected users on each simulated node.")] = 500,
+    messages_per_node: Annotated[int, typer.Option(help="Events addressed to each node's users.")] = 5000,
+    live: Annotated[bool, typer.Option(help="Deliver through Redis pub/sub to one listener per node.")] = False,
+):
+    if live:
+        # All nodes share this process, so CPU is reported for the whole cluster, publisher included
+        _run_live_routing(users_per_node, messages_per_node)
+        return
+
+    event = NewTextMessageEvent(
+        message=ChatMessage(id=uuid.uuid4(), sender_id=uuid.uuid4(), content="hello stranger")
+    )
+    # No Redis involved: the pub/sub socket read and reply parsing are not part of these numbers
+    typer.echo(f"{'nodes':>5} {'mode':>10} {'msgs/node':>10} {'cpu/node (ms)':>14}")
+
+    for node_count in (1, 4, 16):
+        for mode in ("broadcast", "routed"):
+            nodes = [_build_node(i, users_per_node, mode) for i in range(node_count)]
+
+            # Cluster traffic grows with the number of nodes, every node receives its own share
+            per_node_messages: list[list[str]] = [[] for _ in nodes]
+            for index, node in enumerate(nodes):
+                recipients = list(node.active_connections)
+                for _ in range(messages_per_node):
+                    message = ConnectionManager.encode_message(event, random.choice(recipients))
+                    per_node_messages[index].append(message)
+
+            if mode == "broadcast":
+                every_message = [m for messages in per_node_messages for m in messages]
+                ingress = [every_message for _ in nodes]
+            else:
+                ingress = per_node_messages
+
+            cpu = [_drain(node, messages) for node, messages in zip(nodes, ingress)]
+            typer.echo(
+                f"{node_count:>5} {mode:>10} {len(ingress[0]):>10} {sum(cpu) / len(cpu) * 1000:>14.2f}"
+            )
+
+
+def _legacy_roundtrip(event, user_id: uuid.UUID) -> str:
+    # Publisher, listener and send_json of the original JSON-in-JSON envelope
+    raw = json.dumps({'recipient_id': str(user_id), 'event_data': event.model_dump_json()})
+    data = json.loads(raw)
+    UUID(data["recipient_id"])
+    event_data = json.loads(data["event_data"])
+    return json.dumps(event_data, separators=(",", ":"), ensure_ascii=False)
+
+
+def _envelope_roundtrip(event, user_id: uuid.UUID) -> str:
+    raw = ConnectionManager.encode_message(event, user_id)
+    UUID(bytes=raw[:ENVELOPE_HEADER_SIZE])
+    body = raw[ENVELOPE_HEADER_SIZE:]
+    return body[room_change_size(body):].decode()
+
+
+@benchmark.command("envelope", help="Per-message serialization cost of the pub/sub envelope, before and after.")
+def envelope(
+    iterations: Annotated[int, typer.Option(help="Messages encoded and decoded per payload.")] = 20000,
+):
+    user_id = uuid.uuid4()
+    payloads = {
+        "text": NewTextMessageEvent(
+            message=ChatMessage(id=uuid.uuid4(), sender_id=uuid.uuid4(), content="hello stranger")
+        ),
+        "sdp": PartnerWebRTCOfferEvent(sdp={"type": "offer", "sdp": SAMPLE_SDP}),
+    }
+    typer.echo(f"{'payload':>8} {'legacy (us)':>12} {'envelope (us)':>14} {'speedup':>8}")
+
+    for name, event in payloads.items():
+        timings = []
+        for roundtrip in (_legacy_roundtrip, _envelope_roundtrip):
+            start = time.perf_counter()
+            for _ in range(iterations):
+                roundtrip(event, user_id)
+            timings.append((time.perf_counter() - start) / iterations * 1_000_000)
+
+        legacy, current = timings
+        typer.echo(f"{name:>8} {legacy:>12.2f} {current:>14.2f} {legacy / current:>7.1f}x")
+
+
+async def _delivery_throughput(manager: ConnectionManager, messages: int, concurrency: int) -> float:
+    event = NewTextMessageEvent(
+        message=ChatMessage(id=uuid.uuid4(), sender_id=uuid.uuid4(), content="hello stranger")
+    )
+    listener = asyncio.create_task(manager.listen())
+    websocket = CountingWebSocket(messages)
+    user_id = uuid.uuid4()
+    await manager.connect(websocket, user_id)
+    await asyncio.sleep(0.5)
+
+    start = time.perf_counter()
+    for offset in range(0, messages, concurrency):
+        batch = min(concurrency, messages - offset)
+        await asyncio.gather(*(manager.broadcast_event_to_user(event, user_id) for _ in range(batch)))
+    await asyncio.wait_for(websocket.done.wait(), timeout=60)
+    elapsed = time.perf_counter() - start
+
+    await manager.disconnect(user_id)
+    listener.cancel()
+    return messages / elapsed
+
+
+async def _compare_backends(messages: int, concurrency: int):
+    redis_client = get_redis_client(decode_responses=False)
+    backends = {
+        "pubsub": ConnectionManager(redis_client, node_id="bench-pubsub", local_delivery=False,
+                                    outbound_queue_size=0),
+        "streams": StreamConnectionManager(redis_client, node_id="bench-streams", block_ms=100,
+                                           outbound_queue_size=0),
+    }
+    typer.echo(f"{'backend':>8} {'events/s':>10}")
+    for name, manager in backends.items():
+        rate = await _delivery_throughput(manager, messages, concurrency)
+        typer.echo(f"{name:>8} {rate:>10.0f}")
+    await redis_client.aclose()
+
+
+@benchmark.command("delivery", help="End-to-end events per second through Redis for each delivery backend.")
+def delivery(
+    messages: Annotated[int, typer.Option(help="Events published to one connected user.")] = 10000,
+    concurrency: Annotated[int, typer.Option(help="Publishes in flight at once.")] = 50,
+):
+    asyncio.run(_compare_backends(messages, concurrency))
+
+
+def _rss_bytes() -> int:
+    # Current resident set from procfs, falling back to the peak where procfs is missing
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+async def _fill_manager(connections: int, writers: bool) -> tuple[int, int]:
+    manager = ConnectionManager(Redis(), node_id="bench-memory")
+    gc.collect()
+    before = _rss_bytes()
+
+    for _ in range(connections):
+        user_id = uuid.uuid4()
+        if writers:
+            # Same path as a real connect, minus the handshake and the presence write
+            manager._register(NullWebSocket(), user_id)
+        else:
+            manager.active_connections[user_id] = Connection(NullWebSocket(), user_id, manager.outbound_queue_size)
+    await asyncio.sleep(0)
+
+    gc.collect()
+    after = _rss_bytes()
+    for connection in manager.active_connections.values():
+        manager._stop_writer(connection)
+    return before, after
+
+
+@benchmark.command("memory", help="Resident memory per connection held by one ConnectionManager.")
+def memory(
+    connections: Annotated[int, typer.Option(help="Fake connections registered on the manager.")] = 100_000,
+    writers: Annotated[bool, typer.Option(help="Start a writer task per connection, as connect() does.")] = True,
+):
+    before, after = asyncio.run(_fill_manager(connections, writers))
+    total = after - before
+    typer.echo(f"{'connections':>12} {'rss delta (MB)':>15} {'bytes/conn':>11}")
+    typer.echo(f"{connections:>12} {total / 1024 / 1024:>15.1f} {total / connections:>11.0f}")
+
+
+def _per_call_us(func, iterations: int) -> float:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func()
+    return (time.perf_counter() - start) / iterations * 1_000_000
+
+
+@benchmark.command("codec", help="Frame size and CPU of JSON text frames vs the tanin.msgpack subprotocol.")
+def codec(
+    iterations: Annotated[int, typer.Option(help="Encodes and decodes per payload and codec.")] = 20000,
+):
+    adapter = pydantic.TypeAdapter(ClientEvent)
+    payloads = {
+        "text": SendTextMessageEvent(content="hello stranger"),
+        "offer": WebRTCOfferEvent(sdp={"type": "offer", "sdp": SAMPLE_SDP}),
+    }
+    typer.echo(
+        f"{'payload':>8} {'codec':>8} {'bytes':>6} {'encode (us)':>12} {'decode+validate (us)':>21}"
+    )
+
+    for name, event in payloads.items():
+        as_json = event.model_dump_json()
+        as_msgpack = msgpack.packb(event.model_dump(mode="json"))
+        codecs = {
+            "json": (as_json, lambda: event.model_dump_json(), lambda: adapter.validate_python(json.loads(as_json))),
+            "msgpack": (
+                as_msgpack,
+                lambda: msgpack.packb(event.model_dump(mode="json")),
+                lambda: adapter.validate_python(msgpack.unpackb(as_msgpack)),
+            ),
+        }
+        for codec_name, (frame, encode, decode) in codecs.items():
+            typer.echo(
+                f"{name:>8} {codec_name:>8} {len(frame):>6} "
+                f"{_per_call_us(encode, iterations):>12.2f} {_per_call_us(decode, iterations):>21.2f}"
+            )
+
+        # Local deliveries are encoded once per codec as above; events from other nodes and streams arrive
+        # as JSON, so msgpack sockets pay this transcode at write time for those
+        transcode = _per_call_us(lambda: msgpack.packb(json.loads(as_json)), iterations)
+        typer.echo(f"{name:>8} {'transcode':>8} {'':>6} {transcode:>12.2f}")
+
+
+async def _inline_matching(manager: ConnectionManager, service: MatchingService, users: list, concurrency: int):
+    async def search(user):
+        match = await service.enqueue_and_match(user)
+        if match:
+            await manager.broadcast_events(matched_events(*match))
+
+    for offset in range(0, len(users), concurrency):
+        await asyncio.gather(*(search(user) for user in users[offset:offset + concurrency]))
+
+
+async def _batch_matching(matcher: BatchMatcher, service: MatchingService, users: list, concurrency: int):
+    if not await matcher.elect():
+        typer.echo("Another matcher holds the leader lease, stop it first.")
+        raise typer.Exit(1)
+
+    expected = matcher.matches.value + len(users) // 2
+    task = asyncio.create_task(matcher.run())
+    for offset in range(0, len(users), concurrency):
+        await asyncio.gather(*(service.enqueue_and_match(user, match_open=False) for user in users[offset:offset + concurrency]))
+    while matcher.matches.value < expected:
+        await asyncio.sleep(0.001)
+    task.cancel()
+    await matcher.resign()
+
+
+async def _remove_rooms(redis_client: Redis, service: MatchingService, users: list):
+    user_room_keys = [service.user_room_key(user.id) for user in users]
+    async with redis_client.pipeline(transaction=False) as pipe:
+        for key in user_room_keys:
+            pipe.get(key)
+        room_ids = {room_id for room_id in await pipe.execute() if room_id}
+    async with redis_client.pipeline(transaction=False) as pipe:
+        for shard in range(service.shards):
+            pipe.delete(service.pool_keys(shard)[0])
+        for key in user_room_keys:
+            pipe.delete(key)
+        for room_id in room_ids:
+            pipe.delete(service.room_key(uuid.UUID(room_id)))
+        await pipe.execute()
+
+
+async def _compare_matching(searchers: int, concurrency: int, tick_ms: int, shards: int):
+    # Pools and rooms go to REDIS_CLUSTER_URL when it is set, to compare shard counts on a real cluster
+    redis_client = get_matching_redis_client()
+    binary_client = get_redis_client(decode_responses=False)
+    manager = ConnectionManager(binary_client, node_id="bench-matcher", local_delivery=False)
+    service = MatchingService(redis_client, shards=shards)
+    matcher = BatchMatcher(redis_client, manager, service, tick_ms=tick_ms)
+
+    typer.echo(f"{'mode':>8} {'matches/s':>10} {'p50 (ms)':>9} {'p95 (ms)':>9} {'p99 (ms)':>9}")
+    for mode in ("inline", "batch"):
+        service.time_to_match.samples.clear()
+        users = [ActiveUser(id=uuid.uuid4(), display_name="Stranger", is_anonymous=True) for _ in range(searchers)]
+        start = time.perf_counter()
+        if mode == "inline":
+            await _inline_matching(manager, service, users, concurrency)
+        else:
+            await _batch_matching(matcher, service, users, concurrency)
+        elapsed = time.perf_counter() - start
+        wait = service.time_to_match.summary()
+        typer.echo(
+            f"{mode:>8} {searchers // 2 / elapsed:>10.0f} "
+            f"{wait['p50'] * 1000:>9.1f} {wait['p95'] * 1000:>9.1f} {wait['p99'] * 1000:>9.1f}"
+        )
+
+        await _remove_rooms(redis_client, service, users)
+
+    await redis_client.aclose()
+    await binary_client.aclose()
+
+
+@benchmark.command("matching", help="Matches per second with inline matching vs the batch matcher.")
+def matching(
+    searchers: Annotated[int, typer.Option(help="Users starting a search.")] = 20000,
+    concurrency: Annotated[int, typer.Option(help="Searches in flight at once.")] = 200,
+    tick_ms: Annotated[int, typer.Option(help="Batch matcher tick.")] = 50,
+    shards: Annotated[int, typer.Option(help="Waiting pool shards.")] = 1,
+):
+    asyncio.run(_compare_matching(searchers, concurrency, tick_ms, shards))
+
+
+def _percentile(samples: list, q: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q / 100 * len(ordered)))]
+
+
+async def _fill_tagged_pool(service: MatchingService, users: list, tag_count: int):
+    for offset in range(0, len(users), 1000):
+        async with service.redis.pipeline(transaction=False) as pipe:
+            for index, user in enumerate(users[offset:offset + 1000], start=offset):
+                shard = service.shard_of(user.id)
+                await service.enqueue_and_match_script(
+                    keys=service.pool_keys(shard),
+                    args=[
+                        service.shard_prefix(service.TAG_BUCKET_KEY_PREFIX, shard),
+                        service.shard_prefix(service.USER_TAGS_KEY_PREFIX, shard),
+                        str(user.id), "",
+                        service.shard_prefix(service.USER_ROOM_KEY_PREFIX, shard),
+                        service.shard_prefix(service.ROOM_INFO_KEY_PREFIX, shard),
+                        0, int(time.time() * 1000), service.tag_fallback_ms, service.room_ttl,
+                        f"tag-{index % tag_count}"
+                    ],
+                    client=pipe
+                )
+            await pipe.execute()
+
+
+async def _clear_tagged_pool(service: MatchingService, users: list, tag_count: int):
+    await _remove_rooms(service.redis, service, users)
+    for offset in range(0, len(users), 10000):
+        await service.redis.delete(*[
+            f"{service.shard_prefix(service.USER_TAGS_KEY_PREFIX, service.shard_of(user.id))}{user.id}"
+            for user in users[offset:offset + 10000]
+        ])
+    for shard in range(service.shards):
+        await service.redis.delete(*service.pool_keys(shard), *[
+            f"{service.shard_prefix(service.TAG_BUCKET_KEY_PREFIX, shard)}tag-{index}" for index in range(tag_count)
+        ])
+
+
+async def _tagged_match_latency(pool_sizes: list, tag_count: int, searches: int):
+    redis_client = get_redis_client()
+    # A long fallback keeps every waiting user in its bucket for the whole run
+    service = MatchingService(redis_client, tag_fallback_seconds=3600)
+
+    typer.echo(f"{'waiting':>8} {'tags':>5} {'p50 (us)':>9} {'p99 (us)':>9}")
+    for pool_size in pool_sizes:
+        waiting = [ActiveUser(id=uuid.uuid4(), display_name="Stranger", is_anonymous=True) for _ in range(pool_size)]
+        searchers = [ActiveUser(id=uuid.uuid4(), display_name="Stranger", is_anonymous=True) for _ in range(searches)]
+        await _fill_tagged_pool(service, waiting, tag_count)
+
+        latencies = []
+        for index, user in enumerate(searchers):
+            start = time.perf_counter()
+            await service.enqueue_and_match(user, [f"tag-{index % tag_count}"])
+            latencies.append((time.perf_counter() - start) * 1_000_000)
+
+        typer.echo(
+            f"{pool_size:>8} {tag_count:>5} {_percentile(latencies, 50):>9.0f} {_percentile(latencies, 99):>9.0f}"
+        )
+        await _clear_tagged_pool(service, waiting + searchers, tag_count)
+
+    await redis_client.aclose()
+
+
+@benchmark.command("tags", help="Tagged match latency as the waiting pool grows.")
+def tags(
+    tag_count: Annotated[int, typer.Option(help="Distinct tags waiting users are spread across.")] = 50,
+    searches: Annotated[int, typer.Option(help="Tagged searches timed at each pool size.")] = 2000,
+):
+    asyncio.run(_tagged_match_latency([1_000, 10_000, 100_000], tag_count, searches))
+
+
+async def _backend_operations(manager, service, users: list) -> dict:
+    # One matchmaking lifecycle per pair of users, each step timed separately
+    latencies = {"connect": [], "search": [], "room lookup": [], "video ready": [], "leave": [], "disconnect": []}
+
+    async def timed(operation: str, call):
+        start = time.perf_counter()
+        result = await call
+        latencies[operation].append((time.perf_counter() - start) * 1_000_000)
+        return result
+
+    for user1, user2 in zip(users[::2], users[1::2]):
+        for user in (user1, user2):
+            await timed("connect", manager.connect(NullWebSocket(), user.id))
+        await timed("search", service.enqueue_and_match(user1))
+        _, _, room_id = await timed("search", service.enqueue_and_match(user2))
+        await manager.broadcast_events(matched_events(user1.id, user2.id, room_id))
+        await timed("room lookup", service.get_user_room_info(user1.id))
+        for user in (user1, user2):
+            await timed("video ready", service.set_user_ready_for_video(room_id, user.id))
+        await timed("leave", service.leave_room(user1.id, room_id))
+        for user in (user1, user2):
+            await timed("disconnect", manager.disconnect(user.id))
+    return latencies
+
+
+async def _compare_state_backends(pairs: int):
+    redis_client = get_redis_client()
+    binary_client = get_redis_client(decode_responses=False)
+    backends = {
+        "redis": (ConnectionManager(binary_client, node_id="bench-backends"), MatchingService(redis_client)),
+        "memory": (InMemoryConnectionManager(node_id="bench-backends"), InMemoryMatchingService()),
+    }
+
+    typer.echo(f"{'operation':>12} {'backend':>8} {'p50 (us)':>9} {'p99 (us)':>9}")
+    results = {}
+    for name, (manager, service) in backends.items():
+        users = [ActiveUser(id=uuid.uuid4(), display_name="Stranger", is_anonymous=True) for _ in range(pairs * 2)]
+        results[name] = await _backend_operations(manager, service, users)
+    for operation in results["redis"]:
+        for name, latencies in results.items():
+            samples = latencies[operation]
+            typer.echo(
+                f"{operation:>12} {name:>8} {_percentile(samples, 50):>9.1f} {_percentile(samples, 99):>9.1f}"
+            )
+
+    await redis_client.aclose()
+    await binary_client.aclose()
+
+
+@benchmark.command("backends", help="Per-operation latency of the Redis and in-memory state backends.")
+def backends(
+    pairs: Annotated[int, typer.Option(help="Pairs of users taken through connect, match, video and leave.")] = 5000,
+):
+    asyncio.run(_compare_state_backends(pairs))
+
+
+class AdmitAll:
+    # The middleware without any limiter behind it, the floor the limiters are measured against
+    async def consume(self, user_id, ip, amount: int = 1) -> bool:
+        return True
+
+    async def check(self, user_id, ip, amount: int = 1):
+        return True, None
+
+
+def _rate_limited_app(manager) -> FastAPI:
+    app = FastAPI()
+    if manager:
+        app.add_middleware(RateLimitMiddleware)
+        app.state.token_bucket_manager = manager
+
+    @app.get("/")
+    async def hello():
+        return {"message": "Welcome to Tanin API"}
+
+    return app
+
+
+async def _request_rate(
+        app: FastAPI, requests: int, clients: int, concurrency: int, method: str = "GET", path: str = "/"
+) -> float:
+    # Each client has its own address and therefore its own bucket
+    http_clients = [
+        httpx.AsyncClient(transport=httpx.ASGITransport(app=app, client=(f"10.0.{i // 256}.{i % 256}", 40000)),
+                          base_url="http://bench")
+        for i in range(clients)
+    ]
+    start = time.perf_counter()
+    for offset in range(0, requests, concurrency):
+        responses = await asyncio.gather(*(
+            http_clients[i % clients].request(method, path) for i in range(offset, min(offset + concurrency, requests))
+        ))
+        assert all(response.status_code == 200 for response in responses)
+    elapsed = time.perf_counter() - start
+    for http_client in http_clients:
+        await http_client.aclose()
+    return requests / elapsed
+
+
+async def _compare_rate_limiters(requests: int, clients: int, concurrency: int, max_unsynced: int):
+    redis_client = get_redis_client()
+    # Large enough that nothing is rejected, only the cost of the check is measured
+    options = dict(capacity=1_000_000, refill_rate=1_000_000)
+    two_tier = TwoTierTokenBucketManager(redis_client, max_unsynced=max_unsynced, **options)
+    limiters = {
+        "off": None,
+        "admit_all": AdmitAll(),
+        "redis": TokenBucketManager(redis_client, **options),
+        "two_tier": two_tier,
+    }
+    sync_task = asyncio.create_task(two_tier.run())
+
+    typer.echo(f"{'limiter':>10} {'req/s':>8}")
+    for name, manager in limiters.items():
+        rate = await _request_rate(_rate_limited_app(manager), requests, clients, concurrency)
+        typer.echo(f"{name:>10} {rate:>8.0f}")
+    typer.echo(f"two_tier waited on Redis for {two_tier.inline_syncs.value} of {requests} requests")
+
+    sync_task.cancel()
+    async for key in redis_client.scan_iter(match=f"{two_tier.RATE_LIMIT_PREFIX}*"):
+        await redis_client.delete(key)
+    await redis_client.aclose()
+
+
+@benchmark.command("ratelimit", help="HTTP requests per second through RateLimitMiddleware for each limiter.")
+def ratelimit(
+    requests: Annotated[int, typer.Option(help="Requests sent per limiter.")] = 20000,
+    clients: Annotated[int, typer.Option(help="Distinct client addresses.")] = 200,
+    concurrency: Annotated[int, typer.Option(help="Requests in flight at once.")] = 100,
+    max_unsynced: Annotated[int, typer.Option(help="Unsynced admissions per client before waiting on Redis.")] = 5,
+):
+    asyncio.run(_compare_rate_limiters(requests, clients, concurrency, max_unsynced))
+
+
+async def _script_usec_per_call(redis_client: Redis) -> float:
+    stats = await redis_client.info("commandstats")
+    return stats.get("cmdstat_evalsha", {}).get("usec_per_call", 0.0)
+
+
+async def _admitted_on_schedule(limiter: TokenBucketManager, key: str, seconds: int, every_ms: int) -> int:
+    # Replays one client sending a request every every_ms for seconds, on a simulated clock
+    admitted = 0
+    for tick in range(seconds * 1000 // every_ms):
+        now = 1_700_000_000 + tick * every_ms / 1000
+        if isinstance(limiter, GcraRateLimiter):
+            result = await limiter.gcra_script(
+                keys=[key], args=[int(now * 1_000_000), limiter.emission_interval_us, limiter.tolerance_us, 1]
+            ) == 0
+        else:
+            result = await limiter.lua_script(keys=[key], args=[limiter.capacity, limiter.refill_rate, now, 1])
+        admitted += bool(result)
+    return admitted
+
+
+async def _compare_gcra(clients: int, refill_rate: float):
+    redis_client = get_redis_client()
+    limiters = {
+        "bucket": TokenBucketManager(redis_client, capacity=5, refill_rate=refill_rate),
+        "gcra": GcraRateLimiter(redis_client, capacity=5, refill_rate=refill_rate),
+    }
+
+    typer.echo(f"{'limiter':>8} {'bytes/client':>13} {'script (us)':>12} {'admitted':>9} {'expected':>9}")
+    for name, limiter in limiters.items():
+        await limiter.preload()
+        ips = [f"10.{i // 65536}.{i // 256 % 256}.{i % 256}" for i in range(clients)]
+        before = (await redis_client.info("memory"))["used_memory"]
+        await redis_client.config_resetstat()
+        for offset in range(0, clients, 500):
+            await asyncio.gather(*(limiter.consume(user_id=None, ip=ip) for ip in ips[offset:offset + 500]))
+        per_client = ((await redis_client.info("memory"))["used_memory"] - before) / clients
+        usec = await _script_usec_per_call(redis_client)
+
+        # One request every 100ms for a minute: ideally the burst plus refill_rate per second
+        admitted = await _admitted_on_schedule(limiter, f"{limiter.RATE_LIMIT_PREFIX}:bench-schedule", 60, 100)
+        typer.echo(
+            f"{name:>8} {per_client:>13.0f} {usec:>12.2f} {admitted:>9} {limiter.capacity + int(60 * refill_rate):>9}"
+        )
+        async for key in redis_client.scan_iter(match=f"{limiter.RATE_LIMIT_PREFIX}:*"):
+            await redis_client.delete(key)
+
+    await redis_client.aclose()
+
+
+@benchmark.command("gcra", help="Redis memory, script CPU and admission accuracy of the token bucket vs GCRA.")
+def gcra(
+    clients: Annotated[int, typer.Option(help="Distinct clients tracked.")] = 20000,
+    refill_rate: Annotated[float, typer.Option(help="Requests per second each client is allowed.")] = 0.5,
+):
+    asyncio.run(_compare_gcra(clients, refill_rate))
+
+
+class LegacyRateLimitMiddleware(BaseHTTPMiddleware):
+    # RateLimitMiddleware as it was before the plain ASGI rewrite
+    async def dispatch(self, request: Request, call_next):
+        manager = request.app.state.token_bucket_manager
+        allowed, retry_after = await manager.check(user_id=None, ip=request.client.host if request.client else None)
+        if not allowed:
+            return JSONResponse({"detail": "Too Many Requests"}, status_code=429)
+        return await call_next(request)
+
+
+def _middleware_app(variant: str) -> FastAPI:
+    app = FastAPI()
+    app.include_router(session_router.router)
+    app.state.token_bucket_manager = AdmitAll()
+    sys_log = logger.get_logger(Module.SYS)
+
+    if variant == "base_http":
+        app.add_middleware(LegacyRateLimitMiddleware)
+
+        @app.middleware("http")
+        async def log_process_time(request: Request, call_next):
+            start_time = time.time()
+            response = await call_next(request)
+            sys_log.info(f"{request.method} {request.url.path} took {round((time.time() - start_time) * 1000, 2)}ms")
+            return response
+    elif variant == "asgi":
+        app.add_middleware(RateLimitMiddleware)
+        app.add_middleware(ProcessTimeMiddleware)
+
+    @app.get("/")
+    async def hello():
+        return {"message": "Welcome to Tanin API"}
+
+    return app
+
+
+async def _compare_middleware(requests: int, clients: int, concurrency: int):
+    # Only the middleware differs: the limiter admits everything and the per-request log line is muted
+    logger.get_logger(Module.SYS).setLevel(logging.WARNING)
+    endpoints = [("GET", "/"), ("POST", "/sessions/anonymous")]
+    typer.echo(f"{'middleware':>10} " + " ".join(f"{method + ' ' + path:>26}" for method, path in endpoints))
+    for variant in ("none", "base_http", "asgi"):
+        app = _middleware_app(variant)
+        rates = [await _request_rate(app, requests, clients, concurrency, method, path) for method, path in endpoints]
+        typer.echo(f"{variant:>10} " + " ".join(f"{rate:>20.0f} req/s" for rate in rates))
+
+
+@benchmark.command("middleware", help="HTTP requests per second through BaseHTTPMiddleware vs plain ASGI middleware.")
+def middleware(
+    requests: Annotated[int, typer.Option(help="Requests sent per endpoint and variant.")] = 20000,
+    clients: Annotated[int, typer.Option(help="Distinct client addresses.")] = 200,
+    concurrency: Annotated[int, typer.Option(help="Requests in flight at once.")] = 100,
+):
+    asyncio.run(_compare_middleware(requests, clients, concurrency))
@@ -1,5 +1,6 @@
 import typer
-from .manage import database
+from .benchmark import benchmark
+from .manage import database, state
 
 
 app = typer.Typer(
@@ -15,6 +16,8 @@ def info():
 
 
 app.add_typer(database)
+app.add_typer(state)
+app.add_typer(benchmark)
 
 
 if __name__ == '__main__':
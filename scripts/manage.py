@@ -3,7 +3,11 @@ import sys
 from typing import Annotated
 
 from tanin.core.config import settings
+from tanin.core.database import get_redis_client
+from tanin.core.dependencies import get_connection_manager
 from tanin.core.security import get_password_hash
+from tanin.schemas.chat_schema import RoomClosedEvent
+from tanin.websocket.matching_service import MatchingService
 
 if sys.platform == "win32":
     asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
@@ -116,3 +120,36 @@ def init_db(
         await async_engine.dispose()
 
     asyncio.run(run_init())
+
+
+state = typer.Typer(
+    name="state",
+    help="Maintain the matchmaking state kept in Redis."
+)
+
+
+async def _reclaim_unsharded(scan_count: int):
+    # Releases before sharding kept the pool and rooms on REDIS_URL, even where a cluster now holds them
+    redis_client = get_redis_client()
+    try:
+        keys, reclaimed, users = await MatchingService(redis_client).reclaim_unsharded_keys(scan_count)
+        if users:
+            await get_connection_manager().broadcast_events([(RoomClosedEvent(), user_id) for user_id in users])
+    finally:
+        await redis_client.aclose()
+    logger.info(f"Reclaimed {keys} unsharded keys ({reclaimed} bytes), closed {len(users)} rooms")
+    typer.secho(f"Deleted {keys} keys ({reclaimed} bytes), notified {len(users)} users.", fg=typer.colors.GREEN)
+
+
+@state.command(
+    "reclaim-unsharded",
+    help="Deletes the waiting pool, rooms and room pointers of releases before sharding. "
+         "Run once, after every node runs a sharded release."
+)
+def reclaim_unsharded(
+    scan_count: Annotated[int, typer.Option(help="Keys per SCAN page and script batch.")] = 500,
+    yes: Annotated[bool, typer.Option("--yes", "-y", help="Skip the confirmation.")] = False
+):
+    if not yes and not typer.confirm("Nodes still on a release before sharding lose their rooms. Continue?"):
+        return
+    asyncio.run(_reclaim_unsharded(scan_count))
@@ -0,0 +1,13 @@
+from fastapi import APIRouter
+
+from tanin.utils.metrics import metrics
+
+router = APIRouter(
+    prefix="/metrics",
+    tags=["Metrics"]
+)
+
+
+@router.get("")
+async def get_metrics():
+    return metrics.snapshot()
@@ -1,10 +1,12 @@
 import secrets
+import uuid
 from typing import Annotated, Any, Literal
 
 from pydantic import (
     AnyUrl,
     BeforeValidator,
     computed_field,
+    Field,
 )
 from pydantic_core import MultiHostUrl
 from pydantic_settings import BaseSettings, SettingsConfigDict
@@ -65,11 +67,104 @@ class Settings(BaseSettings):
             path=self.POSTGRES_DB,
         )
 
+    # "redis" shares pools, rooms and delivery between processes; "memory" keeps them in this process,
+    # for a single-node deployment that needs no Redis round trip per search or message. The HTTP rate
+    # limiter is shared state too and stays on REDIS_URL either way, so Redis is still required at startup.
+    STATE_BACKEND: Literal["redis", "memory"] = "redis"
     REDIS_URL: str = "redis://localhost:6379/0"
+    # Matchmaking pools and rooms move to this Redis Cluster when set; pub/sub and presence stay on REDIS_URL
+    REDIS_CLUSTER_URL: str | None = None
     RATE_LIMIT_CAPACITY: int = 5
     RATE_LIMIT_REFILL_RATE: float = 1.0
+    # "redis": every request is checked against Redis. "two_tier": checked against an in-process bucket,
+    # with admitted requests synced to Redis every RATE_LIMIT_SYNC_INTERVAL_MS. Each node admits at most
+    # RATE_LIMIT_MAX_UNSYNCED requests per client that Redis has not seen yet, which bounds over-admission.
+    # "gcra": the same limit kept as one timestamp per client in Redis, rejections carry Retry-After.
+    RATE_LIMIT_MODE: Literal["redis", "two_tier", "gcra"] = "redis"
+    RATE_LIMIT_SYNC_INTERVAL_MS: int = 100
+    RATE_LIMIT_MAX_UNSYNCED: int = 5
 
     ACCESS_TOKEN_EXPIRE_MINUTES: int = 15
+    # Verified token claims are kept per process for this long, never past the token's own exp
+    TOKEN_CLAIMS_CACHE_SIZE: int = 10000
+    TOKEN_CLAIMS_CACHE_TTL_SECONDS: int = 300
+
+    # WebSocket delivery
+    # Identifies this worker process in the cluster; each process gets its own by default
+    NODE_ID: str = Field(default_factory=lambda: uuid.uuid4().hex)
+    # "broadcast": every node receives every event on one shared channel
+    # "routed": events are published only to the channel of the node owning the recipient
+    WS_DELIVERY_MODE: Literal["broadcast", "routed"] = "broadcast"
+    # Deliver straight to the socket when the recipient is connected to this process
+    WS_LOCAL_DELIVERY: bool = True
+    # Bounded per-connection send queue and what to do when a client cannot keep up
+    WS_OUTBOUND_QUEUE_SIZE: int = 256
+    WS_OUTBOUND_OVERFLOW_POLICY: Literal["drop_oldest", "drop_newest", "disconnect"] = "drop_oldest"
+    # "streams" keeps a replay log per user so reconnecting clients can resume, it implies routed delivery
+    WS_DELIVERY_BACKEND: Literal["pubsub", "streams"] = "pubsub"
+    WS_STREAM_MAXLEN: int = 1000
+    WS_STREAM_MAX_AGE_SECONDS: int = 300
+    WS_STREAM_BLOCK_MS: int = 1000
+    # Inbound frame limits. Frames above the SDP limit are never decoded, and after validation only
+    # offers/answers may exceed the smaller one. The SDP limit is also the server-level cap above which
+    # the socket is closed with 1009
+    WS_MAX_FRAME_BYTES: int = 4096
+    WS_MAX_SDP_FRAME_BYTES: int = 65536
+    # Outgoing messages smaller than this are sent without permessage-deflate
+    WS_COMPRESSION_THRESHOLD_BYTES: int = 1024
+    # Inbound events per connection and event type: (burst, events per second), checked before validation.
+    # Types without an entry, and frames without a type, share the "*" limit.
+    WS_EVENT_RATE_LIMITS: dict[str, tuple[float, float]] = {
+        "send_text_message": (20, 5),
+        "start_typing": (20, 5),
+        "stop_typing": (20, 5),
+        "start_searching": (5, 1),
+        "leave_room": (5, 1),
+        "video_call_initiate": (5, 1),
+        "webrtc_offer": (10, 2),
+        "webrtc_answer": (10, 2),
+        "webrtc_ice_candidate": (100, 20),
+        "*": (20, 5),
+    }
+    # Over the limit an event is silently dropped, answered with an ErrorEvent, or the socket is closed with 1008
+    WS_EVENT_RATE_LIMIT_POLICY: Literal["drop", "error", "disconnect"] = "error"
+
+    # Matchmaking
+    # "inline": searchers are paired in their own handler; "batch": one elected node drains the pool every tick
+    MATCHING_MODE: Literal["inline", "batch"] = "inline"
+    MATCHER_TICK_MS: int = 50
+    # Inline mode still ticks, this often, to pair tagged searchers past their fallback with the open queue
+    MATCHER_INLINE_TICK_MS: int = 1000
+    MATCHER_BATCH_SIZE: int = 1000
+    MATCHER_LEASE_MS: int = 3000
+    # Tagged searchers wait this long for someone sharing a tag before anyone may be matched with them
+    MATCHING_TAG_FALLBACK_SECONDS: int = 10
+    # The waiting pool is split into this many hash-tagged shards, spread over the cluster's nodes.
+    # A searcher whose shard is empty takes a partner from the fullest other shard.
+    MATCHING_POOL_SHARDS: int = 1
+
+    # Rooms
+    # Rooms expire after ROOM_TTL_SECONDS unless a member's node refreshes them, which it does every
+    # ROOM_SWEEP_INTERVAL_SECONDS, so the TTL must stay well above the interval
+    ROOM_TTL_SECONDS: int = 600
+    ROOM_SWEEP_INTERVAL_SECONDS: int = 60
+    ROOM_SWEEP_SCAN_COUNT: int = 500
+    # A member whose socket drops keeps the room this long; reconnecting with the same client id within
+    # the window resumes it, otherwise the partner is told they left. 0 closes the room at once.
+    ROOM_RECONNECT_GRACE_SECONDS: float = 10
+
+    # Presence
+    # Nodes that miss heartbeats for PRESENCE_NODE_TIMEOUT_SECONDS are treated as crashed and cleaned up
+    PRESENCE_HEARTBEAT_INTERVAL_SECONDS: int = 5
+    PRESENCE_NODE_TIMEOUT_SECONDS: int = 20
+    # Which node owns a user expires after PRESENCE_USER_TTL_SECONDS unless that node is still alive to refresh it
+    PRESENCE_USER_TTL_SECONDS: int = 600
+    # Crash cleanup looks up, clears and notifies users in batches of this size
+    PRESENCE_NOTIFY_BATCH_SIZE: int = 500
+
+    # WebRTC
+    # Trickled ICE candidates from one sender within this window are relayed as one batch, 0 disables
+    WEBRTC_ICE_COALESCE_WINDOW_MS: int = 20
 
 
 settings = Settings()
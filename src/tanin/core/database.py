@@ -5,7 +5,7 @@ from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.ext.asyncio.session import AsyncSession
 from fastapi import Depends, Request
 from tanin.core.config import settings
-from redis.asyncio import Redis, from_url
+from redis.asyncio import Redis, RedisCluster, from_url
 from tanin.utils import logger
 from tanin.utils.logger import Module
 
@@ -20,7 +20,15 @@ async def get_session(request: Request) -> AsyncGenerator[AsyncSession, None]:
 AsyncSessionDep = Annotated[AsyncSession, Depends(get_session)]
 
 
-def get_redis_client() -> Redis:
-    redis_client = from_url(settings.REDIS_URL, decode_responses=True)
+def get_redis_client(decode_responses: bool = True) -> Redis:
+    redis_client = from_url(settings.REDIS_URL, decode_responses=decode_responses)
     logger.info(f"Redis client created for URL: {settings.REDIS_URL}")
     return redis_client
+
+
+def get_matching_redis_client(decode_responses: bool = True) -> Redis | RedisCluster:
+    if not settings.REDIS_CLUSTER_URL:
+        return get_redis_client(decode_responses)
+    redis_client = RedisCluster.from_url(settings.REDIS_CLUSTER_URL, decode_responses=decode_responses)
+    logger.info(f"Redis Cluster client created for URL: {settings.REDIS_CLUSTER_URL}")
+    return redis_client
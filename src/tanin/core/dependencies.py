@@ -1,13 +1,19 @@
 from functools import lru_cache
 
 from tanin.core.config import settings
-from tanin.core.database import get_redis_client
+from tanin.core.database import get_redis_client, get_matching_redis_client
 from redis.asyncio import Redis
 
-from tanin.middlewares.token_bucket import TokenBucketManager
+from tanin.middlewares.token_bucket import TokenBucketManager, TwoTierTokenBucketManager, GcraRateLimiter
 from tanin.utils.logger import Module
-from tanin.websocket.connection_manager import ConnectionManager
-from tanin.websocket.matching_service import MatchingService
+from tanin.websocket.connection_manager import ConnectionManager, BaseConnectionManager
+from tanin.websocket.matcher import BatchMatcher
+from tanin.websocket.matching_service import MatchingService, MatchingBackend
+from tanin.websocket.memory_backend import InMemoryConnectionManager, InMemoryMatchingService
+from tanin.websocket.reaper import PresenceReaper
+from tanin.websocket.reconnect import ReconnectGrace
+from tanin.websocket.room_sweeper import RoomSweeper
+from tanin.websocket.stream_manager import StreamConnectionManager
 from tanin.utils import logger
 
 logger = logger.get_logger(Module.DEPS)
@@ -19,16 +25,113 @@ def get_redis() -> Redis:
 
 
 @lru_cache(maxsize=None)
-def get_connection_manager() -> ConnectionManager:
-    return ConnectionManager(get_redis())
+def get_binary_redis() -> Redis:
+    # Pub/sub payloads are forwarded as raw bytes, decoding them would cost a pass per message
+    return get_redis_client(decode_responses=False)
 
 
 @lru_cache(maxsize=None)
-def get_matching_service() -> MatchingService:
-    return MatchingService(get_redis())
+def get_matching_redis() -> Redis:
+    return get_matching_redis_client()
+
+
+@lru_cache(maxsize=None)
+def get_connection_manager() -> BaseConnectionManager:
+    if settings.STATE_BACKEND == "memory":
+        return InMemoryConnectionManager(
+            node_id=settings.NODE_ID,
+            outbound_queue_size=settings.WS_OUTBOUND_QUEUE_SIZE,
+            overflow_policy=settings.WS_OUTBOUND_OVERFLOW_POLICY
+        )
+    options = dict(
+        node_id=settings.NODE_ID,
+        delivery_mode=settings.WS_DELIVERY_MODE,
+        local_delivery=settings.WS_LOCAL_DELIVERY,
+        outbound_queue_size=settings.WS_OUTBOUND_QUEUE_SIZE,
+        overflow_policy=settings.WS_OUTBOUND_OVERFLOW_POLICY,
+        node_timeout=settings.PRESENCE_NODE_TIMEOUT_SECONDS,
+        user_ttl=settings.PRESENCE_USER_TTL_SECONDS
+    )
+    if settings.WS_DELIVERY_BACKEND == "streams":
+        return StreamConnectionManager(
+            get_binary_redis(),
+            stream_maxlen=settings.WS_STREAM_MAXLEN,
+            stream_max_age=settings.WS_STREAM_MAX_AGE_SECONDS,
+            block_ms=settings.WS_STREAM_BLOCK_MS,
+            **options
+        )
+    return ConnectionManager(get_binary_redis(), **options)
+
+
+@lru_cache(maxsize=None)
+def get_matching_service() -> MatchingBackend:
+    if settings.STATE_BACKEND == "memory":
+        return InMemoryMatchingService(
+            tag_fallback_seconds=settings.MATCHING_TAG_FALLBACK_SECONDS,
+            room_ttl_seconds=settings.ROOM_TTL_SECONDS
+        )
+    return MatchingService(
+        get_matching_redis(),
+        tag_fallback_seconds=settings.MATCHING_TAG_FALLBACK_SECONDS,
+        room_ttl_seconds=settings.ROOM_TTL_SECONDS,
+        shards=settings.MATCHING_POOL_SHARDS
+    )
+
+
+@lru_cache(maxsize=None)
+def get_presence_reaper() -> PresenceReaper:
+    return PresenceReaper(
+        get_connection_manager(),
+        get_matching_service(),
+        heartbeat_interval=settings.PRESENCE_HEARTBEAT_INTERVAL_SECONDS,
+        notify_batch_size=settings.PRESENCE_NOTIFY_BATCH_SIZE
+    )
+
+
+@lru_cache(maxsize=None)
+def get_room_sweeper() -> RoomSweeper:
+    return RoomSweeper(
+        get_connection_manager(),
+        get_matching_service(),
+        interval=settings.ROOM_SWEEP_INTERVAL_SECONDS,
+        scan_count=settings.ROOM_SWEEP_SCAN_COUNT
+    )
+
+
+@lru_cache(maxsize=None)
+def get_reconnect_grace() -> ReconnectGrace:
+    return ReconnectGrace(
+        get_connection_manager(),
+        get_matching_service(),
+        grace_seconds=settings.ROOM_RECONNECT_GRACE_SECONDS
+    )
+
+
+@lru_cache(maxsize=None)
+def get_batch_matcher() -> BatchMatcher:
+    return BatchMatcher(
+        get_redis() if settings.STATE_BACKEND == "redis" else None,
+        get_connection_manager(),
+        get_matching_service(),
+        tick_ms=settings.MATCHER_TICK_MS if settings.MATCHING_MODE == "batch" else settings.MATCHER_INLINE_TICK_MS,
+        batch_size=settings.MATCHER_BATCH_SIZE,
+        lease_ms=settings.MATCHER_LEASE_MS
+    )
 
 
 @lru_cache(maxsize=None)
 def get_token_bucket_manager() -> TokenBucketManager:
     logger.info("Initialize Token Bucket Manager")
+    if settings.RATE_LIMIT_MODE == "two_tier":
+        return TwoTierTokenBucketManager(
+            get_redis(),
+            capacity=settings.RATE_LIMIT_CAPACITY,
+            refill_rate=settings.RATE_LIMIT_REFILL_RATE,
+            sync_interval_ms=settings.RATE_LIMIT_SYNC_INTERVAL_MS,
+            max_unsynced=settings.RATE_LIMIT_MAX_UNSYNCED
+        )
+    if settings.RATE_LIMIT_MODE == "gcra":
+        return GcraRateLimiter(
+            get_redis(), capacity=settings.RATE_LIMIT_CAPACITY, refill_rate=settings.RATE_LIMIT_REFILL_RATE
+        )
     return TokenBucketManager(get_redis(), capacity=settings.RATE_LIMIT_CAPACITY, refill_rate=settings.RATE_LIMIT_REFILL_RATE)
@@ -15,7 +15,7 @@ from tanin.repository.user_repo import UserRepository
 from tanin.schemas.user_schema import ActiveUser
 from fastapi import HTTPException, status, WebSocket
 
-from tanin.utils.helper import extract_user_from_token
+from tanin.utils.helper import token_claims_cache
 from tanin.utils import logger
 from tanin.utils.logger import Module
 
@@ -29,8 +29,10 @@ logger = logger.get_logger(Module.SECURITY)
 async def get_current_active_user(request: Request, session: AsyncSessionDep) -> ActiveUser:
     token = request.headers.get('Authorization')
     if token and token.startswith('Bearer '):
+        # Verified once per request by RateLimitMiddleware, which leaves the claims on request.state
+        claims = getattr(request.state, "token_claims", None) or token_claims_cache.verify(token.split(" ")[1])
         user_repo = UserRepository(session)
-        user = await user_repo.get_user_by_id(UUID(await extract_user_from_token(token.split(" ")[1])))
+        user = await user_repo.get_user_by_id(claims.sub)
         if user:
             return ActiveUser(
                 id=user.id,
@@ -85,7 +87,7 @@ async def get_current_active_user_ws_v2(websocket: WebSocket, session: AsyncSess
         token = auth_header.split(" ")[1]
         try:
             user_repo = UserRepository(session)
-            user = await user_repo.get_user_by_id(UUID(await extract_user_from_token(token.split(" ")[1])))
+            user = await user_repo.get_user_by_id(token_claims_cache.verify(token).sub)
 
             if user:
                 return ActiveUser(
@@ -3,17 +3,16 @@ from contextlib import asynccontextmanager
 
 from tanin.core.config import settings
 from tanin.core.database import get_redis_client
-from tanin.core.dependencies import get_connection_manager, get_token_bucket_manager
-from tanin.middlewares.token_bucket import TokenBucketManager, RateLimitMiddleware
+from tanin.core.dependencies import get_connection_manager, get_token_bucket_manager, get_presence_reaper, \
+    get_batch_matcher, get_room_sweeper, get_reconnect_grace
+from tanin.middlewares.process_time import ProcessTimeMiddleware
+from tanin.middlewares.token_bucket import RateLimitMiddleware
 from tanin.websocket import endpoints
 
-import time
-
 from fastapi import FastAPI
 from fastapi.exceptions import RequestValidationError
-from tanin.api.endpoints import session_router, webrtc_router, auth_router
+from tanin.api.endpoints import session_router, webrtc_router, auth_router, metrics_router
 from tanin.core.exceptions import APIException
-from fastapi import Request
 from tanin.core.handlers import api_exception_handler, validation_exception_handler, general_exception_handler
 from tanin.utils import logger
 from tanin.utils.logger import Module
@@ -31,14 +30,26 @@ async def lifespan(app: FastAPI):
 
     manager = get_connection_manager()
     redis_client = get_redis_client()
-    token_bucket_manager = TokenBucketManager(
-        redis_client=redis_client,
-        capacity=settings.RATE_LIMIT_CAPACITY,
-        refill_rate=settings.RATE_LIMIT_REFILL_RATE
-    )
-
-    logger.info("Server is starting up, initializing Pub/Sub listener...")
-    pubsub_listener_task = asyncio.create_task(manager.pubsub_listener())
+    token_bucket_manager = get_token_bucket_manager()
+    # Rate limits live in Redis on every STATE_BACKEND, this also fails startup early when it is unreachable
+    await token_bucket_manager.preload()
+
+    logger.info("Server is starting up, initializing delivery listener...")
+    pubsub_listener_task = asyncio.create_task(manager.listen())
+    # Presence only tracks which node owns a socket, a single in-memory node has nothing to reap
+    presence_task = None
+    if settings.STATE_BACKEND == "redis":
+        presence_task = asyncio.create_task(get_presence_reaper().run())
+    room_sweeper_task = asyncio.create_task(get_room_sweeper().run())
+
+    rate_limit_sync_task = None
+    if settings.RATE_LIMIT_MODE == "two_tier":
+        rate_limit_sync_task = asyncio.create_task(token_bucket_manager.run())
+
+    # In inline mode the matcher still runs, slowly, for tagged searchers whose fallback ran out while
+    # nobody else searched: only a tick pairs them with whoever waits in the open queue
+    logger.info(f"Starting batch matcher ({settings.MATCHING_MODE} mode)...")
+    matcher_task = asyncio.create_task(get_batch_matcher().run())
 
     async_engine = create_async_engine(str(settings.SQLALCHEMY_DATABASE_URI), echo=True)
     session_factory = async_sessionmaker(
@@ -61,7 +72,39 @@ async def lifespan(app: FastAPI):
     try:
         await pubsub_listener_task
     except asyncio.CancelledError:
-        logger.info("Pub/Sub listener task was cancelled successfully.")
+        logger.info("Delivery listener task was cancelled successfully.")
+
+    matcher_task.cancel()
+    try:
+        await matcher_task
+    except asyncio.CancelledError:
+        logger.info("Batch matcher task was cancelled successfully.")
+    await get_batch_matcher().resign()
+
+    await get_reconnect_grace().flush()
+
+    if rate_limit_sync_task:
+        rate_limit_sync_task.cancel()
+        try:
+            await rate_limit_sync_task
+        except asyncio.CancelledError:
+            logger.info("Rate limit sync task was cancelled successfully.")
+        # Hand the last admissions to Redis so the other nodes see them
+        await token_bucket_manager.sync()
+
+    room_sweeper_task.cancel()
+    try:
+        await room_sweeper_task
+    except asyncio.CancelledError:
+        logger.info("Room sweeper task was cancelled successfully.")
+
+    if presence_task:
+        presence_task.cancel()
+        try:
+            await presence_task
+        except asyncio.CancelledError:
+            logger.info("Presence task was cancelled successfully.")
+        await manager.presence.leave()
 
 
 app = FastAPI(
@@ -74,6 +117,7 @@ app.include_router(session_router.router)
 app.include_router(endpoints.router)
 app.include_router(webrtc_router.router)
 app.include_router(auth_router.router)
+app.include_router(metrics_router.router)
 
 app.add_exception_handler(APIException, api_exception_handler)
 app.add_exception_handler(RequestValidationError, validation_exception_handler)
@@ -90,17 +134,7 @@ if settings.all_cors_origins:
         allow_headers=["*"],
     )
 
-
-@app.middleware("http")
-async def log_process_time(request: Request, call_next):
-    start_time = time.time()
-    response = await call_next(request)
-    duration = time.time() - start_time
-
-    log_message = f"{request.method} {request.url.path} took {round(duration * 1000, 2)}ms"
-    logger.info(log_message)
-
-    return response
+app.add_middleware(ProcessTimeMiddleware)
 
 
 @app.get("/")
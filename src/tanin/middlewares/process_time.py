@@ -0,0 +1,30 @@
+import time
+
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from tanin.utils import logger
+from tanin.utils.logger import Module
+
+log = logger.get_logger(Module.SYS)
+
+
+class ProcessTimeMiddleware:
+    # Logs how long each HTTP request took until its response started, as plain ASGI so streaming
+    # responses pass through untouched
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start_time = time.time()
+
+        async def send_wrapper(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                duration = time.time() - start_time
+                log.info(f"{scope['method']} {scope['path']} took {round(duration * 1000, 2)}ms")
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
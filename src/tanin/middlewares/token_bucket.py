@@ -1,17 +1,53 @@
+import asyncio
+import math
 import time
+from typing import Dict, List, Optional, Tuple
 from uuid import UUID
-from starlette.middleware.base import BaseHTTPMiddleware, RequestResponseEndpoint
 from redis.asyncio import Redis
-from fastapi import FastAPI
 from starlette.requests import Request
-from starlette.responses import Response, JSONResponse
+from starlette.responses import JSONResponse
+from starlette.types import ASGIApp, Receive, Scope, Send
 
 from tanin.utils import helper
 from tanin.utils import logger
 from tanin.utils.logger import Module
+from tanin.utils.metrics import metrics
 
 log = logger.get_logger(Module.MID)
 
+# Settle what one node admitted locally per key (ARGV[3 + i] for KEYS[i]) against the shared bucket,
+# refilled up to now, and return what is left. Same hash layout as the TokenBucketManager script.
+RECONCILE_SCRIPT = """
+local capacity, refill_rate, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local remaining = {}
+for i, key in ipairs(KEYS) do
+    local bucket = redis.call('hmget', key, 'tokens', 'last_refill')
+    local tokens = capacity
+    if bucket[1] then
+        tokens = math.min(capacity, tonumber(bucket[1]) + refill_rate * math.max(0, now - tonumber(bucket[2])))
+    end
+    tokens = math.max(0, tokens - math.max(0, tonumber(ARGV[3 + i])))
+    redis.call('hset', key, 'tokens', tokens, 'last_refill', now)
+    redis.call('expire', key, 120)
+    table.insert(remaining, tostring(tokens))
+end
+return remaining
+"""
+
+# GCRA over one theoretical arrival time per key (KEYS[1]), in microseconds. ARGV: now, emission interval,
+# burst tolerance, amount. Returns 0 when admitted, otherwise the microseconds until it would be.
+GCRA_SCRIPT = """
+local now, interval, tolerance, amount = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3]), tonumber(ARGV[4])
+local tat = math.max(tonumber(redis.call('get', KEYS[1]) or 0), now)
+local new_tat = tat + interval * amount
+local allow_at = new_tat - tolerance
+if allow_at > now then
+    return allow_at - now
+end
+redis.call('set', KEYS[1], string.format('%.0f', new_tat), 'PX', math.ceil((new_tat - now) / 1000))
+return 0
+"""
+
 
 # In-memory manager
 # class TokenBucket:
@@ -86,28 +122,30 @@ class TokenBucketManager:
             """
         )
 
-    async def consume(self, user_id: UUID, ip: str, amount: int = 1) -> bool:
-        log.info("Consuming...")
-        key = None
+    def bucket_key(self, user_id: UUID, ip: str) -> str:
         if user_id:
-            key = f"{self.RATE_LIMIT_PREFIX}:user:{str(user_id)}"
-        elif ip:
-            key = f"{self.RATE_LIMIT_PREFIX}:ip:{ip}"
-
-        log.info(f"Key: {key}")
-
-        if not key:
-            raise ValueError("user_id or ip must be provided for rate limiting")
+            return f"{self.RATE_LIMIT_PREFIX}:user:{str(user_id)}"
+        if ip:
+            return f"{self.RATE_LIMIT_PREFIX}:ip:{ip}"
+        raise ValueError("user_id or ip must be provided for rate limiting")
 
+    async def consume(self, user_id: UUID, ip: str, amount: int = 1) -> bool:
+        key = self.bucket_key(user_id, ip)
         now = time.time()
-        data = await self.redis.hgetall(key)
-        log.info(data)
         result = await self.lua_script(
             keys=[key],
             args=[self.capacity, self.refill_rate, now, amount]
         )
         return bool(result)
 
+    async def check(self, user_id: UUID, ip: str, amount: int = 1) -> Tuple[bool, Optional[float]]:
+        # Whether the request is admitted and, if not and the limiter knows, the seconds until it would be
+        return await self.consume(user_id, ip, amount), None
+
+    async def preload(self):
+        # Scripts run as EVALSHA, loading them up front spares the first request the NOSCRIPT retry
+        await self.redis.script_load(self.lua_script.script)
+
     # async def consume(self, user_id: UUID, ip: str, amount: int = 1) -> bool:
     #     log.info("Consuming...")
     #     key = None
@@ -150,26 +188,184 @@ class TokenBucketManager:
     #     return False
 
 
-class RateLimitMiddleware(BaseHTTPMiddleware):
-    def __init__(self, app: FastAPI):
-        super().__init__(app)
+class LocalBucket:
+    __slots__ = ("tokens", "last_refill", "unsynced", "in_flight")
+
+    def __init__(self, tokens: float, now: float):
+        self.tokens = tokens
+        self.last_refill = now
+        # Admitted here since Redis last heard about this key
+        self.unsynced = 0
+        # Sent to Redis by syncs that have not returned yet, so no two syncs ever send the same admissions
+        self.in_flight = 0
+
+
+class TwoTierTokenBucketManager(TokenBucketManager):
+    # Admits or rejects from an in-process copy of each bucket. What was admitted reaches Redis in one
+    # batch every sync interval, and the shared balance that comes back corrects the local copies.
+    # A node admits at most max_unsynced requests per key that Redis has not seen, so with N nodes a
+    # client gets at most N * max_unsynced requests over the limit.
+    def __init__(
+            self,
+            redis_client: Redis,
+            capacity: int = 20,
+            refill_rate: float = 5.0,
+            sync_interval_ms: int = 100,
+            max_unsynced: int = 5,
+            sync_batch_size: int = 500
+    ):
+        super().__init__(redis_client, capacity=capacity, refill_rate=refill_rate)
+        self.sync_interval = sync_interval_ms / 1000
+        self.max_unsynced = max_unsynced
+        self.sync_batch_size = sync_batch_size
+        self.buckets: Dict[str, LocalBucket] = {}
+
+        self.reconcile_script = self.redis.register_script(RECONCILE_SCRIPT)
+
+        self.inline_syncs = metrics.counter(
+            "rate_limit_inline_syncs", "Requests that waited on Redis after using up the unsynced allowance"
+        )
+
+    def _refill(self, bucket: LocalBucket, now: float):
+        bucket.tokens = min(self.capacity, bucket.tokens + self.refill_rate * (now - bucket.last_refill))
+        bucket.last_refill = now
+
+    async def preload(self):
+        await super().preload()
+        await self.redis.script_load(self.reconcile_script.script)
+
+    async def consume(self, user_id: UUID, ip: str, amount: int = 1) -> bool:
+        return (await self.check(user_id, ip, amount))[0]
+
+    async def check(self, user_id: UUID, ip: str, amount: int = 1) -> Tuple[bool, Optional[float]]:
+        key = self.bucket_key(user_id, ip)
+        now = time.time()
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = LocalBucket(self.capacity, now)
+        else:
+            self._refill(bucket, now)
+
+        if bucket.tokens < amount:
+            return False, (amount - bucket.tokens) / self.refill_rate
+        if bucket.unsynced + amount > self.max_unsynced:
+            self.inline_syncs.inc()
+            await self.sync([key])
+            self._refill(bucket, time.time())
+            if bucket.tokens < amount:
+                return False, (amount - bucket.tokens) / self.refill_rate
+
+        bucket.tokens -= amount
+        bucket.unsynced += amount
+        return True, None
+
+    async def sync(self, keys: Optional[List[str]] = None):
+        now = time.time()
+        if keys is None:
+            # Buckets that have refilled completely and owe Redis nothing are the same as new ones
+            full_after = self.capacity / self.refill_rate if self.refill_rate else float("inf")
+            for key in [key for key, bucket in self.buckets.items()
+                        if not bucket.unsynced and not bucket.in_flight and now - bucket.last_refill >= full_after]:
+                del self.buckets[key]
+            keys = list(self.buckets)
+
+        for start in range(0, len(keys), self.sync_batch_size):
+            batch = [key for key in keys[start:start + self.sync_batch_size] if key in self.buckets]
+            if not batch:
+                continue
+            buckets = [self.buckets[key] for key in batch]
+            sent = []
+            for bucket in buckets:
+                sent.append(max(0, bucket.unsynced))
+                bucket.unsynced = 0
+                bucket.in_flight += sent[-1]
+            try:
+                remaining = await self.reconcile_script(
+                    keys=batch, args=[self.capacity, self.refill_rate, now, *sent]
+                )
+            except Exception:
+                # Not settled, owed to Redis again by the next sync
+                for bucket, consumed in zip(buckets, sent):
+                    bucket.in_flight -= consumed
+                    bucket.unsynced += consumed
+                raise
+            for bucket, consumed, tokens in zip(buckets, sent, remaining):
+                bucket.in_flight -= consumed
+                # Admitted while the script ran, or sent by a sync still running, is not in Redis' answer yet
+                bucket.tokens = float(tokens) - bucket.unsynced - bucket.in_flight
+                bucket.last_refill = now
+
+    async def run(self):
+        while True:
+            try:
+                await self.sync()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.error(f"Rate limit sync failed: {e}")
+            await asyncio.sleep(self.sync_interval)
+
+
+class GcraRateLimiter(TokenBucketManager):
+    # Same limit as the token bucket, a burst of capacity refilled at refill_rate per second, kept as a
+    # single string per key: the time at which the client's next request would be exactly on schedule
+    def __init__(self, redis_client: Redis, capacity: int = 20, refill_rate: float = 5.0):
+        super().__init__(redis_client, capacity=capacity, refill_rate=refill_rate)
+        self.RATE_LIMIT_PREFIX = "rate_limit:gcra"
+        self.emission_interval_us = round(1_000_000 / refill_rate)
+        self.tolerance_us = self.emission_interval_us * capacity
+
+        self.gcra_script = self.redis.register_script(GCRA_SCRIPT)
+
+    async def preload(self):
+        await self.redis.script_load(self.gcra_script.script)
+
+    async def consume(self, user_id: UUID, ip: str, amount: int = 1) -> bool:
+        return (await self.check(user_id, ip, amount))[0]
+
+    async def check(self, user_id: UUID, ip: str, amount: int = 1) -> Tuple[bool, Optional[float]]:
+        wait_us = await self.gcra_script(
+            keys=[self.bucket_key(user_id, ip)],
+            args=[time.time_ns() // 1000, self.emission_interval_us, self.tolerance_us, amount]
+        )
+        if wait_us > 0:
+            return False, wait_us / 1_000_000
+        return True, None
+
+
+class RateLimitMiddleware:
+    # Plain ASGI rather than BaseHTTPMiddleware: admitted requests go straight to the app, with no extra
+    # task or response stream in between
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
 
-    async def dispatch(self, request: Request, call_next: RequestResponseEndpoint) -> Response:
+        request = Request(scope)
         manager = request.app.state.token_bucket_manager
 
         auth_header = request.headers.get("Authorization")
         user_id = None
         client_ip = None
         if auth_header and auth_header.startswith("Bearer "):
-            user_id = await helper.extract_user_from_token(auth_header.split(" ")[1])
+            claims = helper.token_claims_cache.verify(auth_header.split(" ")[1])
+            request.state.token_claims = claims
+            user_id = claims.sub
 
         if request.client:
             client_ip = request.client.host
 
-        if not await manager.consume(user_id=user_id, ip=client_ip):
-            return JSONResponse({"detail": "Too Many Requests"}, status_code=429)
+        allowed, retry_after = await manager.check(user_id=user_id, ip=client_ip)
+        if not allowed:
+            headers = {"Retry-After": str(math.ceil(retry_after))} if retry_after is not None else None
+            response = JSONResponse({"detail": "Too Many Requests"}, status_code=429, headers=headers)
+            await response(scope, receive, send)
+            return
 
-        return await call_next(request)
+        await self.app(scope, receive, send)
 
 
 
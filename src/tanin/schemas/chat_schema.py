@@ -1,8 +1,8 @@
 from datetime import datetime, timezone
-from typing import Literal, Union
+from typing import Annotated, List, Literal, Union
 from uuid import UUID
 
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, StringConstraints
 
 
 class ChatMessage(BaseModel):
@@ -19,6 +19,9 @@ class SendTextMessageEvent(BaseModel):
 
 class StartSearchingEvent(BaseModel):
     event_type: Literal["start_searching"] = "start_searching"
+    # Language or interest tags, users sharing one are paired first
+    tags: List[Annotated[str, StringConstraints(strip_whitespace=True, to_lower=True, min_length=1, max_length=32)]] = \
+        Field(default_factory=list, max_length=5)
 
 
 class LeaveRoomEvent(BaseModel):
@@ -76,6 +79,18 @@ class PartnerLeftEvent(BaseModel):
     event_type: Literal["partner_left"] = "partner_left"
 
 
+class RoomClosedEvent(BaseModel):
+    # The server closed the room without either side leaving, e.g. it expired
+    event_type: Literal["room_closed"] = "room_closed"
+
+
+class RoomResumedEvent(BaseModel):
+    # Sent on reconnect when the room outlived the dropped socket
+    event_type: Literal["room_resumed"] = "room_resumed"
+    room_id: UUID
+    partner: dict
+
+
 class PartnerIsTypingEvent(BaseModel):
     event_type: Literal["partner_is_typing"] = "partner_is_typing"
 
@@ -105,6 +120,12 @@ class PartnerWebRTCICECandidateEvent(BaseModel):
     candidate: dict
 
 
+class PartnerWebRTCICECandidatesEvent(BaseModel):
+    event_type: Literal["partner_webrtc_ice_candidates"] = "partner_webrtc_ice_candidates"
+    # Candidates trickled by the partner within one coalescing window, in arrival order
+    candidates: List[dict]
+
+
 class PartnerWantsVideoEvent(BaseModel):
     event_type: Literal["partner_wants_video"] = "partner_wants_video"
 
@@ -119,10 +140,13 @@ ServerEvent = Union[
     MatchedEvent,
     NewTextMessageEvent,
     PartnerLeftEvent,
+    RoomClosedEvent,
+    RoomResumedEvent,
     ErrorEvent,
     PartnerWebRTCOfferEvent,
     PartnerWebRTCAnswerEvent,
     PartnerWebRTCICECandidateEvent,
+    PartnerWebRTCICECandidatesEvent,
     PartnerWantsVideoEvent,
     StartWebRTCNegotiationEvent
 ]
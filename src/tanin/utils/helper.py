@@ -1,5 +1,8 @@
+import hashlib
+import time
+from collections import OrderedDict
 from datetime import timedelta, datetime, timezone
-from typing import Optional
+from typing import Optional, Tuple
 
 import jwt
 
@@ -10,20 +13,76 @@ from pydantic import ValidationError
 from fastapi import HTTPException, status
 from sqlmodel.ext.asyncio.session import AsyncSession
 
+from tanin.utils.metrics import metrics
+
+
+class TokenClaimsCache:
+    # Verified claims by token digest, least recently used evicted first. An entry lives for ttl_seconds
+    # at most and never past the token's exp, so a cached token expires when the token itself would.
+    # Failed verifications are not cached.
+    def __init__(self, maxsize: int = 10000, ttl_seconds: float = 300):
+        self.maxsize = maxsize
+        self.ttl_seconds = ttl_seconds
+        self.entries: "OrderedDict[bytes, Tuple[TokenPayload, float]]" = OrderedDict()
+
+        self.hits = metrics.counter("auth_token_cache_hits", "Tokens whose claims came from the cache")
+        self.misses = metrics.counter("auth_token_cache_misses", "Tokens verified with a signature check")
+
+    @staticmethod
+    def digest(token: str) -> bytes:
+        return hashlib.sha256(token.encode()).digest()
+
+    def get(self, token: str) -> Optional[TokenPayload]:
+        key = self.digest(token)
+        entry = self.entries.get(key)
+        if not entry:
+            return None
+        claims, expires_at = entry
+        if expires_at <= time.time():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return claims
+
+    def put(self, token: str, claims: TokenPayload, exp: Optional[float] = None):
+        if self.maxsize <= 0:
+            return
+        expires_at = time.time() + self.ttl_seconds
+        if exp is not None:
+            expires_at = min(expires_at, exp)
+        key = self.digest(token)
+        self.entries[key] = (claims, expires_at)
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def verify(self, token: str) -> TokenPayload:
+        claims = self.get(token)
+        if claims:
+            self.hits.inc()
+            return claims
+
+        self.misses.inc()
+        from tanin.core import security
+        try:
+            payload = jwt.decode(
+                token, settings.SECRET_KEY, algorithms=[security.ALGORITHM]
+            )
+            claims = TokenPayload(**payload)
+        except (InvalidTokenError, ValidationError):
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN,
+                detail="Could not validate credentials",
+            )
+        self.put(token, claims, payload.get("exp"))
+        return claims
+
+
+token_claims_cache = TokenClaimsCache(settings.TOKEN_CLAIMS_CACHE_SIZE, settings.TOKEN_CLAIMS_CACHE_TTL_SECONDS)
+
 
 async def extract_user_from_token(token: str):
-    from tanin.core import security
-    try:
-        payload = jwt.decode(
-            token, settings.SECRET_KEY, algorithms=[security.ALGORITHM]
-        )
-        token_data = TokenPayload(**payload)
-    except (InvalidTokenError, ValidationError):
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="Could not validate credentials",
-        )
-    return token_data.sub
+    return token_claims_cache.verify(token).sub
 
 
 def create_jwt_token(data: dict, expires_delta: Optional[timedelta] = None) -> str:
@@ -0,0 +1,62 @@
+from collections import deque
+from typing import Callable, Deque, Dict
+
+
+class Counter:
+    def __init__(self, name: str, description: str = ""):
+        self.name = name
+        self.description = description
+        self.value = 0
+
+    def inc(self, amount: int = 1) -> None:
+        self.value += amount
+
+
+class Histogram:
+    # Percentiles over a sliding window of the most recent observations
+    def __init__(self, name: str, description: str = "", window: int = 10000):
+        self.name = name
+        self.description = description
+        self.count = 0
+        self.samples: Deque[float] = deque(maxlen=window)
+
+    def observe(self, value: float) -> None:
+        self.count += 1
+        self.samples.append(value)
+
+    def summary(self, percentiles=(50, 95, 99)) -> dict:
+        ordered = sorted(self.samples)
+        data = {"count": self.count}
+        for q in percentiles:
+            data[f"p{q}"] = ordered[min(len(ordered) - 1, int(q / 100 * len(ordered)))] if ordered else 0.0
+        return data
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._counters: Dict[str, Counter] = {}
+        self._gauges: Dict[str, Callable[[], float]] = {}
+        self._histograms: Dict[str, Histogram] = {}
+
+    def counter(self, name: str, description: str = "") -> Counter:
+        if name not in self._counters:
+            self._counters[name] = Counter(name, description)
+        return self._counters[name]
+
+    def histogram(self, name: str, description: str = "") -> Histogram:
+        if name not in self._histograms:
+            self._histograms[name] = Histogram(name, description)
+        return self._histograms[name]
+
+    def gauge(self, name: str, func: Callable[[], float]) -> None:
+        # Gauges are computed lazily when a snapshot is taken
+        self._gauges[name] = func
+
+    def snapshot(self) -> dict:
+        data = {name: counter.value for name, counter in self._counters.items()}
+        data.update({name: func() for name, func in self._gauges.items()})
+        data.update({name: histogram.summary() for name, histogram in self._histograms.items()})
+        return data
+
+
+metrics = MetricsRegistry()
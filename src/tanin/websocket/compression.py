@@ -0,0 +1,63 @@
+from websockets.extensions.permessage_deflate import PerMessageDeflate, ServerPerMessageDeflateFactory
+from websockets.frames import Frame, Opcode
+from uvicorn.protocols.websockets.websockets_sansio_impl import WebSocketsSansIOProtocol
+
+from tanin.core.config import settings
+from tanin.utils.metrics import metrics
+
+bytes_saved = metrics.counter("ws_compression_bytes_saved", "Bytes saved by permessage-deflate")
+frames_compressed = metrics.counter("ws_compression_frames_compressed", "Outgoing frames deflated")
+frames_skipped = metrics.counter("ws_compression_frames_skipped", "Outgoing frames below the deflate threshold")
+
+
+class ThresholdPerMessageDeflate(PerMessageDeflate):
+    # RFC 7692 lets the sender leave any message uncompressed (RSV1 unset), the peer's
+    # inflate context is untouched since those bytes never went through the compressor
+    def __init__(self, *args, threshold: int = 0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.threshold = threshold
+
+    def encode(self, frame: Frame) -> Frame:
+        if frame.opcode not in (Opcode.TEXT, Opcode.BINARY) or not frame.fin:
+            return super().encode(frame)
+
+        if len(frame.data) < self.threshold:
+            frames_skipped.inc()
+            return frame
+
+        encoded = super().encode(frame)
+        frames_compressed.inc()
+        bytes_saved.inc(len(frame.data) - len(encoded.data))
+        return encoded
+
+
+class ThresholdPerMessageDeflateFactory(ServerPerMessageDeflateFactory):
+    def __init__(self, *args, threshold: int = 0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.threshold = threshold
+
+    def process_request_params(self, params, accepted_extensions):
+        response_params, extension = super().process_request_params(params, accepted_extensions)
+        return response_params, ThresholdPerMessageDeflate(
+            extension.remote_no_context_takeover,
+            extension.local_no_context_takeover,
+            extension.remote_max_window_bits,
+            extension.local_max_window_bits,
+            self.compress_settings,
+            threshold=self.threshold
+        )
+
+
+class CompressionThresholdProtocol(WebSocketsSansIOProtocol):
+    # uvicorn's websockets-sansio protocol with the deflate extension swapped for the thresholded one
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if self.config.ws_per_message_deflate:
+            self.conn.available_extensions = [
+                ThresholdPerMessageDeflateFactory(
+                    server_max_window_bits=12,
+                    client_max_window_bits=12,
+                    compress_settings={"memLevel": 5},
+                    threshold=settings.WS_COMPRESSION_THRESHOLD_BYTES
+                )
+            ]
@@ -1,99 +1,341 @@
-import json
-from typing import Dict
+import asyncio
+import time
+from abc import ABC, abstractmethod
+from typing import Dict, List, Optional, Tuple, Union
 from uuid import UUID
 
 from redis.asyncio import Redis
-from fastapi import WebSocket
+from fastapi import WebSocket, status
 
-from tanin.schemas.chat_schema import ServerEvent
+from tanin.schemas.chat_schema import MatchedEvent, PartnerLeftEvent, RoomClosedEvent, ServerEvent
 from tanin.utils import logger
 from tanin.utils.logger import Module
+from tanin.utils.metrics import metrics
+from tanin.websocket.presence import PresenceRegistry
+from tanin.websocket.protocol import MSGPACK_SUBPROTOCOL, encode_event, send_payload
 
 log = logger.get_logger(Module.WEBSOCKET)
 
+ENVELOPE_HEADER_SIZE = 16
 
-class ConnectionManager:
-    def __init__(self, redis_client: Redis):
+# Room membership changes travel next to the events that cause them, so no payload is ever parsed
+# for them: one kind byte, followed by the room and partner ids when a room is bound
+ROOM_UNCHANGED, ROOM_CLEARED, ROOM_BOUND = b"\x00", b"\x01", b"\x02"
+ROOM_BOUND_SIZE = 33
+
+
+# Resolve the node owning the recipient and publish to that node's channel in one round trip
+ROUTED_PUBLISH_SCRIPT = """
+local node_id = redis.call('get', KEYS[1])
+if not node_id then
+    return -1
+end
+return redis.call('publish', ARGV[1] .. node_id, ARGV[2])
+"""
+
+
+def room_change(event: ServerEvent) -> bytes:
+    if isinstance(event, MatchedEvent):
+        return ROOM_BOUND + event.room_id.bytes + UUID(str(event.partner["id"])).bytes
+    if isinstance(event, (PartnerLeftEvent, RoomClosedEvent)):
+        return ROOM_CLEARED
+    return ROOM_UNCHANGED
+
+
+def room_change_size(data: bytes) -> int:
+    return ROOM_BOUND_SIZE if data[:1] == ROOM_BOUND else 1
+
+
+class Connection:
+    # One record per socket, slotted so that 100k of them stay cheap
+    __slots__ = (
+        "websocket", "user_id", "outbound", "writer_task", "last_event_id", "replay_buffer",
+        "room_id", "partner_id", "messages_in", "messages_out", "connected_at", "last_seen_at", "binary",
+        "replaced", "closing"
+    )
+
+    def __init__(self, websocket: WebSocket, user_id: UUID, queue_size: int, binary: bool = False):
+        self.websocket = websocket
+        self.user_id = user_id
+        # Negotiated the msgpack subprotocol, frames are sent as bytes instead of JSON text
+        self.binary = binary
+        # Events waiting to be written, drained by the connection's own writer task
+        self.outbound: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.writer_task: Optional[asyncio.Task] = None
+        # Replay position, only tracked by backends that can resume (Redis Streams)
+        self.last_event_id: Optional[bytes] = None
+        self.replay_buffer: Optional[list] = None
+        # Room membership as last seen by this node
+        self.room_id: Optional[UUID] = None
+        self.partner_id: Optional[UUID] = None
+        self.messages_in = 0
+        self.messages_out = 0
+        self.connected_at = time.monotonic()
+        self.last_seen_at = self.connected_at
+        # A newer socket of the same user took over, whoever handles this one must leave the user's state alone
+        self.replaced = False
+        # Being closed by the server, the socket's own handler still runs the departure
+        self.closing = False
+
+    def bind_room(self, room_id: UUID, partner_id: UUID):
+        self.room_id = room_id
+        self.partner_id = partner_id
+
+    def clear_room(self):
+        self.room_id = None
+        self.partner_id = None
+
+    def apply_room_change(self, change: bytes):
+        if change[:1] == ROOM_BOUND:
+            self.bind_room(UUID(bytes=change[1:17]), UUID(bytes=change[17:ROOM_BOUND_SIZE]))
+        elif change == ROOM_CLEARED:
+            self.clear_room()
+
+    def touch(self):
+        self.messages_in += 1
+        self.last_seen_at = time.monotonic()
+
+
+class BaseConnectionManager(ABC):
+    # The sockets of this process and their outbound queues; subclasses decide how events reach other processes
+    def __init__(
+            self,
+            node_id: str = "local",
+            outbound_queue_size: int = 256,
+            overflow_policy: str = "drop_oldest"
+    ):
+        self.active_connections: Dict[UUID, Connection] = {}
+        self.node_id = node_id
+        self.outbound_queue_size = outbound_queue_size
+        self.overflow_policy = overflow_policy
+
+        self.dropped_events = metrics.counter("ws_outbound_dropped", "Events dropped by a full outbound queue")
+        self.slow_consumers = metrics.counter("ws_slow_consumers_disconnected", "Connections closed for lagging")
+
+    @abstractmethod
+    async def connect(
+            self,
+            websocket: WebSocket,
+            user_id: UUID,
+            last_event_id: Optional[str] = None,
+            subprotocol: Optional[str] = None
+    ) -> Connection:
+        ...
+
+    @abstractmethod
+    async def disconnect(self, user_id: UUID):
+        ...
+
+    @abstractmethod
+    async def is_connected(self, user_id: UUID) -> bool:
+        # Whether the user has a socket on any node
+        ...
+
+    @abstractmethod
+    async def broadcast_event_to_user(self, event: ServerEvent, user_id: UUID):
+        ...
+
+    @abstractmethod
+    async def broadcast_events(self, events: List[Tuple[ServerEvent, UUID]], batch_size: int = 500):
+        ...
+
+    @abstractmethod
+    async def listen(self):
+        ...
+
+    def _register(self, websocket: WebSocket, user_id: UUID, binary: bool = False) -> Connection:
+        previous = self.active_connections.pop(user_id, None)
+        if previous:
+            previous.replaced = True
+            self._stop_writer(previous)
+
+        connection = Connection(websocket, user_id, self.outbound_queue_size, binary=binary)
+        connection.writer_task = asyncio.create_task(self._writer(connection))
+        self.active_connections[user_id] = connection
+        return connection
+
+    @staticmethod
+    def _stop_writer(connection: Connection):
+        if connection.writer_task and not connection.writer_task.done():
+            connection.writer_task.cancel()
+
+    async def _writer(self, connection: Connection):
+        try:
+            while True:
+                payload = await connection.outbound.get()
+                await send_payload(connection.websocket, payload, connection.binary)
+                connection.messages_out += 1
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.warning(f"Writer for user {connection.user_id} stopped: {e}")
+
+    async def _close_slow_consumer(self, connection: Connection):
+        self._stop_writer(connection)
+        try:
+            await connection.websocket.close(code=status.WS_1013_TRY_AGAIN_LATER, reason="Client is too slow")
+        except Exception as e:
+            log.warning(f"Failed to close slow consumer {connection.user_id}: {e}")
+
+    def enqueue(self, connection: Connection, payload: Union[str, bytes], room: bytes = ROOM_UNCHANGED):
+        if connection.closing:
+            return
+        connection.apply_room_change(room)
+        try:
+            connection.outbound.put_nowait(payload)
+            return
+        except asyncio.QueueFull:
+            pass
+
+        if self.overflow_policy == "drop_oldest":
+            connection.outbound.get_nowait()
+            connection.outbound.put_nowait(payload)
+            self.dropped_events.inc()
+        elif self.overflow_policy == "drop_newest":
+            self.dropped_events.inc()
+        else:
+            log.warning(f"Outbound queue of user {connection.user_id} is full, disconnecting")
+            self.slow_consumers.inc()
+            # Only the socket is closed here. Its handler sees the disconnect and releases presence,
+            # pool and room like for any other departure.
+            connection.closing = True
+            asyncio.create_task(self._close_slow_consumer(connection))
+
+    async def send_personal_event(self, event: ServerEvent, user_id: UUID):
+        connection = self.active_connections.get(user_id)
+        if connection:
+            self.enqueue(connection, encode_event(event, connection.binary), room_change(event))
+
+
+class ConnectionManager(BaseConnectionManager):
+    def __init__(
+            self,
+            redis_client: Redis,
+            node_id: str = "local",
+            delivery_mode: str = "broadcast",
+            local_delivery: bool = True,
+            outbound_queue_size: int = 256,
+            overflow_policy: str = "drop_oldest",
+            node_timeout: int = 20,
+            user_ttl: int = 600
+    ):
+        super().__init__(node_id, outbound_queue_size=outbound_queue_size, overflow_policy=overflow_policy)
         self.redis = redis_client
-        self.active_connections: Dict[UUID, WebSocket] = {}
+        self.delivery_mode = delivery_mode
+        self.local_delivery = local_delivery
         self.pubsub_channel = "tanin:chat_messages"
+        self.NODE_CHANNEL_PREFIX = "tanin:node:"
+        # Which node owns which socket, also what the reaper uses to clean up after crashed nodes
+        self.presence = PresenceRegistry(redis_client, node_id, node_timeout=node_timeout, user_ttl=user_ttl)
+
+        self.routed_publish_script = self.redis.register_script(ROUTED_PUBLISH_SCRIPT)
+
+        self.local_deliveries = metrics.counter("ws_local_deliveries", "Events delivered without Redis")
+        self.remote_deliveries = metrics.counter("ws_remote_deliveries", "Events published through Redis")
+        metrics.gauge("ws_local_hit_ratio", lambda: self.local_hit_ratio)
+
+    @property
+    def local_hit_ratio(self) -> float:
+        total = self.local_deliveries.value + self.remote_deliveries.value
+        return self.local_deliveries.value / total if total else 0.0
 
-    async def connect(self, websocket: WebSocket, user_id: UUID):
-        await websocket.accept()
-        self.active_connections[user_id] = websocket
+    @property
+    def is_routed(self) -> bool:
+        return self.delivery_mode == "routed"
+
+    @property
+    def node_channel(self) -> str:
+        return f"{self.NODE_CHANNEL_PREFIX}{self.node_id}"
+
+    @property
+    def subscribe_channel(self) -> str:
+        return self.node_channel if self.is_routed else self.pubsub_channel
+
+    async def connect(
+            self,
+            websocket: WebSocket,
+            user_id: UUID,
+            last_event_id: Optional[str] = None,
+            subprotocol: Optional[str] = None
+    ) -> Connection:
+        # Pub/sub keeps no history, so last_event_id is ignored here
+        await websocket.accept(subprotocol=subprotocol)
+        connection = self._register(websocket, user_id, binary=subprotocol == MSGPACK_SUBPROTOCOL)
+        await self.presence.register_user(user_id)
+        return connection
 
     async def disconnect(self, user_id: UUID):
-        if user_id in self.active_connections:
-            del self.active_connections[user_id]
+        connection = self.active_connections.pop(user_id, None)
+        if connection:
+            self._stop_writer(connection)
+        await self.presence.unregister_user(user_id)
 
-    async def send_personal_event(self, event: ServerEvent, user_id: UUID):
-        if user_id in self.active_connections:
-            websocket = self.active_connections[user_id]
-            await websocket.send_json(event.model_dump())
+    async def is_connected(self, user_id: UUID) -> bool:
+        return user_id in self.active_connections or await self.presence.is_online(user_id)
+
+    @staticmethod
+    def encode_message(event: ServerEvent, user_id: UUID) -> bytes:
+        # Envelope: 16 raw bytes of recipient id, the room change, then the already encoded event
+        return user_id.bytes + room_change(event) + event.model_dump_json().encode()
 
     async def broadcast_event_to_user(self, event: ServerEvent, user_id: UUID):
-        message = {
-            'recipient_id': str(user_id),
-            'event_data': event.model_dump_json()
-        }
-        log.info(message)
-        await self.redis.publish(self.pubsub_channel, json.dumps(message))
+        # Same-process recipients skip the Redis round trip; the event joins the same outbound
+        # queue the listener feeds, so ordering matches the Redis path
+        if self.local_delivery and user_id in self.active_connections:
+            self.local_deliveries.inc()
+            await self.send_personal_event(event, user_id)
+            return
+
+        self.remote_deliveries.inc()
+        log.info(f"Publishing {event.event_type} to {user_id}")
+        await self._publish(self.redis, event, user_id)
+
+    async def broadcast_events(self, events: List[Tuple[ServerEvent, UUID]], batch_size: int = 500):
+        # Bulk variant for fan-outs such as crash cleanup: remote events go out in pipelined batches
+        remote = []
+        for event, user_id in events:
+            if self.local_delivery and user_id in self.active_connections:
+                self.local_deliveries.inc()
+                await self.send_personal_event(event, user_id)
+            else:
+                remote.append((event, user_id))
+
+        for start in range(0, len(remote), batch_size):
+            async with self.redis.pipeline(transaction=False) as pipe:
+                for event, user_id in remote[start:start + batch_size]:
+                    await self._publish(pipe, event, user_id)
+                await pipe.execute()
+            self.remote_deliveries.inc(len(remote[start:start + batch_size]))
+
+    async def _publish(self, client, event: ServerEvent, user_id: UUID):
+        message = self.encode_message(event, user_id)
+        if self.is_routed:
+            await self.routed_publish_script(
+                keys=[self.presence.user_node_key(user_id)],
+                args=[self.NODE_CHANNEL_PREFIX, message],
+                client=client
+            )
+        else:
+            await client.publish(self.pubsub_channel, message)
+
+    def handle_pubsub_message(self, raw_message: bytes):
+        # Only enqueues, a slow socket must never block the listener.
+        # The event itself is forwarded verbatim and never parsed here.
+        recipient_id = UUID(bytes=raw_message[:ENVELOPE_HEADER_SIZE])
+
+        connection = self.active_connections.get(recipient_id)
+        if connection:
+            body = raw_message[ENVELOPE_HEADER_SIZE:]
+            size = room_change_size(body)
+            self.enqueue(connection, body[size:].decode(), body[:size])
+
+    async def listen(self):
+        await self.pubsub_listener()
 
     async def pubsub_listener(self):
         async with self.redis.pubsub() as pubsub:
-            await pubsub.subscribe(self.pubsub_channel)
+            await pubsub.subscribe(self.subscribe_channel)
+            log.info(f"Node {self.node_id} listening on {self.subscribe_channel}")
             async for message in pubsub.listen():
                 if message["type"] == "message":
-                    data = json.loads(message["data"])
-                    recipient_id = UUID(data["recipient_id"])
-                    event_data = json.loads(data["event_data"])
-
-                    if recipient_id in self.active_connections:
-                        websocket = self.active_connections[recipient_id]
-                        await websocket.send_json(event_data)
-
-
-# class SimpleConnectionManager:
-#     def __init__(self):
-#         self.active_connections: dict[str, WebSocket] = {}
-#
-#     async def connect(self, websocket: WebSocket, user_id: str):
-#         await websocket.accept()
-#         self.active_connections[user_id] = websocket
-#         logger.info(f"Người dùng {user_id} đã kết nối. Hiện có {len(self.active_connections)} kết nối.")
-#
-#     def disconnect(self, user_id: str):
-#         if user_id in self.active_connections:
-#             del self.active_connections[user_id]
-#             logger.info(f"Người dùng {user_id} đã ngắt kết nối.")
-#
-#     async def send_personal_message(self, message: str, user_id: str):
-#         if user_id in self.active_connections:
-#             websocket = self.active_connections[user_id]
-#             await websocket.send_text(message)
-#
-#     async def broadcast(self, message: str):
-#         for user_id, websocket in self.active_connections.items():
-#             await websocket.send_text(message)
-
-
-# class ConnectionManager:
-#     def __init__(self):
-#         self.active_connections: Dict[UUID, WebSocket] = {}
-#
-#     async def connect(self, websocket: WebSocket, conversation_id: UUID):
-#         self.active_connections[conversation_id] = websocket
-#
-#     async def disconnect(self, conversation_id: UUID):
-#         if conversation_id in self.active_connections:
-#             del self.active_connections[conversation_id]
-#
-#     async def send_message(self, message: str, websocket: WebSocket):
-#         await websocket.send_text(message)
-#
-#     async def broadcast(self, message: str, conversation_id: UUID):
-#         if conversation_id in self.active_connections:
-#             await self.active_connections[conversation_id].send_text(message)
-
-
-# manager = ConnectionManager()
+                    self.handle_pubsub_message(message["data"])
@@ -1,94 +1,162 @@
 import uuid
+from functools import partial
+from typing import List, Optional, Tuple
+from uuid import UUID
 
-from fastapi import APIRouter, WebSocket, Depends, WebSocketDisconnect
+from fastapi import APIRouter, WebSocket, Depends, WebSocketDisconnect, status
 
-from tanin.core.dependencies import get_matching_service, get_connection_manager
+from tanin.core.config import settings
+from tanin.core.dependencies import get_matching_service, get_connection_manager, get_reconnect_grace
 from tanin.core.security import get_current_active_user_ws
-from tanin.schemas.chat_schema import ClientEvent, StartSearchingEvent, MatchedEvent, SendTextMessageEvent, ChatMessage, \
+from tanin.schemas.chat_schema import ClientEvent, StartSearchingEvent, SendTextMessageEvent, ChatMessage, \
     NewTextMessageEvent, LeaveRoomEvent, PartnerLeftEvent, WebRTCOfferEvent, WebRTCAnswerEvent, WebRTCICECandidateEvent, \
     PartnerWebRTCOfferEvent, PartnerWebRTCAnswerEvent, PartnerWebRTCICECandidateEvent, VideoCallInitiateEvent, \
-    StartWebRTCNegotiationEvent, PartnerWantsVideoEvent
+    StartWebRTCNegotiationEvent, PartnerWantsVideoEvent, PartnerWebRTCICECandidatesEvent, ErrorEvent, ServerEvent
 from tanin.schemas.user_schema import ActiveUser
 from tanin.utils.logger import Module
-from tanin.websocket.connection_manager import ConnectionManager
+from tanin.utils.metrics import metrics
+from tanin.websocket.connection_manager import BaseConnectionManager, Connection
+from tanin.websocket.event_limiter import EventRateLimiter
+from tanin.websocket.ice_coalescer import IceCandidateCoalescer
+from tanin.websocket.matcher import matched_events
+from tanin.websocket.protocol import FrameError, select_subprotocol, receive_frame, frame_size, decode_frame, \
+    frame_size_limit
+from tanin.websocket.reconnect import ReconnectGrace
 import pydantic
 from tanin.utils import logger
-from tanin.websocket.matching_service import MatchingService
+from tanin.websocket.matching_service import MatchingBackend
 
 router = APIRouter()
 
 logger = logger.get_logger(Module.WEBSOCKET)
 
+oversized_frames = metrics.counter("ws_oversized_frames", "Inbound frames rejected for exceeding the size limit")
 
-async def handle_user_departure(
-        user: ActiveUser,
-        manager: ConnectionManager,
-        matching_service: MatchingService
+
+async def reject_oversized_frame(manager: BaseConnectionManager, user_id: UUID):
+    oversized_frames.inc()
+    await manager.send_personal_event(ErrorEvent(message="Frame too large"), user_id)
+
+
+async def resolve_room(connection: Connection, matching_service: MatchingBackend) -> Optional[Tuple[UUID, UUID]]:
+    # The room is bound from the delivered MatchedEvent, Redis is only asked when a session
+    # picked up an existing room, e.g. after reconnecting mid-conversation
+    if connection.room_id is None:
+        room_info = await matching_service.get_user_room_info(connection.user_id)
+        if not room_info:
+            return None
+        connection.bind_room(*room_info)
+    return connection.room_id, connection.partner_id
+
+
+async def relay_to_partner(
+        connection: Connection,
+        manager: BaseConnectionManager,
+        matching_service: MatchingBackend,
+        event: ServerEvent
+) -> bool:
+    room_info = await resolve_room(connection, matching_service)
+    if not room_info:
+        return False
+    await manager.broadcast_event_to_user(event, room_info[1])
+    return True
+
+
+async def relay_ice_candidates(
+        connection: Connection,
+        manager: BaseConnectionManager,
+        matching_service: MatchingBackend,
+        candidates: List[dict]
 ):
-    logger.info(f"Handling departure for user {user.id}")
-    await manager.disconnect(user.id)
-    partner_id = await matching_service.leave_room(user.id)
-    if partner_id:
-        logger.info(f"User {user.id} left room. Notifying partner {partner_id}")
-        await manager.broadcast_event_to_user(PartnerLeftEvent(), partner_id)
-    await matching_service.remove_from_pool(user.id)
+
+    if len(candidates) == 1:
+        event = PartnerWebRTCICECandidateEvent(candidate=candidates[0])
+    else:
+        event = PartnerWebRTCICECandidatesEvent(candidates=candidates)
+    await relay_to_partner(connection, manager, matching_service, event)
 
 
 @router.websocket("/ws")
 async def websocket_endpoint(
         websocket: WebSocket,
+        last_event_id: str | None = None,
         user: ActiveUser = Depends(get_current_active_user_ws),
-        manager: ConnectionManager = Depends(get_connection_manager),
-        matching_service: MatchingService = Depends(get_matching_service)
+        manager: BaseConnectionManager = Depends(get_connection_manager),
+        matching_service: MatchingBackend = Depends(get_matching_service),
+        reconnect_grace: ReconnectGrace = Depends(get_reconnect_grace)
 ):
-    await manager.connect(websocket, user.id)
+    connection = await manager.connect(
+        websocket, user.id, last_event_id=last_event_id, subprotocol=select_subprotocol(websocket)
+    )
+    await reconnect_grace.resume(connection)
+    ice_coalescer = IceCandidateCoalescer(
+        partial(relay_ice_candidates, connection, manager, matching_service),
+        window_ms=settings.WEBRTC_ICE_COALESCE_WINDOW_MS
+    )
+    event_limiter = EventRateLimiter(settings.WS_EVENT_RATE_LIMITS)
     try:
         while True:
-            data = await websocket.receive_json()
-            logger.info(data)
+            if connection.closing:
+                # Closed by the server for lagging, the socket cannot be read any more
+                raise WebSocketDisconnect(code=status.WS_1013_TRY_AGAIN_LATER)
+            try:
+                frame = await receive_frame(websocket, connection.binary)
+                connection.touch()
+                size = frame_size(frame)
+                # Nothing above the largest allowance is decoded at all
+                if size > settings.WS_MAX_SDP_FRAME_BYTES:
+                    await reject_oversized_frame(manager, user.id)
+                    continue
+                data = decode_frame(frame, connection.binary)
+            except FrameError as e:
+                # Dropped like an event that fails validation, the connection carries on
+                logger.debug(f"Dropped a frame from user {user.id}: {e}")
+                continue
+            if not event_limiter.allow(data.get("event_type") if isinstance(data, dict) else None):
+                # Throttled before validation, so spam never reaches the matcher or Redis
+                if settings.WS_EVENT_RATE_LIMIT_POLICY == "error":
+                    await manager.send_personal_event(ErrorEvent(message="Rate limit exceeded"), user.id)
+                elif settings.WS_EVENT_RATE_LIMIT_POLICY == "disconnect":
+                    await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason="Rate limit exceeded")
+                    raise WebSocketDisconnect(code=status.WS_1008_POLICY_VIOLATION)
+                continue
             try:
                 event = pydantic.parse_obj_as(ClientEvent, data)
-                logger.info(event)
             except pydantic.ValidationError:
                 continue
+            logger.debug(f"Received {event.event_type} ({size} bytes) from user {user.id}")
+            if size > frame_size_limit(event):
+                # Only offers and answers may use the SDP allowance, nothing oversized reaches the partner
+                await reject_oversized_frame(manager, user.id)
+                continue
 
             if isinstance(event, StartSearchingEvent):
-                await matching_service.add_to_pool(user)
-
-                match = await matching_service.find_and_create_match()
+                connection.clear_room()
+                # In batch mode only a shared-tag partner is taken here, the elected matcher pairs the open pool
+                match = await matching_service.enqueue_and_match(
+                    user, event.tags, match_open=settings.MATCHING_MODE == "inline"
+                )
                 if match:
-                    user1_id, user2_id, room_id = match
-                    user1_info = {"id": user1_id, "display_name": "Stranger"}
-                    user2_info = {"id": user2_id, "display_name": "Stranger"}
-
-                    logger.info(user1_info)
-                    logger.info(user2_info)
-
-                    await manager.broadcast_event_to_user(MatchedEvent(room_id=room_id, partner=user2_info), user1_id)
-                    await manager.broadcast_event_to_user(MatchedEvent(room_id=room_id, partner=user1_info), user2_id)
+                    logger.info(f"Matched {match[0]} with {match[1]} in room {match[2]}")
+                    await manager.broadcast_events(matched_events(*match))
 
             elif isinstance(event, SendTextMessageEvent):
-                room_info = await matching_service.get_user_room_info(user.id)
-                if not room_info:
-                    continue
-
-                _, partner_id = room_info
                 chat_message = ChatMessage(id=uuid.uuid4(), sender_id=user.id, content=event.content)
-
-                logger.info(room_info)
                 logger.info(chat_message)
 
-                await manager.broadcast_event_to_user(NewTextMessageEvent(message=chat_message), partner_id)
+                await relay_to_partner(connection, manager, matching_service, NewTextMessageEvent(message=chat_message))
 
             elif isinstance(event, VideoCallInitiateEvent):
-                room_info = await matching_service.get_user_room_info(user.id)
+                room_info = await resolve_room(connection, matching_service)
                 if not room_info:
                     continue
 
                 room_id, partner_id = room_info
-                await matching_service.set_user_ready_for_video(room_id, user.id)
-
-                both_ready = await matching_service.check_if_both_ready_for_video(room_id)
+                both_ready = await matching_service.set_user_ready_for_video(room_id, user.id)
+                if both_ready is None:
+                    # The room closed under a stale cached binding
+                    connection.clear_room()
+                    continue
                 if both_ready:
                     logger.info(f"Both users in room {room_id} are ready for video. Initiating negotiation.")
                     await manager.broadcast_event_to_user(StartWebRTCNegotiationEvent(should_create_offer=True), user.id)
@@ -99,49 +167,34 @@ async def websocket_endpoint(
                     await manager.broadcast_event_to_user(PartnerWantsVideoEvent(), partner_id)
 
             elif isinstance(event, WebRTCOfferEvent):
-                room_info = await matching_service.get_user_room_info(user.id)
-                if not room_info: continue
-                _, partner_id = room_info
-
-                await manager.broadcast_event_to_user(
-                    PartnerWebRTCOfferEvent(sdp=event.sdp),
-                    partner_id
-                )
+                # Candidates gathered so far must reach the partner before the new description
+                await ice_coalescer.flush()
+                await relay_to_partner(connection, manager, matching_service, PartnerWebRTCOfferEvent(sdp=event.sdp))
 
             elif isinstance(event, WebRTCAnswerEvent):
-                room_info = await matching_service.get_user_room_info(user.id)
-                if not room_info:
-                    continue
-                _, partner_id = room_info
-
-                await manager.broadcast_event_to_user(
-                    PartnerWebRTCAnswerEvent(sdp=event.sdp),
-                    partner_id
-                )
+                await ice_coalescer.flush()
+                await relay_to_partner(connection, manager, matching_service, PartnerWebRTCAnswerEvent(sdp=event.sdp))
 
             elif isinstance(event, WebRTCICECandidateEvent):
-                room_info = await matching_service.get_user_room_info(user.id)
-                if not room_info:
-                    continue
-                _, partner_id = room_info
-
-                await manager.broadcast_event_to_user(
-                    PartnerWebRTCICECandidateEvent(candidate=event.candidate),
-                    partner_id
-                )
+                await ice_coalescer.add(event.candidate)
 
             elif isinstance(event, LeaveRoomEvent):
-                partner_id = await matching_service.leave_room(user.id)
+                ice_coalescer.discard()
+                room_id = connection.room_id
+                connection.clear_room()
+                partner_id = await matching_service.leave_room(user.id, room_id)
                 if partner_id:
                     await manager.broadcast_event_to_user(PartnerLeftEvent(), partner_id)
 
     except WebSocketDisconnect:
+        ice_coalescer.discard()
+        if connection.replaced:
+            # A dead socket noticed only after the client reconnected here, the new session owns the user
+            return
         await manager.disconnect(user.id)
-        partner_id = await matching_service.leave_room(user.id)
-        if partner_id:
-            await manager.broadcast_event_to_user(PartnerLeftEvent(), partner_id)
-
         await matching_service.remove_from_pool(user.id)
+        # The room outlives the socket for the grace window, the partner is told only if it runs out
+        await reconnect_grace.depart(user.id, connection.room_id)
 
 # =================================
 # @router.get("/find/{client_id}",
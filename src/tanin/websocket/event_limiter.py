@@ -0,0 +1,45 @@
+import time
+from typing import Any, Dict, Tuple
+
+from tanin.utils.metrics import metrics
+
+throttled_events = metrics.counter("ws_throttled_events", "Inbound events rejected by the per-connection rate limit")
+
+
+class EventBucket:
+    __slots__ = ("tokens", "last_refill")
+
+    def __init__(self, tokens: float, last_refill: float):
+        self.tokens = tokens
+        self.last_refill = last_refill
+
+
+class EventRateLimiter:
+    # Token buckets for one connection, one per event type, refilled lazily when checked.
+    # Nothing is shared, so a check is a dict lookup and some arithmetic.
+    __slots__ = ("limits", "buckets")
+
+    def __init__(self, limits: Dict[str, Tuple[float, float]]):
+        self.limits = limits
+        self.buckets: Dict[str, EventBucket] = {}
+
+    def allow(self, event_type: Any) -> bool:
+        key = event_type if isinstance(event_type, str) and event_type in self.limits else "*"
+        limit = self.limits.get(key)
+        if not limit:
+            return True
+        capacity, refill_rate = limit
+
+        now = time.monotonic()
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = EventBucket(capacity, now)
+        else:
+            bucket.tokens = min(capacity, bucket.tokens + (now - bucket.last_refill) * refill_rate)
+            bucket.last_refill = now
+
+        if bucket.tokens < 1:
+            throttled_events.inc()
+            return False
+        bucket.tokens -= 1
+        return True
@@ -0,0 +1,52 @@
+import asyncio
+from typing import Awaitable, Callable, List, Optional
+
+from tanin.utils import logger
+from tanin.utils.logger import Module
+
+log = logger.get_logger(Module.WEBSOCKET)
+
+
+class IceCandidateCoalescer:
+    def __init__(self, send: Callable[[List[dict]], Awaitable[None]], window_ms: int = 20):
+        self._send = send
+        self.window = window_ms / 1000
+        self.pending: List[dict] = []
+        self._timer: Optional[asyncio.Task] = None
+        # Serializes flushes so an offer/answer never overtakes a batch already being sent
+        self._lock = asyncio.Lock()
+
+    async def add(self, candidate: dict):
+        if self.window <= 0:
+            await self._send([candidate])
+            return
+
+        self.pending.append(candidate)
+        if self._timer is None:
+            self._timer = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.window)
+        self._timer = None
+        try:
+            await self.flush()
+        except Exception as e:
+            # Nobody awaits this task, an unlogged failure here would lose the batch without a trace
+            log.error(f"Relaying a batch of ICE candidates failed: {e}")
+
+    async def flush(self):
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+
+        async with self._lock:
+            if not self.pending:
+                return
+            candidates, self.pending = self.pending, []
+            await self._send(candidates)
+
+    def discard(self):
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        self.pending = []
@@ -0,0 +1,108 @@
+import asyncio
+from typing import List, Optional, Tuple
+from uuid import UUID
+
+from redis.asyncio import Redis
+
+from tanin.schemas.chat_schema import MatchedEvent, ServerEvent
+from tanin.utils import logger
+from tanin.utils.logger import Module
+from tanin.utils.metrics import metrics
+from tanin.websocket.connection_manager import BaseConnectionManager
+from tanin.websocket.matching_service import MatchingBackend
+
+log = logger.get_logger(Module.WEBSOCKET)
+
+
+# Extend the lease only while this node still holds it
+RENEW_LEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+RELEASE_LEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+def matched_events(user1_id: UUID, user2_id: UUID, room_id: UUID) -> List[Tuple[ServerEvent, UUID]]:
+    return [
+        (MatchedEvent(room_id=room_id, partner={"id": user2_id, "display_name": "Stranger"}), user1_id),
+        (MatchedEvent(room_id=room_id, partner={"id": user1_id, "display_name": "Stranger"}), user2_id),
+    ]
+
+
+class BatchMatcher:
+    def __init__(
+            self,
+            redis_client: Optional[Redis],
+            manager: BaseConnectionManager,
+            matching_service: MatchingBackend,
+            tick_ms: int = 50,
+            batch_size: int = 1000,
+            lease_ms: int = 3000
+    ):
+        self.redis = redis_client
+        self.manager = manager
+        self.matching_service = matching_service
+        self.node_id = manager.node_id
+        self.tick = tick_ms / 1000
+        self.batch_size = batch_size
+        self.lease_ms = lease_ms
+        self.is_leader = False
+        self.LEADER_KEY = "tanin:matcher:leader"
+
+        # Without Redis there is a single process and nobody to elect against
+        if self.redis:
+            self.renew_lease_script = self.redis.register_script(RENEW_LEASE_SCRIPT)
+            self.release_lease_script = self.redis.register_script(RELEASE_LEASE_SCRIPT)
+
+        self.matches = metrics.counter("matcher_matches", "Pairs created by the batch matcher")
+
+    async def elect(self) -> bool:
+        if not self.redis:
+            self.is_leader = True
+        elif self.is_leader:
+            self.is_leader = bool(await self.renew_lease_script(
+                keys=[self.LEADER_KEY], args=[self.node_id, self.lease_ms]
+            ))
+        else:
+            self.is_leader = bool(await self.redis.set(self.LEADER_KEY, self.node_id, nx=True, px=self.lease_ms))
+            if self.is_leader:
+                log.info(f"Node {self.node_id} is now the matcher leader")
+        return self.is_leader
+
+    async def resign(self):
+        if self.is_leader and self.redis:
+            await self.release_lease_script(keys=[self.LEADER_KEY], args=[self.node_id])
+            self.is_leader = False
+
+    async def run_once(self) -> int:
+        # Keep draining while full batches come back, so a burst does not wait a tick per batch
+        total = 0
+        while True:
+            matches = await self.matching_service.match_batch(self.batch_size)
+            if matches:
+                events = [event for match in matches for event in matched_events(*match)]
+                await self.manager.broadcast_events(events, batch_size=len(events))
+                self.matches.inc(len(matches))
+                total += len(matches)
+            if len(matches) < self.batch_size:
+                return total
+
+    async def run(self):
+        while True:
+            try:
+                if await self.elect():
+                    await self.run_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.error(f"Batch matcher tick failed: {e}")
+                self.is_leader = False
+            await asyncio.sleep(self.tick)
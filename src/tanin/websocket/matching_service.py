@@ -1,90 +1,803 @@
+import asyncio
+import time
 import uuid
-from typing import Tuple, Optional
+from abc import ABC, abstractmethod
+from collections import defaultdict
+from typing import List, Tuple, Optional
 from uuid import UUID
 
+from redis.asyncio.cluster import RedisCluster
+
 from tanin.schemas.user_schema import ActiveUser
+from tanin.utils.metrics import metrics, Histogram
 from redis.asyncio import Redis
 
 
-class MatchingService:
-    def __init__(self, redis_client: Redis):
+# Shared by the scripts below. Untagged users wait in the open queue (KEYS[1]); tagged users wait in
+# the tagged queue (KEYS[2]) and in one bucket per tag, all sorted sets scored by enqueue time (ms).
+# A tagged user who waited longer than the fallback is promoted to the open queue, where anyone may
+# take them. ARGV[1] is the bucket key prefix, ARGV[2] the user tags key prefix.
+QUEUE_FUNCTIONS = """
+local bucket_prefix, user_tags_prefix = ARGV[1], ARGV[2]
+
+local function dequeue(member)
+    redis.call('zrem', KEYS[1], member)
+    redis.call('zrem', KEYS[2], member)
+    local tags_key = user_tags_prefix .. member
+    for _, tag in ipairs(redis.call('smembers', tags_key)) do
+        redis.call('zrem', bucket_prefix .. tag, member)
+    end
+    redis.call('del', tags_key)
+end
+
+local function promote_expired(cutoff, limit)
+    local expired = redis.call('zrangebyscore', KEYS[2], '-inf', cutoff, 'WITHSCORES', 'LIMIT', 0, limit)
+    for i = 1, #expired, 2 do
+        redis.call('zrem', KEYS[2], expired[i])
+        redis.call('zadd', KEYS[1], expired[i + 1], expired[i])
+    end
+end
+"""
+
+# Rooms and both user pointers expire together unless the members' nodes keep refreshing them
+ROOM_FUNCTIONS = """
+local function create_room(user_room_prefix, room_prefix, room_id, user1_id, user2_id, ttl)
+    redis.call('hset', room_prefix .. room_id, 'user1', user1_id, 'user2', user2_id)
+    redis.call('expire', room_prefix .. room_id, ttl)
+    redis.call('set', user_room_prefix .. user1_id, room_id, 'EX', ttl)
+    redis.call('set', user_room_prefix .. user2_id, room_id, 'EX', ttl)
+end
+"""
+
+# Same as MatchingService.shard_of: the last four hex digits of a UUID are its low 16 bits
+SHARD_FUNCTIONS = """
+local function shard_of(id, shards)
+    return tonumber(string.sub(id, -4), 16) % shards
+end
+"""
+
+DEQUEUE_SCRIPT = QUEUE_FUNCTIONS + """
+for i = 3, #ARGV do
+    dequeue(ARGV[i])
+end
+return 0
+"""
+
+# Enqueue the searcher or pair them, room included, in one atomic step. A partner sharing a tag is
+# taken first, the longest-waiting one across the searcher's buckets. Without one, untagged searchers
+# and tagged ones past their fallback take the head of the open queue, unless ARGV[7] = '0' leaves
+# that to the batch matcher. A repeated search keeps its original enqueue time, and a user who
+# already has a room is neither enqueued nor matched again.
+# Returns partner_id, partner and searcher enqueue times.
+ENQUEUE_AND_MATCH_SCRIPT = QUEUE_FUNCTIONS + ROOM_FUNCTIONS + """
+local user_id, room_id, user_room_prefix, room_prefix = ARGV[3], ARGV[4], ARGV[5], ARGV[6]
+local now, fallback, ttl = tonumber(ARGV[8]), tonumber(ARGV[9]), ARGV[10]
+local tags = {unpack(ARGV, 11)}
+if redis.call('exists', user_room_prefix .. user_id) == 1 then
+    return false
+end
+
+promote_expired(now - fallback, 100)
+local enqueued_at = redis.call('zscore', KEYS[1], user_id) or redis.call('zscore', KEYS[2], user_id) or ARGV[8]
+dequeue(user_id)
+
+local partner_id, partner_at
+for _, tag in ipairs(tags) do
+    local head = redis.call('zrange', bucket_prefix .. tag, 0, 0, 'WITHSCORES')
+    if head[1] and (not partner_at or tonumber(head[2]) < tonumber(partner_at)) then
+        partner_id, partner_at = head[1], head[2]
+    end
+end
+
+if not partner_id and ARGV[7] == '1' and (#tags == 0 or now - tonumber(enqueued_at) >= fallback) then
+    local head = redis.call('zrange', KEYS[1], 0, 0, 'WITHSCORES')
+    partner_id, partner_at = head[1], head[2]
+end
+
+if not partner_id then
+    if #tags == 0 then
+        redis.call('zadd', KEYS[1], enqueued_at, user_id)
+    else
+        redis.call('zadd', KEYS[2], enqueued_at, user_id)
+        redis.call('sadd', user_tags_prefix .. user_id, unpack(tags))
+        for _, tag in ipairs(tags) do
+            redis.call('zadd', bucket_prefix .. tag, enqueued_at, user_id)
+        end
+    end
+    return false
+end
+
+dequeue(partner_id)
+create_room(user_room_prefix, room_prefix, room_id, partner_id, user_id, ttl)
+return {partner_id, partner_at, enqueued_at}
+"""
+
+# Pair the head of the open queue two by two, as many pairs as there are room ids.
+# Returns a flat list of user1, user2, room_id, user1 enqueue time, user2 enqueue time.
+MATCH_BATCH_SCRIPT = QUEUE_FUNCTIONS + ROOM_FUNCTIONS + """
+local user_room_prefix, room_prefix, cutoff, ttl = ARGV[3], ARGV[4], ARGV[5], ARGV[6]
+local room_ids = {unpack(ARGV, 7)}
+
+promote_expired(cutoff, #room_ids * 2)
+local pairs = math.min(math.floor(redis.call('zcard', KEYS[1]) / 2), #room_ids)
+if pairs == 0 then
+    return {}
+end
+
+local popped = redis.call('zpopmin', KEYS[1], pairs * 2)
+local matches = {}
+for i = 1, pairs do
+    local base = (i - 1) * 4
+    local user1_id, user2_id, room_id = popped[base + 1], popped[base + 3], room_ids[i]
+    dequeue(user1_id)
+    dequeue(user2_id)
+    create_room(user_room_prefix, room_prefix, room_id, user1_id, user2_id, ttl)
+    for _, value in ipairs({user1_id, user2_id, room_id, popped[base + 2], popped[base + 4]}) do
+        table.insert(matches, value)
+    end
+end
+return matches
+"""
+
+# First half of a cross-shard match, run on the shard being stolen from: the head of its open queue
+# is dequeued and pointed at a room on another shard, which the caller opens next.
+# Returns the partner and their enqueue time.
+STEAL_SCRIPT = QUEUE_FUNCTIONS + """
+local user_room_prefix, room_id, ttl, cutoff = ARGV[3], ARGV[4], ARGV[5], ARGV[6]
+promote_expired(cutoff, 100)
+local head = redis.call('zrange', KEYS[1], 0, 0, 'WITHSCORES')
+if not head[1] then
+    return false
+end
+dequeue(head[1])
+redis.call('set', user_room_prefix .. head[1], room_id, 'EX', ttl)
+return head
+"""
+
+# Second half, run on the room's shard: open the room for the stolen partner (ARGV[7]) and the local
+# member ARGV[8] if they are still waiting in the open queue, or its head when ARGV[8] is empty.
+# Returns the local member and their enqueue time, false when there was nobody to take.
+OPEN_ROOM_SCRIPT = QUEUE_FUNCTIONS + """
+local user_room_prefix, room_prefix, room_id, ttl, partner_id = ARGV[3], ARGV[4], ARGV[5], ARGV[6], ARGV[7]
+local member, enqueued_at = ARGV[8], false
+if member == '' then
+    local head = redis.call('zrange', KEYS[1], 0, 0, 'WITHSCORES')
+    member, enqueued_at = head[1], head[2]
+else
+    enqueued_at = redis.call('zscore', KEYS[1], member)
+end
+if not enqueued_at then
+    return false
+end
+dequeue(member)
+redis.call('hset', room_prefix .. room_id, 'user1', partner_id, 'user2', member)
+redis.call('expire', room_prefix .. room_id, ttl)
+redis.call('set', user_room_prefix .. member, room_id, 'EX', ttl)
+return {member, enqueued_at}
+"""
+
+# Undo a steal whose room could not be opened, the partner keeps its place in the open queue (KEYS[1])
+RELEASE_SCRIPT = """
+local user_room_key = ARGV[1] .. ARGV[2]
+if redis.call('get', user_room_key) == ARGV[4] then
+    redis.call('del', user_room_key)
+end
+redis.call('zadd', KEYS[1], ARGV[3], ARGV[2])
+return 0
+"""
+
+# Garbage collection over one page of user pointers (KEYS) of one shard. A pointer whose room is gone
+# or no longer lists the user is deleted; a live one written before rooms had a TTL gets one. Rooms on
+# another shard cannot be checked from here, pointers to them are left to their TTL.
+# Returns the bytes reclaimed followed by the user ids whose pointer was deleted.
+SWEEP_USER_ROOMS_SCRIPT = SHARD_FUNCTIONS + """
+local user_room_prefix, room_prefix, ttl = ARGV[1], ARGV[2], ARGV[3]
+local shard, shards = tonumber(ARGV[4]), tonumber(ARGV[5])
+local reclaimed, orphans = 0, {}
+for _, key in ipairs(KEYS) do
+    local room_id = redis.call('get', key)
+    if room_id then
+        local user_id = string.sub(key, #user_room_prefix + 1)
+        local orphaned = false
+        if shard_of(room_id, shards) == shard then
+            local members = redis.call('hmget', room_prefix .. room_id, 'user1', 'user2')
+            orphaned = members[1] ~= user_id and members[2] ~= user_id
+        end
+        if orphaned then
+            reclaimed = reclaimed + (redis.call('memory', 'usage', key) or 0)
+            redis.call('del', key)
+            table.insert(orphans, user_id)
+        elseif redis.call('ttl', key) == -1 then
+            redis.call('expire', key, ttl)
+        end
+    end
+end
+return {reclaimed, unpack(orphans)}
+"""
+
+# Same over one page of rooms (KEYS). Rooms that carry a TTL are left to expire; one without a TTL is
+# deleted when no member points at it any more, otherwise it gets one.
+# Returns the bytes reclaimed followed by the ids of the deleted rooms.
+SWEEP_ROOMS_SCRIPT = SHARD_FUNCTIONS + """
+local user_room_prefix, room_prefix, ttl = ARGV[1], ARGV[2], ARGV[3]
+local shard, shards = tonumber(ARGV[4]), tonumber(ARGV[5])
+local reclaimed, deleted = 0, {}
+for _, key in ipairs(KEYS) do
+    if redis.call('ttl', key) == -1 then
+        local room_id = string.sub(key, #room_prefix + 1)
+        local live = false
+        for _, member in ipairs(redis.call('hmget', key, 'user1', 'user2')) do
+            if member and (shard_of(member, shards) ~= shard or redis.call('get', user_room_prefix .. member) == room_id) then
+                live = true
+            end
+        end
+        if live then
+            redis.call('expire', key, ttl)
+        else
+            reclaimed = reclaimed + (redis.call('memory', 'usage', key) or 0)
+            redis.call('del', key)
+            table.insert(deleted, room_id)
+        end
+    end
+end
+return {reclaimed, unpack(deleted)}
+"""
+
+# Mark ARGV[1] ready in room KEYS[1]. Returns 1 once both members are ready, 0 while only this one
+# is, -1 if the user is not in the room. Concurrent calls see a consistent state, so exactly one
+# of two simultaneous initiators learns that both are ready.
+READY_FOR_VIDEO_SCRIPT = """
+local user_id = ARGV[1]
+local members = redis.call('hmget', KEYS[1], 'user1', 'user2')
+if members[1] == user_id then
+    redis.call('hset', KEYS[1], 'user1_ready_video', '1')
+elseif members[2] == user_id then
+    redis.call('hset', KEYS[1], 'user2_ready_video', '1')
+else
+    return -1
+end
+local ready = redis.call('hmget', KEYS[1], 'user1_ready_video', 'user2_ready_video')
+if ready[1] == '1' and ready[2] == '1' then
+    return 1
+end
+return 0
+"""
+
+# Close room KEYS[1] on behalf of ARGV[1] and return the partner. When both members leave at once only
+# the first call gets the partner back. Pointers on this shard are dropped here, as long as they still
+# point at this room; members whose pointer lives on another shard are returned for the caller.
+# Returns the partner id ('' if the room was already closed) followed by those members.
+LEAVE_ROOM_SCRIPT = SHARD_FUNCTIONS + """
+local user_id, room_id, user_room_prefix = ARGV[1], ARGV[2], ARGV[3]
+local shard, shards = tonumber(ARGV[4]), tonumber(ARGV[5])
+local remote = {}
+
+local function release(member)
+    if shard_of(member, shards) ~= shard then
+        table.insert(remote, member)
+    elseif redis.call('get', user_room_prefix .. member) == room_id then
+        redis.call('del', user_room_prefix .. member)
+    end
+end
+
+local members = redis.call('hmget', KEYS[1], 'user1', 'user2')
+local partner_id
+if members[1] == user_id then
+    partner_id = members[2]
+elseif members[2] == user_id then
+    partner_id = members[1]
+end
+
+release(user_id)
+if not partner_id then
+    return {'', unpack(remote)}
+end
+redis.call('del', KEYS[1])
+release(partner_id)
+return {partner_id, unpack(remote)}
+"""
+
+# Drop a room pointer (KEYS[1]) left on another shard than its room, unless it moved on to a new room
+CLEAR_POINTER_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+# Reclaim a key (KEYS[1]) of the layout used before keys were sharded. Returns the bytes reclaimed,
+# -1 when the key does not exist.
+RECLAIM_UNSHARDED_SCRIPT = """
+if redis.call('exists', KEYS[1]) == 0 then
+    return -1
+end
+local size = redis.call('memory', 'usage', KEYS[1]) or 0
+redis.call('del', KEYS[1])
+return size
+"""
+
+
+class MatchingBackend(ABC):
+    # Waiting pool and rooms. Every operation is atomic towards concurrent callers, whatever the backend.
+    time_to_match: Histogram
+
+    @abstractmethod
+    async def enqueue_and_match(
+            self,
+            user: ActiveUser,
+            tags: Optional[List[str]] = None,
+            match_open: bool = True
+    ) -> Optional[Tuple[UUID, UUID, UUID]]:
+        ...
+
+    @abstractmethod
+    async def match_batch(self, max_pairs: int) -> List[Tuple[UUID, UUID, UUID]]:
+        ...
+
+    async def remove_from_pool(self, user_id: UUID) -> None:
+        await self.remove_many_from_pool([user_id])
+
+    @abstractmethod
+    async def remove_many_from_pool(self, user_ids: List[UUID]) -> None:
+        ...
+
+    @abstractmethod
+    async def get_user_room_info(self, user_id: UUID) -> Optional[Tuple[UUID, UUID]]:
+        ...
+
+    @abstractmethod
+    async def refresh_rooms(self, memberships: List[Tuple[UUID, UUID]]) -> None:
+        ...
+
+    @abstractmethod
+    async def claim_sweep(self, node_id: str, interval: int) -> bool:
+        ...
+
+    @abstractmethod
+    async def sweep_orphans(self, scan_count: int = 500) -> Tuple[int, int, List[UUID]]:
+        ...
+
+    @abstractmethod
+    async def set_user_ready_for_video(self, room_id: UUID, user_id: UUID) -> Optional[bool]:
+        ...
+
+    @abstractmethod
+    async def leave_room(self, user_id: UUID, room_id: Optional[UUID] = None) -> Optional[UUID]:
+        ...
+
+    @abstractmethod
+    async def evict_users(self, user_ids: List[UUID]) -> List[UUID]:
+        ...
+
+    # A user's pending departure, shared by all nodes so only the latest one may close the room
+    @abstractmethod
+    async def mark_departed(self, user_id: UUID, token: str, ttl_ms: int) -> None:
+        ...
+
+    @abstractmethod
+    async def clear_departure(self, user_id: UUID) -> None:
+        ...
+
+    @abstractmethod
+    async def take_departure(self, user_id: UUID, token: str) -> bool:
+        # Consumes the departure if it is still the one marked with token
+        ...
+
+
+class MatchingService(MatchingBackend):
+    def __init__(
+            self,
+            redis_client: Redis,
+            tag_fallback_seconds: int = 10,
+            room_ttl_seconds: int = 600,
+            shards: int = 1
+    ):
         self.redis = redis_client
-        self.WAITING_POOL_KEY = "tanin:waiting_pool"
+        self.tag_fallback_ms = tag_fallback_seconds * 1000
+        self.room_ttl = room_ttl_seconds
+        self.shards = shards
+        # Every key below is per shard, with the shard number as hash tag, e.g. tanin:room:{3}:<room_id>
+        self.WAITING_POOL_KEY = "tanin:waiting_queue"
+        self.TAGGED_POOL_KEY = "tanin:waiting_queue:tagged"
+        self.TAG_BUCKET_KEY_PREFIX = "tanin:waiting_queue:tag:"
+        self.USER_TAGS_KEY_PREFIX = "tanin:user_tags:"
         self.USER_ROOM_KEY_PREFIX = "tanin:user_room:"
         self.ROOM_INFO_KEY_PREFIX = "tanin:room:"
+        self.SWEEP_LOCK_KEY = "tanin:room_sweeper:lock"
+        self.DEPARTURE_KEY_PREFIX = "tanin:departure:"
+        # Written by releases before the keyspace was sharded, see reclaim_unsharded_keys
+        self.UNSHARDED_POOL_KEY = "tanin:waiting_pool"
 
-    async def add_to_pool(self, user: ActiveUser) -> None:
-        await self.redis.sadd(self.WAITING_POOL_KEY, str(user.id))
+        self.dequeue_script = self.redis.register_script(DEQUEUE_SCRIPT)
+        self.enqueue_and_match_script = self.redis.register_script(ENQUEUE_AND_MATCH_SCRIPT)
+        self.match_batch_script = self.redis.register_script(MATCH_BATCH_SCRIPT)
+        self.steal_script = self.redis.register_script(STEAL_SCRIPT)
+        self.open_room_script = self.redis.register_script(OPEN_ROOM_SCRIPT)
+        self.release_script = self.redis.register_script(RELEASE_SCRIPT)
+        self.sweep_user_rooms_script = self.redis.register_script(SWEEP_USER_ROOMS_SCRIPT)
+        self.sweep_rooms_script = self.redis.register_script(SWEEP_ROOMS_SCRIPT)
+        self.reclaim_unsharded_script = self.redis.register_script(RECLAIM_UNSHARDED_SCRIPT)
+        self.ready_for_video_script = self.redis.register_script(READY_FOR_VIDEO_SCRIPT)
+        self.leave_room_script = self.redis.register_script(LEAVE_ROOM_SCRIPT)
+        self.clear_pointer_script = self.redis.register_script(CLEAR_POINTER_SCRIPT)
 
-    async def remove_from_pool(self, user_id: UUID) -> None:
-        await self.redis.srem(self.WAITING_POOL_KEY, str(user_id))
+        self.time_to_match = metrics.histogram("matching_time_to_match_seconds", "Time from enqueue to match")
+        self.steals = metrics.counter("matching_cross_shard_matches", "Matches with a partner from another shard")
+
+    def shard_of(self, id: UUID) -> int:
+        # A user's pool entry and room pointer live on their shard, a room on the shard it was opened on.
+        # Pairs matched within a shard therefore keep the room and both pointers in one cluster slot.
+        return (id.int & 0xFFFF) % self.shards
+
+    def shard_prefix(self, prefix: str, shard: int) -> str:
+        return f"{prefix}{{{shard}}}:"
+
+    def pool_keys(self, shard: int) -> List[str]:
+        return [f"{self.WAITING_POOL_KEY}:{{{shard}}}", f"{self.TAGGED_POOL_KEY}:{{{shard}}}"]
+
+    def _queue_prefixes(self, shard: int) -> List[str]:
+        return [self.shard_prefix(self.TAG_BUCKET_KEY_PREFIX, shard), self.shard_prefix(self.USER_TAGS_KEY_PREFIX, shard)]
+
+    def user_room_key(self, user_id: UUID) -> str:
+        return f"{self.shard_prefix(self.USER_ROOM_KEY_PREFIX, self.shard_of(user_id))}{user_id}"
+
+    def departure_key(self, user_id: UUID) -> str:
+        return f"{self.shard_prefix(self.DEPARTURE_KEY_PREFIX, self.shard_of(user_id))}{user_id}"
+
+    def room_key(self, room_id: UUID) -> str:
+        return f"{self.shard_prefix(self.ROOM_INFO_KEY_PREFIX, self.shard_of(room_id))}{room_id}"
+
+    def _room_id_on(self, shard: int) -> UUID:
+        # The room id decides where the room lives, so draw one that hashes to the matching shard
+        room_id = uuid.uuid4()
+        while self.shard_of(room_id) != shard:
+            room_id = uuid.uuid4()
+        return room_id
+
+    async def _run_scripts(self, calls: list) -> list:
+        # A cluster pipeline cannot carry scripts, there the calls run concurrently instead
+        if isinstance(self.redis, RedisCluster):
+            return await asyncio.gather(*(script(keys=keys, args=args) for script, keys, args in calls))
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for script, keys, args in calls:
+                await script(keys=keys, args=args, client=pipe)
+            return await pipe.execute()
+
+    async def remove_many_from_pool(self, user_ids: List[UUID]) -> None:
+        by_shard = defaultdict(list)
+        for user_id in user_ids:
+            by_shard[self.shard_of(user_id)].append(str(user_id))
+        if by_shard:
+            await self._run_scripts([
+                (self.dequeue_script, self.pool_keys(shard), [*self._queue_prefixes(shard), *members])
+                for shard, members in by_shard.items()
+            ])
 
-    async def find_and_create_match(self) -> Optional[Tuple[UUID, UUID, UUID]]:
-        if await self.redis.scard(self.WAITING_POOL_KEY) < 2:
+    def _observe_wait(self, now_ms: int, enqueued_at) -> None:
+        self.time_to_match.observe(max(0.0, now_ms - float(enqueued_at)) / 1000)
+
+    async def enqueue_and_match(
+            self,
+            user: ActiveUser,
+            tags: Optional[List[str]] = None,
+            match_open: bool = True
+    ) -> Optional[Tuple[UUID, UUID, UUID]]:
+        shard = self.shard_of(user.id)
+        # The room id is generated here since Lua has no UUIDs; it is simply unused when nobody is waiting
+        room_id = self._room_id_on(shard)
+        now_ms = int(time.time() * 1000)
+        result = await self.enqueue_and_match_script(
+            keys=self.pool_keys(shard),
+            args=[
+                *self._queue_prefixes(shard),
+                str(user.id),
+                str(room_id),
+                self.shard_prefix(self.USER_ROOM_KEY_PREFIX, shard),
+                self.shard_prefix(self.ROOM_INFO_KEY_PREFIX, shard),
+                int(match_open),
+                now_ms,
+                self.tag_fallback_ms,
+                self.room_ttl,
+                *(tags or [])
+            ]
+        )
+        if not result:
+            # Only untagged searchers look beyond their own shard, tag buckets are not shared between shards
+            if match_open and not tags and self.shards > 1:
+                return await self._steal_partner(user.id, room_id)
             return None
 
-        user1_id, user2_id = await self.redis.spop(self.WAITING_POOL_KEY, 2)
-        if not user1_id or not user2_id:
+        partner_id, partner_enqueued_at, enqueued_at = result
+        self._observe_wait(now_ms, partner_enqueued_at)
+        self._observe_wait(now_ms, enqueued_at)
+        return UUID(partner_id), user.id, room_id
+
+    async def _steal_partner(self, user_id: UUID, room_id: UUID) -> Optional[Tuple[UUID, UUID, UUID]]:
+        # The searcher waits alone on its shard: take the longest waiter of the fullest other shard. The
+        # searcher stays visible meanwhile, so when someone matched them first the partner is put back.
+        shard = self.shard_of(user_id)
+        others = [other for other in range(self.shards) if other != shard]
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for other in others:
+                pipe.zcard(self.pool_keys(other)[0])
+            sizes = await pipe.execute()
+
+        size, other = max(zip(sizes, others))
+        if not size:
+            return None
+        # One attempt only: when that waiter is gone already the pool is busy enough to match the searcher
+        stolen = await self._steal(other, room_id, int(time.time() * 1000) - self.tag_fallback_ms)
+        if not stolen:
             return None
 
-        room_id = str(uuid.uuid4())
-        room_key = f"{self.ROOM_INFO_KEY_PREFIX}{room_id}"
+        partner_id, partner_enqueued_at = stolen
+        opened = await self._open_room(shard, room_id, partner_id, str(user_id))
+        if not opened:
+            await self._release(other, partner_id, partner_enqueued_at, room_id)
+            return None
 
-        async with self.redis.pipeline(transaction=True) as pipe:
-            pipe.hset(room_key, mapping={"user1": user1_id, "user2": user2_id})
-            pipe.set(f"{self.USER_ROOM_KEY_PREFIX}{user1_id}", room_id)
-            pipe.set(f"{self.USER_ROOM_KEY_PREFIX}{user2_id}", room_id)
-            await pipe.execute()
+        _, enqueued_at = opened
+        now_ms = int(time.time() * 1000)
+        self.steals.inc()
+        self._observe_wait(now_ms, partner_enqueued_at)
+        self._observe_wait(now_ms, enqueued_at)
+        return UUID(partner_id), user_id, room_id
+
+    def _steal(self, shard: int, room_id: UUID, cutoff: int):
+        return self.steal_script(
+            keys=self.pool_keys(shard),
+            args=[
+                *self._queue_prefixes(shard),
+                self.shard_prefix(self.USER_ROOM_KEY_PREFIX, shard),
+                str(room_id),
+                self.room_ttl,
+                cutoff
+            ]
+        )
+
+    def _open_room(self, shard: int, room_id: UUID, partner_id: str, member: str = ""):
+        return self.open_room_script(
+            keys=self.pool_keys(shard),
+            args=[
+                *self._queue_prefixes(shard),
+                self.shard_prefix(self.USER_ROOM_KEY_PREFIX, shard),
+                self.shard_prefix(self.ROOM_INFO_KEY_PREFIX, shard),
+                str(room_id),
+                self.room_ttl,
+                partner_id,
+                member
+            ]
+        )
 
-        return UUID(user1_id), UUID(user2_id), UUID(room_id)
+    def _release(self, shard: int, partner_id: str, enqueued_at, room_id: UUID):
+        return self.release_script(
+            keys=self.pool_keys(shard)[:1],
+            args=[self.shard_prefix(self.USER_ROOM_KEY_PREFIX, shard), partner_id, enqueued_at, str(room_id)]
+        )
+
+    async def _match_across(self, shard: int, other: int, cutoff: int) -> Optional[Tuple[UUID, UUID, UUID]]:
+        room_id = self._room_id_on(shard)
+        stolen = await self._steal(other, room_id, cutoff)
+        if not stolen:
+            return None
+
+        partner_id, partner_enqueued_at = stolen
+        opened = await self._open_room(shard, room_id, partner_id)
+        if not opened:
+            await self._release(other, partner_id, partner_enqueued_at, room_id)
+            return None
+
+        member_id, member_enqueued_at = opened
+        now_ms = int(time.time() * 1000)
+        self.steals.inc()
+        self._observe_wait(now_ms, member_enqueued_at)
+        self._observe_wait(now_ms, partner_enqueued_at)
+        return UUID(member_id), UUID(partner_id), room_id
+
+    async def match_batch(self, max_pairs: int) -> List[Tuple[UUID, UUID, UUID]]:
+        # Size the batch first so a quiet tick does not ship a thousand unused room ids; the script
+        # re-checks the pool size in case users left in between
+        cutoff = int(time.time() * 1000) - self.tag_fallback_ms
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for shard in range(self.shards):
+                open_key, tagged_key = self.pool_keys(shard)
+                pipe.zcard(open_key)
+                pipe.zcount(tagged_key, "-inf", cutoff)
+            counts = await pipe.execute()
+        waiting = [counts[2 * shard] + counts[2 * shard + 1] for shard in range(self.shards)]
+
+        calls, budget = [], max_pairs
+        for shard, users in enumerate(waiting):
+            pairs = min(users // 2, budget)
+            if pairs > 0:
+                budget -= pairs
+                room_ids = [str(self._room_id_on(shard)) for _ in range(pairs)]
+                calls.append((self.match_batch_script, self.pool_keys(shard), [
+                    *self._queue_prefixes(shard),
+                    self.shard_prefix(self.USER_ROOM_KEY_PREFIX, shard),
+                    self.shard_prefix(self.ROOM_INFO_KEY_PREFIX, shard),
+                    cutoff,
+                    self.room_ttl,
+                    *room_ids
+                ]))
+        results = await self._run_scripts(calls) if calls else []
+
+        now_ms = int(time.time() * 1000)
+        matches = []
+        for result in results:
+            for i in range(0, len(result), 5):
+                user1_id, user2_id, room_id, user1_enqueued_at, user2_enqueued_at = result[i:i + 5]
+                self._observe_wait(now_ms, user1_enqueued_at)
+                self._observe_wait(now_ms, user2_enqueued_at)
+                matches.append((UUID(user1_id), UUID(user2_id), UUID(room_id)))
+
+        # Shards left with a single waiter are paired with each other
+        leftovers = [shard for shard, users in enumerate(waiting) if users % 2]
+        for shard, other in zip(leftovers[::2], leftovers[1::2]):
+            if len(matches) >= max_pairs:
+                break
+            match = await self._match_across(shard, other, cutoff)
+            if match:
+                matches.append(match)
+        return matches
 
     async def get_user_room_info(self, user_id: UUID) -> Optional[Tuple[UUID, UUID]]:
-        room_id = await self.redis.get(f"{self.USER_ROOM_KEY_PREFIX}{str(user_id)}")
+        room_id = await self.redis.get(self.user_room_key(user_id))
 
         if not room_id:
             return None
 
         room_id = UUID(room_id)
-        room_key = f"{self.ROOM_INFO_KEY_PREFIX}{room_id}"
-
-        user1_id, user2_id = await self.redis.hmget(room_key, ["user1", "user2"])
+        user1_id, user2_id = await self.redis.hmget(self.room_key(room_id), ["user1", "user2"])
         if not user1_id or not user2_id:
             return None
 
         partner_id = user2_id if str(user_id) == user1_id else user1_id
         return room_id, UUID(partner_id)
 
-    async def set_user_ready_for_video(self, room_id: UUID, user_id: UUID):
-        room_key = f"{self.ROOM_INFO_KEY_PREFIX}{room_id}"
-        room_data = await self.redis.hgetall(room_key)
-
-        if not room_data:
+    async def refresh_rooms(self, memberships: List[Tuple[UUID, UUID]]) -> None:
+        # Slides the TTL of (room_id, user_id) pairs; each member refreshes the room and its own pointer
+        if not memberships:
             return
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for room_id, user_id in memberships:
+                pipe.expire(self.room_key(room_id), self.room_ttl)
+                pipe.expire(self.user_room_key(user_id), self.room_ttl)
+            await pipe.execute()
+
+    async def claim_sweep(self, node_id: str, interval: int) -> bool:
+        # Any node may sweep, the lock only keeps them from scanning the keyspace all at once
+        return bool(await self.redis.set(self.SWEEP_LOCK_KEY, node_id, nx=True, ex=interval))
 
-        user_field = "user1_ready_video" if room_data.get("user1") == str(user_id) else "user2_ready_video"
-        await self.redis.hset(room_key, user_field, "1")
+    async def _sweep(self, prefix: str, script, scan_count: int) -> Tuple[int, List[str]]:
+        # Keys are swept a page at a time, grouped by shard so each script call stays within one slot
+        reclaimed_bytes, reclaimed_ids = 0, []
+        pages = defaultdict(list)
 
-    async def check_if_both_ready_for_video(self, room_id: UUID) -> bool:
-        room_key = f"{self.ROOM_INFO_KEY_PREFIX}{room_id}"
-        ready_states = await self.redis.hmget(room_key, ["user1_ready_video", "user2_ready_video"])
+        async def sweep_page(shard: int, keys: List[str]):
+            nonlocal reclaimed_bytes
+            reclaimed, *ids = await script(keys=keys, args=[
+                self.shard_prefix(self.USER_ROOM_KEY_PREFIX, shard),
+                self.shard_prefix(self.ROOM_INFO_KEY_PREFIX, shard),
+                self.room_ttl,
+                shard,
+                self.shards
+            ])
+            reclaimed_bytes += reclaimed
+            reclaimed_ids.extend(ids)
 
-        return all(state == "1" for state in ready_states if state is not None)
+        async for key in self.redis.scan_iter(match=f"{prefix}{{*", count=scan_count):
+            shard = int(key[len(prefix) + 1:key.index("}")])
+            pages[shard].append(key)
+            if len(pages[shard]) >= scan_count:
+                await sweep_page(shard, pages.pop(shard))
+        for shard, keys in pages.items():
+            await sweep_page(shard, keys)
+        return reclaimed_bytes, reclaimed_ids
 
-    async def leave_room(self, user_id: UUID) -> Optional[UUID]:
-        room_info = await self.get_user_room_info(user_id)
+    async def sweep_orphans(self, scan_count: int = 500) -> Tuple[int, int, List[UUID]]:
+        # Incremental: SCAN pages feed one script call each, so Redis is never blocked on a full keyspace
+        # pass. Returns keys deleted, bytes reclaimed and the users whose room pointer was orphaned.
+        pointer_bytes, orphans = await self._sweep(self.USER_ROOM_KEY_PREFIX, self.sweep_user_rooms_script, scan_count)
+        room_bytes, rooms = await self._sweep(self.ROOM_INFO_KEY_PREFIX, self.sweep_rooms_script, scan_count)
+        return len(orphans) + len(rooms), pointer_bytes + room_bytes, [UUID(user_id) for user_id in orphans]
 
-        if not room_info:
+    async def reclaim_unsharded_keys(self, scan_count: int = 500) -> Tuple[int, int, List[UUID]]:
+        # One-off cleanup after every node runs the sharded layout: the pool, rooms and pointers written
+        # before it are unreachable by then. Never part of the periodic sweep, nodes still on the old
+        # release keep using these keys during a rolling deploy. Returns keys deleted, bytes reclaimed
+        # and the users whose room pointer was deleted.
+        deleted, reclaimed_bytes, users = 0, 0, []
+
+        async def reclaim_page(keys: List[str]):
+            nonlocal deleted, reclaimed_bytes
+            sizes = await self._run_scripts([(self.reclaim_unsharded_script, [key], []) for key in keys])
+            for key, size in zip(keys, sizes):
+                if size < 0:
+                    continue
+                deleted += 1
+                reclaimed_bytes += size
+                if key.startswith(self.USER_ROOM_KEY_PREFIX):
+                    users.append(UUID(key[len(self.USER_ROOM_KEY_PREFIX):]))
+
+        await reclaim_page([self.UNSHARDED_POOL_KEY])
+        for prefix in (self.USER_ROOM_KEY_PREFIX, self.ROOM_INFO_KEY_PREFIX):
+            page = []
+            async for key in self.redis.scan_iter(match=f"{prefix}*", count=scan_count):
+                if key[len(prefix):].startswith("{"):
+                    continue
+                page.append(key)
+                if len(page) >= scan_count:
+                    await reclaim_page(page)
+                    page = []
+            if page:
+                await reclaim_page(page)
+        return deleted, reclaimed_bytes, users
+
+    async def set_user_ready_for_video(self, room_id: UUID, user_id: UUID) -> Optional[bool]:
+        # Returns whether both members are now ready, None if the user is not in the room
+        both_ready = await self.ready_for_video_script(keys=[self.room_key(room_id)], args=[str(user_id)])
+        if both_ready < 0:
             return None
+        return both_ready == 1
 
-        room_id, partner_id = room_info
+    def _leave_args(self, user_id: UUID, room_id: UUID) -> list:
+        shard = self.shard_of(room_id)
+        return [str(user_id), str(room_id), self.shard_prefix(self.USER_ROOM_KEY_PREFIX, shard), shard, self.shards]
 
-        async with self.redis.pipeline(transaction=True) as pipe:
-            pipe.delete(f"{self.ROOM_INFO_KEY_PREFIX}{room_id}")
-            pipe.delete(f"{self.USER_ROOM_KEY_PREFIX}{user_id}")
-            pipe.delete(f"{self.USER_ROOM_KEY_PREFIX}{partner_id}")
-            await pipe.execute()
+    async def _clear_pointers(self, pointers: List[Tuple[UUID, UUID]]) -> None:
+        # (user_id, room_id) pointers on other shards than their room, dropped if still pointing at it
+        if pointers:
+            await self._run_scripts([
+                (self.clear_pointer_script, [self.user_room_key(user_id)], [str(room_id)])
+                for user_id, room_id in pointers
+            ])
+
+    async def leave_room(self, user_id: UUID, room_id: Optional[UUID] = None) -> Optional[UUID]:
+        # Callers holding the room id from the connection's cache skip the pointer lookup
+        if room_id is None:
+            room_id = await self.redis.get(self.user_room_key(user_id))
+            if not room_id:
+                return None
+            room_id = UUID(room_id)
+
+        partner_id, *remote = await self.leave_room_script(
+            keys=[self.room_key(room_id)], args=self._leave_args(user_id, room_id)
+        )
+        await self._clear_pointers([(UUID(member), room_id) for member in remote])
+        return UUID(partner_id) if partner_id else None
+
+    async def evict_users(self, user_ids: List[UUID]) -> List[UUID]:
+        # Bulk leave_room for users that are gone for good, returns the partners left behind
+        if not user_ids:
+            return []
+        evicted = {str(user_id) for user_id in user_ids}
+
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for user_id in user_ids:
+                pipe.get(self.user_room_key(user_id))
+            room_ids = await pipe.execute()
+        rooms = [(user_id, UUID(room_id)) for user_id, room_id in zip(user_ids, room_ids) if room_id]
+        if not rooms:
+            return []
+
+        results = await self._run_scripts([
+            (self.leave_room_script, [self.room_key(room_id)], self._leave_args(user_id, room_id))
+            for user_id, room_id in rooms
+        ])
+        await self._clear_pointers([
+            (UUID(member), room_id) for (_, room_id), (_, *remote) in zip(rooms, results) for member in remote
+        ])
+        return [UUID(partner_id) for partner_id in {result[0] for result in results} if partner_id and partner_id not in evicted]
+
+    async def mark_departed(self, user_id: UUID, token: str, ttl_ms: int) -> None:
+        await self.redis.set(self.departure_key(user_id), token, px=ttl_ms)
+
+    async def clear_departure(self, user_id: UUID) -> None:
+        await self.redis.delete(self.departure_key(user_id))
 
-        return partner_id
+    async def take_departure(self, user_id: UUID, token: str) -> bool:
+        return bool(await self.clear_pointer_script(keys=[self.departure_key(user_id)], args=[token]))
 
 # class MatchService:
 #     def match(self, user_a: UUID, user_b: UUID):
@@ -0,0 +1,316 @@
+import heapq
+import time
+import uuid
+from typing import Dict, List, Optional, Set, Tuple
+from uuid import UUID
+
+from fastapi import WebSocket
+
+from tanin.schemas.chat_schema import ServerEvent
+from tanin.schemas.user_schema import ActiveUser
+from tanin.utils.metrics import metrics
+from tanin.websocket.connection_manager import BaseConnectionManager, Connection
+from tanin.websocket.matching_service import MatchingBackend
+from tanin.websocket.protocol import MSGPACK_SUBPROTOCOL
+
+
+class SortedPool:
+    # The sorted sets of the Redis backend: members ordered by enqueue time (ms), ties by id.
+    # A heap with lazy deletion, removed members are skipped once they reach the top.
+    def __init__(self):
+        self.scores: Dict[UUID, int] = {}
+        self.heap: List[Tuple[int, UUID]] = []
+
+    def __len__(self) -> int:
+        return len(self.scores)
+
+    def __contains__(self, member: UUID) -> bool:
+        return member in self.scores
+
+    def score(self, member: UUID) -> Optional[int]:
+        return self.scores.get(member)
+
+    def add(self, member: UUID, score: int):
+        if self.scores.get(member) == score:
+            return
+        self.scores[member] = score
+        heapq.heappush(self.heap, (score, member))
+
+    def remove(self, member: UUID):
+        if self.scores.pop(member, None) is not None and len(self.heap) > 2 * len(self.scores) + 64:
+            # Mostly stale entries, rebuild rather than let the heap grow with every departure
+            self.heap = [(score, member) for member, score in self.scores.items()]
+            heapq.heapify(self.heap)
+
+    def head(self) -> Optional[Tuple[UUID, int]]:
+        while self.heap:
+            score, member = self.heap[0]
+            if self.scores.get(member) == score:
+                return member, score
+            heapq.heappop(self.heap)
+        return None
+
+    def pop(self) -> Optional[Tuple[UUID, int]]:
+        head = self.head()
+        if head:
+            heapq.heappop(self.heap)
+            del self.scores[head[0]]
+        return head
+
+
+class Room:
+    __slots__ = ("user1", "user2", "ready", "expires_at")
+
+    def __init__(self, user1: UUID, user2: UUID, expires_at: float):
+        self.user1 = user1
+        self.user2 = user2
+        self.ready: Set[UUID] = set()
+        self.expires_at = expires_at
+
+    def partner_of(self, user_id: UUID) -> Optional[UUID]:
+        if user_id == self.user1:
+            return self.user2
+        if user_id == self.user2:
+            return self.user1
+        return None
+
+
+class InMemoryMatchingService(MatchingBackend):
+    # Same semantics as MatchingService for a single process: no coroutine below awaits, so each call
+    # runs to completion on the event loop just like a Lua script does on Redis
+    def __init__(self, tag_fallback_seconds: int = 10, room_ttl_seconds: int = 600):
+        self.tag_fallback_ms = tag_fallback_seconds * 1000
+        self.room_ttl = room_ttl_seconds
+        self.open_pool = SortedPool()
+        self.tagged_pool = SortedPool()
+        self.tag_buckets: Dict[str, SortedPool] = {}
+        self.user_tags: Dict[UUID, List[str]] = {}
+        # Rooms and user pointers expire like their Redis keys, checked lazily on access
+        self.rooms: Dict[UUID, Room] = {}
+        self.user_rooms: Dict[UUID, Tuple[UUID, float]] = {}
+        # Pending departures by token; one process runs every timer, so they need no expiry
+        self.departures: Dict[UUID, str] = {}
+
+        self.time_to_match = metrics.histogram("matching_time_to_match_seconds", "Time from enqueue to match")
+
+    def _dequeue(self, user_id: UUID):
+        self.open_pool.remove(user_id)
+        self.tagged_pool.remove(user_id)
+        for tag in self.user_tags.pop(user_id, ()):
+            bucket = self.tag_buckets[tag]
+            bucket.remove(user_id)
+            if not bucket:
+                del self.tag_buckets[tag]
+
+    def _promote_expired(self, cutoff: int, limit: int):
+        # Tagged users past their fallback join the open queue, keeping their place by enqueue time
+        for _ in range(limit):
+            head = self.tagged_pool.head()
+            if not head or head[1] > cutoff:
+                return
+            self.tagged_pool.pop()
+            self.open_pool.add(*head)
+
+    def _room(self, room_id: UUID) -> Optional[Room]:
+        room = self.rooms.get(room_id)
+        if room and room.expires_at <= time.monotonic():
+            del self.rooms[room_id]
+            return None
+        return room
+
+    def _pointer(self, user_id: UUID) -> Optional[UUID]:
+        pointer = self.user_rooms.get(user_id)
+        if not pointer:
+            return None
+        if pointer[1] <= time.monotonic():
+            del self.user_rooms[user_id]
+            return None
+        return pointer[0]
+
+    def _create_room(self, user1_id: UUID, user2_id: UUID) -> UUID:
+        room_id = uuid.uuid4()
+        expires_at = time.monotonic() + self.room_ttl
+        self.rooms[room_id] = Room(user1_id, user2_id, expires_at)
+        self.user_rooms[user1_id] = (room_id, expires_at)
+        self.user_rooms[user2_id] = (room_id, expires_at)
+        return room_id
+
+    def _observe_wait(self, now_ms: int, enqueued_at: int) -> None:
+        self.time_to_match.observe(max(0.0, now_ms - enqueued_at) / 1000)
+
+    async def enqueue_and_match(
+            self,
+            user: ActiveUser,
+            tags: Optional[List[str]] = None,
+            match_open: bool = True
+    ) -> Optional[Tuple[UUID, UUID, UUID]]:
+        if self._pointer(user.id):
+            return None
+
+        now_ms = int(time.time() * 1000)
+        self._promote_expired(now_ms - self.tag_fallback_ms, 100)
+        enqueued_at = self.open_pool.score(user.id)
+        if enqueued_at is None:
+            enqueued_at = self.tagged_pool.score(user.id)
+        if enqueued_at is None:
+            enqueued_at = now_ms
+        self._dequeue(user.id)
+
+        # The longest-waiting partner across the searcher's buckets, then the head of the open queue
+        head = None
+        for tag in tags or ():
+            bucket_head = self.tag_buckets[tag].head() if tag in self.tag_buckets else None
+            if bucket_head and (not head or bucket_head[1] < head[1]):
+                head = bucket_head
+        if not head and match_open and (not tags or now_ms - enqueued_at >= self.tag_fallback_ms):
+            head = self.open_pool.head()
+
+        if not head:
+            if not tags:
+                self.open_pool.add(user.id, enqueued_at)
+            else:
+                self.tagged_pool.add(user.id, enqueued_at)
+                self.user_tags[user.id] = list(dict.fromkeys(tags))
+                for tag in self.user_tags[user.id]:
+                    self.tag_buckets.setdefault(tag, SortedPool()).add(user.id, enqueued_at)
+            return None
+
+        partner_id, partner_enqueued_at = head
+        self._dequeue(partner_id)
+        room_id = self._create_room(partner_id, user.id)
+        self._observe_wait(now_ms, partner_enqueued_at)
+        self._observe_wait(now_ms, enqueued_at)
+        return partner_id, user.id, room_id
+
+    async def match_batch(self, max_pairs: int) -> List[Tuple[UUID, UUID, UUID]]:
+        now_ms = int(time.time() * 1000)
+        self._promote_expired(now_ms - self.tag_fallback_ms, max_pairs * 2)
+        matches = []
+        for _ in range(min(len(self.open_pool) // 2, max_pairs)):
+            (user1_id, user1_enqueued_at), (user2_id, user2_enqueued_at) = self.open_pool.pop(), self.open_pool.pop()
+            self._dequeue(user1_id)
+            self._dequeue(user2_id)
+            self._observe_wait(now_ms, user1_enqueued_at)
+            self._observe_wait(now_ms, user2_enqueued_at)
+            matches.append((user1_id, user2_id, self._create_room(user1_id, user2_id)))
+        return matches
+
+    async def remove_many_from_pool(self, user_ids: List[UUID]) -> None:
+        for user_id in user_ids:
+            self._dequeue(user_id)
+
+    async def get_user_room_info(self, user_id: UUID) -> Optional[Tuple[UUID, UUID]]:
+        room_id = self._pointer(user_id)
+        room = self._room(room_id) if room_id else None
+        if not room:
+            return None
+        return room_id, room.partner_of(user_id)
+
+    async def refresh_rooms(self, memberships: List[Tuple[UUID, UUID]]) -> None:
+        expires_at = time.monotonic() + self.room_ttl
+        for room_id, user_id in memberships:
+            room = self._room(room_id)
+            if room:
+                room.expires_at = expires_at
+            pointer = self._pointer(user_id)
+            if pointer:
+                self.user_rooms[user_id] = (pointer, expires_at)
+
+    async def claim_sweep(self, node_id: str, interval: int) -> bool:
+        # Nobody else holds this state
+        return True
+
+    async def mark_departed(self, user_id: UUID, token: str, ttl_ms: int) -> None:
+        self.departures[user_id] = token
+
+    async def clear_departure(self, user_id: UUID) -> None:
+        self.departures.pop(user_id, None)
+
+    async def take_departure(self, user_id: UUID, token: str) -> bool:
+        if self.departures.get(user_id) != token:
+            return False
+        del self.departures[user_id]
+        return True
+
+    async def sweep_orphans(self, scan_count: int = 500) -> Tuple[int, int, List[UUID]]:
+        # Expired entries go silently, as their keys would on Redis; a live pointer whose room is gone
+        # or no longer lists the user is an orphan. Python has no cheap per-entry size, so no bytes.
+        now = time.monotonic()
+        for room_id in [room_id for room_id, room in self.rooms.items() if room.expires_at <= now]:
+            del self.rooms[room_id]
+        orphans = []
+        for user_id, (room_id, expires_at) in list(self.user_rooms.items()):
+            room = self.rooms.get(room_id)
+            if expires_at <= now or not room or room.partner_of(user_id) is None:
+                del self.user_rooms[user_id]
+                if expires_at > now:
+                    orphans.append(user_id)
+        return len(orphans), 0, orphans
+
+    async def set_user_ready_for_video(self, room_id: UUID, user_id: UUID) -> Optional[bool]:
+        room = self._room(room_id)
+        if not room or room.partner_of(user_id) is None:
+            return None
+        room.ready.add(user_id)
+        return len(room.ready) == 2
+
+    def _release(self, user_id: UUID, room_id: UUID):
+        if self._pointer(user_id) == room_id:
+            del self.user_rooms[user_id]
+
+    async def leave_room(self, user_id: UUID, room_id: Optional[UUID] = None) -> Optional[UUID]:
+        if room_id is None:
+            room_id = self._pointer(user_id)
+            if not room_id:
+                return None
+
+        room = self._room(room_id)
+        partner_id = room.partner_of(user_id) if room else None
+        self._release(user_id, room_id)
+        if not partner_id:
+            return None
+        del self.rooms[room_id]
+        self._release(partner_id, room_id)
+        return partner_id
+
+    async def evict_users(self, user_ids: List[UUID]) -> List[UUID]:
+        evicted = set(user_ids)
+        partners = {await self.leave_room(user_id) for user_id in user_ids}
+        return [partner_id for partner_id in partners if partner_id and partner_id not in evicted]
+
+
+class InMemoryConnectionManager(BaseConnectionManager):
+    # Every socket lives in this process, so delivery is a queue put and there is nothing to listen to
+    def __init__(self, node_id: str = "local", outbound_queue_size: int = 256, overflow_policy: str = "drop_oldest"):
+        super().__init__(node_id, outbound_queue_size=outbound_queue_size, overflow_policy=overflow_policy)
+        self.local_deliveries = metrics.counter("ws_local_deliveries", "Events delivered without Redis")
+
+    async def connect(
+            self,
+            websocket: WebSocket,
+            user_id: UUID,
+            last_event_id: Optional[str] = None,
+            subprotocol: Optional[str] = None
+    ) -> Connection:
+        await websocket.accept(subprotocol=subprotocol)
+        return self._register(websocket, user_id, binary=subprotocol == MSGPACK_SUBPROTOCOL)
+
+    async def disconnect(self, user_id: UUID):
+        connection = self.active_connections.pop(user_id, None)
+        if connection:
+            self._stop_writer(connection)
+
+    async def is_connected(self, user_id: UUID) -> bool:
+        return user_id in self.active_connections
+
+    async def broadcast_event_to_user(self, event: ServerEvent, user_id: UUID):
+        # Recipients that are not connected miss the event, as they would on pub/sub
+        self.local_deliveries.inc()
+        await self.send_personal_event(event, user_id)
+
+    async def broadcast_events(self, events: List[Tuple[ServerEvent, UUID]], batch_size: int = 500):
+        for event, user_id in events:
+            await self.broadcast_event_to_user(event, user_id)
+
+    async def listen(self):
+        return
@@ -0,0 +1,127 @@
+from typing import List
+from uuid import UUID
+
+from redis.asyncio import Redis
+
+
+# Only clear the pointer if the user has not reconnected to another node in the meantime.
+# One key per call, so releases and crash cleanup stay within a single slot on a cluster.
+CLEAR_POINTER_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+def _text(value) -> str:
+    return value.decode() if isinstance(value, bytes) else value
+
+
+class PresenceRegistry:
+    def __init__(self, redis_client: Redis, node_id: str, node_timeout: int = 20, user_ttl: int = 600):
+        self.redis = redis_client
+        self.node_id = node_id
+        self.node_timeout = node_timeout
+        # Pointers expire unless the owning node refreshes them, so none outlives a cleanup that never ran
+        self.user_ttl = user_ttl
+        self.USER_NODE_KEY_PREFIX = "tanin:user_node:"
+        self.NODE_USERS_KEY_PREFIX = "tanin:node_users:"
+        self.NODE_ALIVE_KEY_PREFIX = "tanin:node_alive:"
+        self.REAPER_LOCK_KEY_PREFIX = "tanin:reaper_lock:"
+        self.NODES_KEY = "tanin:nodes"
+
+        self.clear_pointer_script = self.redis.register_script(CLEAR_POINTER_SCRIPT)
+
+    def user_node_key(self, user_id: UUID) -> str:
+        return f"{self.USER_NODE_KEY_PREFIX}{user_id}"
+
+    def node_users_key(self, node_id: str) -> str:
+        return f"{self.NODE_USERS_KEY_PREFIX}{node_id}"
+
+    async def register_user(self, user_id: UUID):
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.set(self.user_node_key(user_id), self.node_id, ex=self.user_ttl)
+            pipe.sadd(self.node_users_key(self.node_id), str(user_id))
+            await pipe.execute()
+
+    async def unregister_user(self, user_id: UUID):
+        async with self.redis.pipeline(transaction=False) as pipe:
+            await self.clear_pointer_script(keys=[self.user_node_key(user_id)], args=[self.node_id], client=pipe)
+            pipe.srem(self.node_users_key(self.node_id), str(user_id))
+            await pipe.execute()
+
+    async def refresh_users(self, user_ids: List[UUID], batch_size: int = 500):
+        # A pointer another node took over in the meantime only gets a longer life, never a new owner
+        for start in range(0, len(user_ids), batch_size):
+            async with self.redis.pipeline(transaction=False) as pipe:
+                for user_id in user_ids[start:start + batch_size]:
+                    pipe.expire(self.user_node_key(user_id), self.user_ttl)
+                await pipe.execute()
+
+    async def is_online(self, user_id: UUID) -> bool:
+        return bool(await self.redis.exists(self.user_node_key(user_id)))
+
+    async def heartbeat(self):
+        # The alive key expires by itself when the process stops beating
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.set(f"{self.NODE_ALIVE_KEY_PREFIX}{self.node_id}", 1, ex=self.node_timeout)
+            pipe.sadd(self.NODES_KEY, self.node_id)
+            await pipe.execute()
+
+    async def leave(self):
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.delete(f"{self.NODE_ALIVE_KEY_PREFIX}{self.node_id}")
+            pipe.srem(self.NODES_KEY, self.node_id)
+            await pipe.execute()
+
+    async def find_dead_nodes(self) -> List[str]:
+        nodes = [_text(node) for node in await self.redis.smembers(self.NODES_KEY)]
+        if not nodes:
+            return []
+
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for node in nodes:
+                pipe.exists(f"{self.NODE_ALIVE_KEY_PREFIX}{node}")
+            alive = await pipe.execute()
+        return [node for node, is_alive in zip(nodes, alive) if not is_alive]
+
+    async def claim_dead_node(self, node_id: str) -> bool:
+        # Several reapers may notice the same dead node, only one cleans it up
+        return bool(await self.redis.set(
+            f"{self.REAPER_LOCK_KEY_PREFIX}{node_id}", self.node_id, nx=True, ex=self.node_timeout
+        ))
+
+    async def collect_orphans(self, node_id: str, batch_size: int = 500) -> List[UUID]:
+        orphans = []
+        batch = []
+        async for member in self.redis.sscan_iter(self.node_users_key(node_id), count=batch_size):
+            batch.append(UUID(_text(member)))
+            if len(batch) >= batch_size:
+                orphans += await self._orphans_among(node_id, batch)
+                batch = []
+        if batch:
+            orphans += await self._orphans_among(node_id, batch)
+        return orphans
+
+    async def _orphans_among(self, node_id: str, user_ids: List[UUID]) -> List[UUID]:
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for user_id in user_ids:
+                pipe.get(self.user_node_key(user_id))
+            owners = await pipe.execute()
+
+        # Users who already reconnected somewhere else are not orphans
+        return [user_id for user_id, owner in zip(user_ids, owners) if owner is None or _text(owner) == node_id]
+
+    async def forget_node(self, node_id: str, user_ids: List[UUID], batch_size: int = 500):
+        # Pointers go first: if this reaper dies halfway, the node is still listed and the next one resumes
+        for start in range(0, len(user_ids), batch_size):
+            async with self.redis.pipeline(transaction=False) as pipe:
+                for user_id in user_ids[start:start + batch_size]:
+                    await self.clear_pointer_script(keys=[self.user_node_key(user_id)], args=[node_id], client=pipe)
+                await pipe.execute()
+
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.unlink(self.node_users_key(node_id))
+            pipe.srem(self.NODES_KEY, node_id)
+            await pipe.execute()
@@ -0,0 +1,74 @@
+import json
+from typing import Any, Optional, Union
+
+import msgpack
+from fastapi import WebSocket, WebSocketDisconnect, status
+from pydantic import BaseModel
+
+from tanin.core.config import settings
+from tanin.schemas.chat_schema import WebRTCAnswerEvent, WebRTCOfferEvent
+
+MSGPACK_SUBPROTOCOL = "tanin.msgpack"
+
+
+def select_subprotocol(websocket: WebSocket) -> Optional[str]:
+    # Clients that offer nothing we know keep plain JSON text frames
+    if MSGPACK_SUBPROTOCOL in websocket.scope.get("subprotocols", []):
+        return MSGPACK_SUBPROTOCOL
+    return None
+
+
+class FrameError(Exception):
+    # The frame is not in the negotiated framing or does not decode; the socket itself is still usable
+    pass
+
+
+async def receive_frame(websocket: WebSocket, binary: bool) -> Union[str, bytes]:
+    message = await websocket.receive()
+    if message["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(message.get("code", status.WS_1000_NORMAL_CLOSURE), message.get("reason"))
+
+    frame = message.get("bytes") if binary else message.get("text")
+    if frame is None:
+        raise FrameError("Expected a binary frame" if binary else "Expected a text frame")
+    return frame
+
+
+def frame_size(frame: Union[str, bytes]) -> int:
+    # Size on the wire; isascii is a cheap scan, only other text is encoded to count its bytes
+    if isinstance(frame, str) and not frame.isascii():
+        return len(frame.encode())
+    return len(frame)
+
+
+def decode_frame(frame: Union[str, bytes], binary: bool) -> Any:
+    try:
+        return msgpack.unpackb(frame) if binary else json.loads(frame)
+    except (ValueError, TypeError, RecursionError) as e:
+        raise FrameError(f"Undecodable frame: {e}") from e
+
+
+def frame_size_limit(event: BaseModel) -> int:
+    # Taken from the validated event, a client cannot claim the SDP allowance by naming its frame an offer
+    if isinstance(event, (WebRTCOfferEvent, WebRTCAnswerEvent)):
+        return settings.WS_MAX_SDP_FRAME_BYTES
+    return settings.WS_MAX_FRAME_BYTES
+
+
+def encode_event(event: BaseModel, binary: bool) -> Union[str, bytes]:
+    # Encoded once, straight from the model, in the framing the socket negotiated
+    if binary:
+        return msgpack.packb(event.model_dump(mode="json"))
+    return event.model_dump_json()
+
+
+async def send_payload(websocket: WebSocket, payload: Union[str, bytes], binary: bool):
+    if isinstance(payload, bytes):
+        await websocket.send_bytes(payload)
+    elif binary:
+        # Events from other nodes and from streams arrive as JSON: one published payload serves
+        # whichever socket, and whichever subprotocol, the recipient has when it lands, and streams
+        # splice event_id into that JSON. Only msgpack recipients of those pay for the transcode.
+        await websocket.send_bytes(msgpack.packb(json.loads(payload)))
+    else:
+        await websocket.send_text(payload)
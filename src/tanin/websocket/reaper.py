@@ -0,0 +1,67 @@
+import asyncio
+import time
+
+from tanin.schemas.chat_schema import PartnerLeftEvent
+from tanin.utils import logger
+from tanin.utils.logger import Module
+from tanin.websocket.connection_manager import BaseConnectionManager
+from tanin.websocket.matching_service import MatchingBackend
+
+log = logger.get_logger(Module.WEBSOCKET)
+
+
+class PresenceReaper:
+    def __init__(
+            self,
+            manager: BaseConnectionManager,
+            matching_service: MatchingBackend,
+            heartbeat_interval: int = 5,
+            notify_batch_size: int = 500
+    ):
+        self.manager = manager
+        self.matching_service = matching_service
+        self.presence = manager.presence
+        self.heartbeat_interval = heartbeat_interval
+        self.notify_batch_size = notify_batch_size
+        self.next_user_refresh = 0.0
+
+    async def refresh_local_users(self):
+        # Well inside the pointer TTL, a pointer only lapses once its node has stopped refreshing it
+        if time.monotonic() < self.next_user_refresh:
+            return
+        await self.presence.refresh_users(list(self.manager.active_connections), batch_size=self.notify_batch_size)
+        self.next_user_refresh = time.monotonic() + self.presence.user_ttl / 3
+
+    async def reap_dead_nodes(self) -> int:
+        reaped = 0
+        for node_id in await self.presence.find_dead_nodes():
+            if not await self.presence.claim_dead_node(node_id):
+                continue
+
+            user_ids = await self.presence.collect_orphans(node_id, batch_size=self.notify_batch_size)
+            if user_ids:
+                await self.matching_service.remove_many_from_pool(user_ids)
+                partner_ids = await self.matching_service.evict_users(user_ids)
+                await self.manager.broadcast_events(
+                    [(PartnerLeftEvent(), partner_id) for partner_id in partner_ids],
+                    batch_size=self.notify_batch_size
+                )
+                log.warning(
+                    f"Node {node_id} is dead: removed {len(user_ids)} users, notified {len(partner_ids)} partners"
+                )
+
+            await self.presence.forget_node(node_id, user_ids, batch_size=self.notify_batch_size)
+            reaped += len(user_ids)
+        return reaped
+
+    async def run(self):
+        while True:
+            try:
+                await self.presence.heartbeat()
+                await self.refresh_local_users()
+                await self.reap_dead_nodes()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.error(f"Presence maintenance failed: {e}")
+            await asyncio.sleep(self.heartbeat_interval)
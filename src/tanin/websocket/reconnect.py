@@ -0,0 +1,93 @@
+import asyncio
+import uuid
+from typing import Dict, Optional, Tuple
+from uuid import UUID
+
+from tanin.schemas.chat_schema import PartnerLeftEvent, RoomResumedEvent
+from tanin.utils import logger
+from tanin.utils.logger import Module
+from tanin.utils.metrics import metrics
+from tanin.websocket.connection_manager import BaseConnectionManager, Connection
+from tanin.websocket.matching_service import MatchingBackend
+
+log = logger.get_logger(Module.WEBSOCKET)
+
+
+class ReconnectGrace:
+    # A dropped socket keeps its room for grace_seconds. Reconnecting within the window, to any node,
+    # resumes the room; only when the window runs out is the room closed and the partner told.
+    def __init__(self, manager: BaseConnectionManager, matching_service: MatchingBackend, grace_seconds: float = 10):
+        self.manager = manager
+        self.matching_service = matching_service
+        self.grace_seconds = grace_seconds
+        # Departures started on this node that are still inside their window, with their tokens
+        self.pending: Dict[UUID, Tuple[asyncio.Task, str]] = {}
+
+        self.resumed = metrics.counter("ws_reconnect_resumed", "Rooms resumed by a reconnect within the grace window")
+        self.expired = metrics.counter("ws_reconnect_grace_expired", "Rooms closed after the grace window ran out")
+
+    def _cancel(self, user_id: UUID):
+        pending = self.pending.pop(user_id, None)
+        if pending:
+            pending[0].cancel()
+
+    async def depart(self, user_id: UUID, room_id: Optional[UUID] = None):
+        self._cancel(user_id)
+        if self.grace_seconds <= 0:
+            await self.leave(user_id, room_id)
+            return
+
+        # Other nodes cannot cancel this timer. A reconnect anywhere clears the token, and a later
+        # departure through another node replaces it, so only the latest departure closes the room.
+        token = uuid.uuid4().hex
+        await self.matching_service.mark_departed(user_id, token, int(self.grace_seconds * 1000) + 60_000)
+        self.pending[user_id] = (asyncio.create_task(self._expire(user_id, room_id, token)), token)
+
+    async def _expire(self, user_id: UUID, room_id: Optional[UUID], token: str):
+        try:
+            await asyncio.sleep(self.grace_seconds)
+            if not await self.matching_service.take_departure(user_id, token):
+                return
+            if await self.leave(user_id, room_id):
+                self.expired.inc()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.error(f"Departure of user {user_id} failed: {e}")
+        finally:
+            pending = self.pending.get(user_id)
+            if pending and pending[0] is asyncio.current_task():
+                del self.pending[user_id]
+
+    async def leave(self, user_id: UUID, room_id: Optional[UUID] = None) -> Optional[UUID]:
+        partner_id = await self.matching_service.leave_room(user_id, room_id)
+        if partner_id:
+            log.info(f"User {user_id} left room. Notifying partner {partner_id}")
+            await self.manager.broadcast_event_to_user(PartnerLeftEvent(), partner_id)
+        return partner_id
+
+    async def resume(self, connection: Connection) -> Optional[Tuple[UUID, UUID]]:
+        self._cancel(connection.user_id)
+        if self.grace_seconds <= 0:
+            return None
+        await self.matching_service.clear_departure(connection.user_id)
+
+        room_info = await self.matching_service.get_user_room_info(connection.user_id)
+        if not room_info:
+            return None
+        room_id, partner_id = room_info
+        connection.bind_room(room_id, partner_id)
+        await self.manager.send_personal_event(
+            RoomResumedEvent(room_id=room_id, partner={"id": partner_id, "display_name": "Stranger"}),
+            connection.user_id
+        )
+        self.resumed.inc()
+        return room_info
+
+    async def flush(self):
+        # On shutdown nobody is left to run the timers, so pending departures complete right away
+        pending, self.pending = self.pending, {}
+        for user_id, (task, token) in pending.items():
+            task.cancel()
+            if await self.matching_service.take_departure(user_id, token):
+                await self.leave(user_id)
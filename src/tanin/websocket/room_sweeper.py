@@ -0,0 +1,59 @@
+import asyncio
+
+from tanin.schemas.chat_schema import RoomClosedEvent
+from tanin.utils import logger
+from tanin.utils.logger import Module
+from tanin.utils.metrics import metrics
+from tanin.websocket.connection_manager import BaseConnectionManager
+from tanin.websocket.matching_service import MatchingBackend
+
+log = logger.get_logger(Module.WEBSOCKET)
+
+
+class RoomSweeper:
+    def __init__(
+            self,
+            manager: BaseConnectionManager,
+            matching_service: MatchingBackend,
+            interval: int = 60,
+            scan_count: int = 500
+    ):
+        self.manager = manager
+        self.matching_service = matching_service
+        self.interval = interval
+        self.scan_count = scan_count
+
+        self.reclaimed_keys = metrics.counter("room_sweeper_reclaimed_keys", "Orphaned room keys deleted")
+        self.reclaimed_bytes = metrics.counter("room_sweeper_reclaimed_bytes", "Memory freed by the room sweeper")
+
+    async def refresh_local_rooms(self):
+        # An open connection keeps its room alive, even through a video call that sends nothing over the socket
+        await self.matching_service.refresh_rooms([
+            (connection.room_id, connection.user_id)
+            for connection in list(self.manager.active_connections.values())
+            if connection.room_id
+        ])
+
+    async def sweep(self) -> int:
+        if not await self.matching_service.claim_sweep(self.manager.node_id, self.interval):
+            return 0
+
+        keys, reclaimed, orphaned_users = await self.matching_service.sweep_orphans(self.scan_count)
+        if orphaned_users:
+            await self.manager.broadcast_events([(RoomClosedEvent(), user_id) for user_id in orphaned_users])
+        if keys:
+            self.reclaimed_keys.inc(keys)
+            self.reclaimed_bytes.inc(reclaimed)
+            log.info(f"Room sweep reclaimed {keys} keys ({reclaimed} bytes)")
+        return keys
+
+    async def run(self):
+        while True:
+            try:
+                await self.refresh_local_rooms()
+                await self.sweep()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.error(f"Room sweep failed: {e}")
+            await asyncio.sleep(self.interval)
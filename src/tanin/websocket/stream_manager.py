@@ -0,0 +1,165 @@
+import time
+from typing import List, Optional, Tuple
+from uuid import UUID
+
+from fastapi import WebSocket
+from redis.asyncio import Redis
+
+from tanin.schemas.chat_schema import ServerEvent
+from tanin.utils import logger
+from tanin.utils.logger import Module
+from tanin.websocket.connection_manager import ConnectionManager, Connection, ROOM_UNCHANGED, room_change
+from tanin.websocket.protocol import MSGPACK_SUBPROTOCOL
+
+log = logger.get_logger(Module.WEBSOCKET)
+
+
+# Append to the recipient's replay stream, then hand the entry to the owning node's delivery stream.
+# Both trims are approximate so Redis can drop whole macro nodes instead of single entries.
+STREAM_PUBLISH_SCRIPT = """
+local id = redis.call('xadd', KEYS[1], 'MAXLEN', '~', ARGV[1], '*', 'e', ARGV[4], 'm', ARGV[7])
+redis.call('xtrim', KEYS[1], 'MINID', '~', ARGV[2])
+redis.call('expire', KEYS[1], ARGV[3])
+
+local node_id = redis.call('get', KEYS[2])
+if node_id then
+    local node_stream = ARGV[5] .. node_id
+    redis.call('xadd', node_stream, 'MAXLEN', '~', ARGV[1], '*', 'r', ARGV[6], 'i', id, 'e', ARGV[4], 'm', ARGV[7])
+    redis.call('expire', node_stream, ARGV[3])
+end
+return id
+"""
+
+
+def parse_stream_id(stream_id: bytes) -> Tuple[int, int]:
+    milliseconds, sequence = stream_id.split(b"-")
+    return int(milliseconds), int(sequence)
+
+
+def with_event_id(payload: bytes, stream_id: bytes) -> str:
+    # Splice the id into the encoded event instead of parsing and re-encoding it
+    return '{"event_id":"' + stream_id.decode() + '",' + payload[1:].decode()
+
+
+# Every event goes to a per-user stream, trimmed by length and age, that a reconnecting client
+# resumes from with its last seen event_id. A copy goes to the owning node's delivery stream,
+# which that node tails with a blocking XREAD. There are no consumer groups: a node stream has exactly
+# one reader, and resuming is per user from the client's event_id, so a group's pending list and XACKs
+# would add a write per event without anything to hand entries over to.
+class StreamConnectionManager(ConnectionManager):
+    def __init__(
+            self,
+            redis_client: Redis,
+            stream_maxlen: int = 1000,
+            stream_max_age: int = 300,
+            block_ms: int = 1000,
+            **kwargs
+    ):
+        kwargs["delivery_mode"] = "routed"
+        super().__init__(redis_client, **kwargs)
+        self.stream_maxlen = stream_maxlen
+        self.stream_max_age = stream_max_age
+        self.block_ms = block_ms
+        self.USER_STREAM_KEY_PREFIX = "tanin:stream:user:"
+        self.NODE_STREAM_KEY_PREFIX = "tanin:stream:node:"
+
+        self.stream_publish_script = self.redis.register_script(STREAM_PUBLISH_SCRIPT)
+
+    @property
+    def node_stream(self) -> str:
+        return f"{self.NODE_STREAM_KEY_PREFIX}{self.node_id}"
+
+    async def connect(
+            self,
+            websocket: WebSocket,
+            user_id: UUID,
+            last_event_id: Optional[str] = None,
+            subprotocol: Optional[str] = None
+    ) -> Connection:
+        await websocket.accept(subprotocol=subprotocol)
+        connection = self._register(websocket, user_id, binary=subprotocol == MSGPACK_SUBPROTOCOL)
+
+        if not last_event_id:
+            await self.presence.register_user(user_id)
+            return connection
+
+        # Live entries arriving while the backlog is read are parked, then replayed behind it
+        connection.replay_buffer = []
+        await self.presence.register_user(user_id)
+        try:
+            missed = await self.redis.xrange(
+                f"{self.USER_STREAM_KEY_PREFIX}{user_id}",
+                min=f"({last_event_id}",
+                max="+"
+            )
+        except Exception as e:
+            log.warning(f"Cannot replay events for user {user_id} from {last_event_id}: {e}")
+            missed = []
+
+        buffered, connection.replay_buffer = connection.replay_buffer, None
+        for stream_id, fields in missed:
+            self._deliver(connection, stream_id, fields[b"e"], fields.get(b"m", ROOM_UNCHANGED))
+        for stream_id, payload, room in buffered:
+            self._deliver(connection, stream_id, payload, room)
+
+        log.info(f"Replayed {len(missed)} missed events to user {user_id}")
+        return connection
+
+    def _deliver(self, connection: Connection, stream_id: bytes, payload: bytes, room: bytes = ROOM_UNCHANGED):
+        if connection.replay_buffer is not None:
+            connection.replay_buffer.append((stream_id, payload, room))
+            return
+
+        # Ids only grow, anything older was already sent by the replay or the live path
+        if connection.last_event_id and parse_stream_id(stream_id) <= parse_stream_id(connection.last_event_id):
+            return
+
+        connection.last_event_id = stream_id
+        self.enqueue(connection, with_event_id(payload, stream_id), room)
+
+    async def broadcast_event_to_user(self, event: ServerEvent, user_id: UUID):
+        # No local short-circuit: the node stream is the single ordering point for a recipient
+        self.remote_deliveries.inc()
+        await self._publish(self.redis, event, user_id)
+
+    async def broadcast_events(self, events: List[Tuple[ServerEvent, UUID]], batch_size: int = 500):
+        for start in range(0, len(events), batch_size):
+            async with self.redis.pipeline(transaction=False) as pipe:
+                for event, user_id in events[start:start + batch_size]:
+                    await self._publish(pipe, event, user_id)
+                await pipe.execute()
+            self.remote_deliveries.inc(len(events[start:start + batch_size]))
+
+    async def _publish(self, client, event: ServerEvent, user_id: UUID):
+        min_id = int(time.time() * 1000) - self.stream_max_age * 1000
+        await self.stream_publish_script(
+            keys=[f"{self.USER_STREAM_KEY_PREFIX}{user_id}", self.presence.user_node_key(user_id)],
+            args=[
+                self.stream_maxlen,
+                min_id,
+                self.stream_max_age,
+                event.model_dump_json(),
+                self.NODE_STREAM_KEY_PREFIX,
+                user_id.bytes,
+                room_change(event)
+            ],
+            client=client
+        )
+
+    def handle_stream_entry(self, fields: dict):
+        connection = self.active_connections.get(UUID(bytes=fields[b"r"]))
+        if connection:
+            # Entries written before room changes were carried have no m field
+            self._deliver(connection, fields[b"i"], fields[b"e"], fields.get(b"m", ROOM_UNCHANGED))
+
+    async def listen(self):
+        # A node stream only ever has this process as reader, so a cursor is enough
+        latest = await self.redis.xrevrange(self.node_stream, count=1)
+        cursor = latest[0][0] if latest else "0-0"
+        log.info(f"Node {self.node_id} tailing {self.node_stream}")
+        while True:
+            response = await self.redis.xread({self.node_stream: cursor}, count=500, block=self.block_ms)
+            for _, entries in response or []:
+                for entry_id, fields in entries:
+                    cursor = entry_id
+                    self.handle_stream_entry(fields)
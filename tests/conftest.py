@@ -0,0 +1,77 @@
+import asyncio
+import uuid
+
+import pytest_asyncio
+
+from tanin.core.database import get_redis_client
+from tanin.schemas.user_schema import ActiveUser
+from tanin.websocket.connection_manager import ConnectionManager
+from tanin.websocket.matching_service import MatchingService
+from tanin.websocket.memory_backend import InMemoryConnectionManager, InMemoryMatchingService
+
+
+class FakeWebSocket:
+    scope = {}
+
+    def __init__(self):
+        self.sent = []
+        self.incoming = asyncio.Queue()
+        self.close_code = None
+
+    async def accept(self, subprotocol=None):
+        pass
+
+    async def send_text(self, data):
+        self.sent.append(data)
+
+    async def send_bytes(self, data):
+        self.sent.append(data)
+
+    async def receive(self):
+        # Text or bytes frames put on incoming, until the server closes the socket
+        frame = await self.incoming.get()
+        if frame is None:
+            return {"type": "websocket.disconnect", "code": self.close_code}
+        return {"type": "websocket.receive", "bytes" if isinstance(frame, bytes) else "text": frame}
+
+    async def close(self, code=1000, reason=None):
+        self.close_code = code
+        self.incoming.put_nowait(None)
+
+
+def make_user() -> ActiveUser:
+    return ActiveUser(id=uuid.uuid4(), display_name="Stranger", is_anonymous=True)
+
+
+def count_commands(redis_client) -> list:
+    commands = []
+    execute_command = redis_client.execute_command
+
+    async def counting_execute_command(*args, **options):
+        commands.append(args[0])
+        return await execute_command(*args, **options)
+
+    redis_client.execute_command = counting_execute_command
+    return commands
+
+
+async def clear_matching_keys(redis_client):
+    for pattern in ("tanin:waiting_queue*", "tanin:user_tags:*", "tanin:*room:*", "tanin:departure:*"):
+        async for key in redis_client.scan_iter(match=pattern):
+            await redis_client.delete(key)
+
+
+# Tests taking this fixture run against each STATE_BACKEND and only go through the backend interface
+@pytest_asyncio.fixture(params=["redis", "memory"])
+async def backend(request):
+    if request.param == "memory":
+        yield InMemoryConnectionManager(), InMemoryMatchingService(room_ttl_seconds=1)
+        return
+
+    redis_client = get_redis_client()
+    binary_redis = get_redis_client(decode_responses=False)
+    await clear_matching_keys(redis_client)
+    yield ConnectionManager(binary_redis), MatchingService(redis_client, room_ttl_seconds=1)
+    await clear_matching_keys(redis_client)
+    await binary_redis.aclose()
+    await redis_client.aclose()
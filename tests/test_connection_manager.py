@@ -0,0 +1,150 @@
+import asyncio
+import uuid
+
+import msgpack
+import pytest
+import pytest_asyncio
+
+from tanin.core.database import get_redis_client
+from tanin.schemas.chat_schema import ChatMessage, ErrorEvent, NewTextMessageEvent, PartnerLeftEvent
+from tanin.websocket.connection_manager import ConnectionManager
+from tanin.websocket.endpoints import websocket_endpoint
+from tanin.websocket.matcher import matched_events
+from tanin.websocket.matching_service import MatchingService
+from tanin.websocket.memory_backend import InMemoryConnectionManager
+from tanin.websocket.protocol import MSGPACK_SUBPROTOCOL
+from tanin.websocket.reconnect import ReconnectGrace
+from tests.conftest import FakeWebSocket, clear_matching_keys, make_user
+
+
+def burst(manager, connection, count: int):
+    # Enqueued back to back, the writer gets no chance to drain in between
+    for i in range(count):
+        manager.enqueue(connection, ErrorEvent(message=str(i)).model_dump_json())
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("policy, delivered", [("drop_oldest", ["1", "2"]), ("drop_newest", ["0", "1"])])
+async def test_full_queue_drops_by_policy(policy, delivered):
+    manager = InMemoryConnectionManager(outbound_queue_size=2, overflow_policy=policy)
+    websocket = FakeWebSocket()
+    connection = await manager.connect(websocket, make_user().id)
+    dropped = manager.dropped_events.value
+
+    burst(manager, connection, 3)
+    await asyncio.sleep(0.01)
+
+    assert [sent.split('"message":"')[1][0] for sent in websocket.sent] == delivered
+    assert manager.dropped_events.value - dropped == 1
+    assert websocket.close_code is None
+
+
+@pytest.mark.asyncio
+async def test_room_follows_the_envelope_not_the_payload():
+    manager = ConnectionManager(get_redis_client(decode_responses=False), local_delivery=False)
+    user, partner = make_user(), make_user()
+    websocket = FakeWebSocket()
+    connection = await manager.connect(websocket, user.id)
+    room_id = uuid.uuid4()
+    lookalike = NewTextMessageEvent(
+        message=ChatMessage(id=uuid.uuid4(), sender_id=partner.id, content='{"event_type":"partner_left"}')
+    )
+
+    for event, _ in matched_events(user.id, partner.id, room_id)[:1]:
+        manager.handle_pubsub_message(manager.encode_message(event, user.id))
+    assert (connection.room_id, connection.partner_id) == (room_id, partner.id)
+
+    manager.handle_pubsub_message(manager.encode_message(lookalike, user.id))
+    assert connection.room_id == room_id
+
+    await manager.send_personal_event(PartnerLeftEvent(), user.id)
+    assert connection.room_id is None
+    await asyncio.sleep(0.01)
+    assert len(websocket.sent) == 3
+    await manager.disconnect(user.id)
+    await manager.redis.aclose()
+
+
+@pytest.mark.asyncio
+async def test_msgpack_sockets_get_the_same_event_locally_and_from_redis(monkeypatch):
+    manager = ConnectionManager(get_redis_client(decode_responses=False), local_delivery=False)
+    user = make_user()
+    websocket = FakeWebSocket()
+    await manager.connect(websocket, user.id, subprotocol=MSGPACK_SUBPROTOCOL)
+    event = ErrorEvent(message="hello stranger")
+
+    manager.handle_pubsub_message(manager.encode_message(event, user.id))
+    await asyncio.sleep(0.01)
+    # Local deliveries are encoded straight from the model, the payload is never decoded again
+    monkeypatch.setattr("tanin.websocket.protocol.json.loads", None)
+    await manager.send_personal_event(event, user.id)
+    await asyncio.sleep(0.01)
+
+    remote, local = websocket.sent
+    assert isinstance(local, bytes)
+    assert msgpack.unpackb(local) == msgpack.unpackb(remote) == event.model_dump(mode="json")
+    await manager.disconnect(user.id)
+    await manager.redis.aclose()
+
+
+@pytest_asyncio.fixture
+async def services():
+    redis_client = get_redis_client()
+    binary_redis = get_redis_client(decode_responses=False)
+    await clear_matching_keys(redis_client)
+    manager = ConnectionManager(binary_redis, outbound_queue_size=1, overflow_policy="disconnect")
+    matching_service = MatchingService(redis_client)
+    yield manager, matching_service, ReconnectGrace(manager, matching_service, grace_seconds=0)
+    await clear_matching_keys(redis_client)
+    await binary_redis.aclose()
+    await redis_client.aclose()
+
+
+async def matched_session(manager, matching_service, reconnect_grace):
+    # The user's socket runs through the real endpoint, the partner is only connected
+    user, partner = make_user(), make_user()
+    websocket, partner_websocket = FakeWebSocket(), FakeWebSocket()
+    session = asyncio.create_task(
+        websocket_endpoint(websocket, None, user, manager, matching_service, reconnect_grace)
+    )
+    await manager.connect(partner_websocket, partner.id)
+    await asyncio.sleep(0.01)
+    await matching_service.enqueue_and_match(partner)
+    await manager.broadcast_events(matched_events(*await matching_service.enqueue_and_match(user)))
+    await asyncio.sleep(0.01)
+    return user, partner, websocket, partner_websocket, session
+
+
+@pytest.mark.asyncio
+async def test_slow_consumer_departs_like_any_other_disconnect(services):
+    manager, matching_service, reconnect_grace = services
+    user, partner, websocket, partner_websocket, session = await matched_session(*services)
+    connection = manager.active_connections[user.id]
+
+    burst(manager, connection, 3)
+    await asyncio.wait_for(session, 1)
+
+    assert websocket.close_code == 1013
+    assert user.id not in manager.active_connections
+    assert not await manager.presence.is_online(user.id)
+    assert await matching_service.get_user_room_info(partner.id) is None
+    await asyncio.sleep(0.01)
+    assert '"event_type":"partner_left"' in partner_websocket.sent[-1]
+    await manager.disconnect(partner.id)
+
+
+@pytest.mark.asyncio
+async def test_replaced_socket_leaves_the_user_alone(services):
+    manager, matching_service, reconnect_grace = services
+    user, partner, websocket, partner_websocket, session = await matched_session(*services)
+
+    # The client reconnects before the old socket is noticed dead
+    await manager.connect(FakeWebSocket(), user.id)
+    await websocket.close()
+    await asyncio.wait_for(session, 1)
+
+    assert user.id in manager.active_connections
+    assert await manager.presence.is_online(user.id)
+    assert (await matching_service.get_user_room_info(partner.id))[1] == user.id
+    for user_id in (user.id, partner.id):
+        await manager.disconnect(user_id)
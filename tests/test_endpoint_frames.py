@@ -0,0 +1,156 @@
+import asyncio
+import json
+
+import msgpack
+import pytest
+import pytest_asyncio
+import uvicorn
+from fastapi import FastAPI, WebSocket
+from websockets.asyncio.client import connect
+from websockets.exceptions import ConnectionClosed
+
+from tanin.core.config import settings
+from tanin.websocket import compression, endpoints
+from tanin.websocket.compression import CompressionThresholdProtocol
+from tanin.websocket.endpoints import websocket_endpoint
+from tanin.websocket.matcher import matched_events
+from tanin.websocket.memory_backend import InMemoryConnectionManager, InMemoryMatchingService
+from tanin.websocket.protocol import MSGPACK_SUBPROTOCOL
+from tanin.websocket.reconnect import ReconnectGrace
+from tests.conftest import FakeWebSocket, make_user
+
+
+async def open_session(subprotocol=None):
+    manager, matching_service = InMemoryConnectionManager(), InMemoryMatchingService()
+    user, websocket = make_user(), FakeWebSocket()
+    if subprotocol:
+        websocket.scope = {"subprotocols": [subprotocol]}
+    session = asyncio.create_task(websocket_endpoint(
+        websocket, None, user, manager, matching_service, ReconnectGrace(manager, matching_service, 0)
+    ))
+    await asyncio.sleep(0.01)
+    return manager, matching_service, user, websocket, session
+
+
+async def matched_session():
+    manager, matching_service, user, websocket, session = await open_session()
+    partner, partner_websocket = make_user(), FakeWebSocket()
+    await manager.connect(partner_websocket, partner.id)
+    await matching_service.enqueue_and_match(partner)
+    await manager.broadcast_events(matched_events(*await matching_service.enqueue_and_match(user)))
+    return websocket, partner_websocket, session
+
+
+def event_types(websocket: FakeWebSocket) -> list:
+    return [json.loads(sent)["event_type"] for sent in websocket.sent]
+
+
+@pytest.mark.asyncio
+async def test_bad_frames_on_a_msgpack_socket_are_dropped():
+    manager, matching_service, user, websocket, session = await open_session(MSGPACK_SUBPROTOCOL)
+
+    # A text frame, a reserved type byte, a truncated array and a map with an unhashable key
+    for frame in ('{"event_type":"start_searching"}', b"\xc1", b"\x92\x01", b"\x81\x90\x01"):
+        websocket.incoming.put_nowait(frame)
+    websocket.incoming.put_nowait(msgpack.packb({"event_type": "start_searching"}))
+    await asyncio.sleep(0.01)
+
+    assert not session.done()
+    assert matching_service.open_pool.score(user.id) is not None
+
+    await websocket.close()
+    await asyncio.wait_for(session, 1)
+    # Left through the normal departure path
+    assert user.id not in manager.active_connections
+    assert matching_service.open_pool.score(user.id) is None
+
+
+@pytest.mark.asyncio
+async def test_only_offers_and_answers_get_the_sdp_allowance(monkeypatch):
+    monkeypatch.setattr(settings, "WEBRTC_ICE_COALESCE_WINDOW_MS", 0)
+    websocket, partner_websocket, session = await matched_session()
+    padding = "x" * settings.WS_MAX_FRAME_BYTES
+
+    for frame in (
+        {"event_type": "send_text_message", "content": padding},
+        {"event_type": "webrtc_ice_candidate", "candidate": {"candidate": padding}},
+        # Named an offer but carrying a candidate, it validates as nothing and is dropped
+        {"event_type": "webrtc_offer", "candidate": {"candidate": padding}},
+        {"event_type": "webrtc_ice_candidate", "candidate": {"candidate": "small"}},
+        {"event_type": "webrtc_offer", "sdp": {"type": "offer", "sdp": padding}},
+    ):
+        websocket.incoming.put_nowait(json.dumps(frame))
+    await asyncio.sleep(0.05)
+
+    assert event_types(websocket) == ["matched", "error", "error"]
+    assert event_types(partner_websocket) == ["matched", "partner_webrtc_ice_candidate", "partner_webrtc_offer"]
+    await websocket.close()
+    await asyncio.wait_for(session, 1)
+
+
+@pytest.mark.asyncio
+async def test_frames_over_the_sdp_limit_are_never_decoded(monkeypatch):
+    decoded = []
+    decode_frame = endpoints.decode_frame
+
+    def recording_decode_frame(frame, binary):
+        decoded.append(frame)
+        return decode_frame(frame, binary)
+
+    monkeypatch.setattr(endpoints, "decode_frame", recording_decode_frame)
+    websocket, partner_websocket, session = await matched_session()
+    oversized = {"event_type": "webrtc_offer", "sdp": {"type": "offer", "sdp": "x" * settings.WS_MAX_SDP_FRAME_BYTES}}
+
+    websocket.incoming.put_nowait(json.dumps(oversized))
+    await asyncio.sleep(0.01)
+
+    assert decoded == []
+    assert event_types(websocket) == ["matched", "error"]
+    assert event_types(partner_websocket) == ["matched"]
+    await websocket.close()
+    await asyncio.wait_for(session, 1)
+
+
+@pytest_asyncio.fixture
+async def echo_server(monkeypatch):
+    # A real uvicorn server with the production protocol, where the 1009 cap and deflate are enforced
+    monkeypatch.setattr(settings, "WS_COMPRESSION_THRESHOLD_BYTES", 256)
+    app = FastAPI()
+
+    @app.websocket("/echo")
+    async def echo(websocket: WebSocket):
+        await websocket.accept()
+        while True:
+            await websocket.send_text(await websocket.receive_text())
+
+    server = uvicorn.Server(uvicorn.Config(
+        app, host="127.0.0.1", port=0, ws=CompressionThresholdProtocol, ws_max_size=1024, log_level="warning"
+    ))
+    serving = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.01)
+    port = server.servers[0].sockets[0].getsockname()[1]
+    yield f"ws://127.0.0.1:{port}/echo"
+    server.should_exit = True
+    await serving
+
+
+@pytest.mark.asyncio
+async def test_server_closes_frames_over_the_cap_with_1009(echo_server):
+    async with connect(echo_server) as client:
+        await client.send("x" * 2048)
+        with pytest.raises(ConnectionClosed) as closed:
+            await client.recv()
+    assert closed.value.rcvd.code == 1009
+
+
+@pytest.mark.asyncio
+async def test_only_messages_over_the_threshold_are_deflated(echo_server):
+    skipped, compressed = compression.frames_skipped.value, compression.frames_compressed.value
+    async with connect(echo_server, compression="deflate") as client:
+        for message in ("hello stranger", "x" * 512):
+            await client.send(message)
+            assert await client.recv() == message
+
+    assert compression.frames_skipped.value - skipped == 1
+    assert compression.frames_compressed.value - compressed == 1
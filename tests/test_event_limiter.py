@@ -0,0 +1,65 @@
+import json
+import time
+import uuid
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from starlette.websockets import WebSocketDisconnect
+
+from tanin.core.config import settings
+from tanin.core.dependencies import get_connection_manager, get_matching_service, get_reconnect_grace
+from tanin.websocket import endpoints
+from tanin.websocket.event_limiter import EventRateLimiter, throttled_events
+from tanin.websocket.memory_backend import InMemoryConnectionManager, InMemoryMatchingService
+from tanin.websocket.reconnect import ReconnectGrace
+
+
+def test_each_event_type_has_its_own_bucket():
+    limiter = EventRateLimiter({"send_text_message": (3, 10), "*": (1, 0.001)})
+    throttled = throttled_events.value
+
+    assert [limiter.allow("send_text_message") for _ in range(4)] == [True, True, True, False]
+    # Unknown types, missing and malformed ones all share the fallback bucket
+    assert [limiter.allow(event_type) for event_type in ("start_typing", None, ["x"])] == [True, False, False]
+    assert throttled_events.value - throttled == 3
+
+    time.sleep(0.1)
+    assert limiter.allow("send_text_message")
+    assert not limiter.allow("start_typing")
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(settings, "WS_EVENT_RATE_LIMITS", {"send_text_message": (2, 0.001)})
+    manager, matching_service = InMemoryConnectionManager(), InMemoryMatchingService()
+    app = FastAPI()
+    app.include_router(endpoints.router)
+    app.dependency_overrides[get_connection_manager] = lambda: manager
+    app.dependency_overrides[get_matching_service] = lambda: matching_service
+    app.dependency_overrides[get_reconnect_grace] = lambda: ReconnectGrace(manager, matching_service, 0)
+    with TestClient(app) as client:
+        yield client
+
+
+def spam(websocket, count: int):
+    for _ in range(count):
+        websocket.send_text(json.dumps({"event_type": "send_text_message", "content": "hi"}))
+
+
+def test_error_policy_answers_each_throttled_event(client, monkeypatch):
+    monkeypatch.setattr(settings, "WS_EVENT_RATE_LIMIT_POLICY", "error")
+    with client.websocket_connect(f"/ws?client_id={uuid.uuid4()}") as websocket:
+        spam(websocket, 4)
+        assert [websocket.receive_json() for _ in range(2)] == [
+            {"event_type": "error", "message": "Rate limit exceeded"}
+        ] * 2
+
+
+def test_disconnect_policy_closes_the_socket(client, monkeypatch):
+    monkeypatch.setattr(settings, "WS_EVENT_RATE_LIMIT_POLICY", "disconnect")
+    with client.websocket_connect(f"/ws?client_id={uuid.uuid4()}") as websocket:
+        spam(websocket, 3)
+        with pytest.raises(WebSocketDisconnect) as closed:
+            websocket.receive_json()
+    assert closed.value.code == 1008
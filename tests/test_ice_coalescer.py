@@ -0,0 +1,93 @@
+import asyncio
+import json
+
+import pytest
+
+from tanin.core.config import settings
+from tanin.websocket import ice_coalescer
+from tanin.websocket.endpoints import websocket_endpoint
+from tanin.websocket.ice_coalescer import IceCandidateCoalescer
+from tanin.websocket.matcher import matched_events
+from tanin.websocket.memory_backend import InMemoryConnectionManager, InMemoryMatchingService
+from tanin.websocket.reconnect import ReconnectGrace
+from tests.conftest import FakeWebSocket, make_user
+
+
+def recording_coalescer(window_ms: int):
+    batches = []
+
+    async def send(candidates):
+        batches.append(candidates)
+
+    return IceCandidateCoalescer(send, window_ms=window_ms), batches
+
+
+@pytest.mark.asyncio
+async def test_candidates_within_the_window_go_out_as_one_batch():
+    coalescer, batches = recording_coalescer(window_ms=30)
+    for i in range(3):
+        await coalescer.add({"candidate": i})
+    assert batches == []
+
+    await asyncio.sleep(0.05)
+    await coalescer.add({"candidate": 3})
+    await asyncio.sleep(0.05)
+    assert batches == [[{"candidate": 0}, {"candidate": 1}, {"candidate": 2}], [{"candidate": 3}]]
+
+
+@pytest.mark.asyncio
+async def test_discarded_candidates_are_never_sent():
+    coalescer, batches = recording_coalescer(window_ms=20)
+    await coalescer.add({"candidate": 0})
+    coalescer.discard()
+    await asyncio.sleep(0.05)
+    assert batches == [] and not coalescer.pending
+
+
+@pytest.mark.asyncio
+async def test_failed_timer_flush_is_logged(monkeypatch):
+    errors = []
+    monkeypatch.setattr(ice_coalescer.log, "error", errors.append)
+
+    async def send(candidates):
+        raise ConnectionError("Redis is down")
+
+    coalescer = IceCandidateCoalescer(send, window_ms=10)
+    await coalescer.add({"candidate": 0})
+    timer = coalescer._timer
+    await asyncio.sleep(0.03)
+
+    assert timer.done() and timer.exception() is None
+    assert len(errors) == 1 and "Redis is down" in errors[0]
+
+
+@pytest.mark.asyncio
+async def test_pending_candidates_reach_the_partner_before_an_offer(monkeypatch):
+    # A window long enough that only the flush before the offer can send the candidates
+    monkeypatch.setattr(settings, "WEBRTC_ICE_COALESCE_WINDOW_MS", 10_000)
+    manager, matching_service = InMemoryConnectionManager(), InMemoryMatchingService()
+    user, partner = make_user(), make_user()
+    websocket, partner_websocket = FakeWebSocket(), FakeWebSocket()
+    session = asyncio.create_task(websocket_endpoint(
+        websocket, None, user, manager, matching_service, ReconnectGrace(manager, matching_service, 0)
+    ))
+    await asyncio.sleep(0.01)
+    await manager.connect(partner_websocket, partner.id)
+    await matching_service.enqueue_and_match(partner)
+    await manager.broadcast_events(matched_events(*await matching_service.enqueue_and_match(user)))
+
+    for frame in (
+        {"event_type": "webrtc_ice_candidate", "candidate": {"candidate": 0}},
+        {"event_type": "webrtc_ice_candidate", "candidate": {"candidate": 1}},
+        {"event_type": "webrtc_offer", "sdp": {"type": "offer"}},
+    ):
+        websocket.incoming.put_nowait(json.dumps(frame))
+    await asyncio.sleep(0.05)
+
+    events = [json.loads(sent) for sent in partner_websocket.sent]
+    assert [event["event_type"] for event in events] == [
+        "matched", "partner_webrtc_ice_candidates", "partner_webrtc_offer"
+    ]
+    assert events[1]["candidates"] == [{"candidate": 0}, {"candidate": 1}]
+    await websocket.close()
+    await asyncio.wait_for(session, 1)
@@ -0,0 +1,92 @@
+import asyncio
+import os
+from collections import Counter
+
+import pytest
+import pytest_asyncio
+from redis.asyncio import RedisCluster
+
+from tanin.websocket.matching_service import MatchingService
+from tests.conftest import clear_matching_keys, make_user
+
+# Runs against a local cluster, e.g. `docker compose -f docker-compose.cluster.yml up -d` and
+# REDIS_CLUSTER_URL=redis://localhost:7001
+REDIS_CLUSTER_URL = os.getenv("REDIS_CLUSTER_URL")
+pytestmark = pytest.mark.skipif(not REDIS_CLUSTER_URL, reason="REDIS_CLUSTER_URL is not set")
+
+SHARDS = 8
+
+
+@pytest_asyncio.fixture
+async def matching_service():
+    redis_client = RedisCluster.from_url(REDIS_CLUSTER_URL, decode_responses=True)
+    service = MatchingService(redis_client, shards=SHARDS)
+    await clear_matching_keys(redis_client)
+    yield service
+    await clear_matching_keys(redis_client)
+    await redis_client.aclose()
+
+
+@pytest.mark.asyncio
+async def test_shards_spread_over_cluster_nodes(matching_service):
+    nodes = {
+        matching_service.redis.get_node_from_key(matching_service.pool_keys(shard)[0]).name
+        for shard in range(SHARDS)
+    }
+    assert len(nodes) > 1
+
+
+@pytest.mark.asyncio
+async def test_concurrent_searchers_are_paired_across_shards(matching_service):
+    users = [make_user() for _ in range(200)]
+
+    matches = await asyncio.gather(*(matching_service.enqueue_and_match(user) for user in users))
+    matches = [match for match in matches if match]
+
+    matched = Counter(user_id for user1_id, user2_id, _ in matches for user_id in (user1_id, user2_id))
+    waiting = sum([await matching_service.redis.zcard(matching_service.pool_keys(shard)[0]) for shard in range(SHARDS)])
+    # Two searchers on different empty shards may both end up waiting, never matched twice
+    assert all(count == 1 for count in matched.values())
+    assert len(matched) + waiting == len(users)
+    assert waiting < SHARDS
+
+    for user1_id, user2_id, room_id in matches:
+        assert await matching_service.get_user_room_info(user1_id) == (room_id, user2_id)
+        assert await matching_service.get_user_room_info(user2_id) == (room_id, user1_id)
+
+
+@pytest.mark.asyncio
+async def test_lone_searchers_on_different_shards_are_matched(matching_service):
+    waiter = make_user()
+    searcher = make_user()
+    while matching_service.shard_of(searcher.id) == matching_service.shard_of(waiter.id):
+        searcher = make_user()
+
+    assert await matching_service.enqueue_and_match(waiter) is None
+    partner_id, user_id, room_id = await matching_service.enqueue_and_match(searcher)
+    assert (partner_id, user_id) == (waiter.id, searcher.id)
+    assert matching_service.shard_of(room_id) == matching_service.shard_of(searcher.id)
+
+    # The partner's pointer lives on its own shard and is cleared with the room
+    assert await matching_service.leave_room(waiter.id) == searcher.id
+    assert not await matching_service.redis.exists(matching_service.room_key(room_id))
+    assert not await matching_service.redis.exists(matching_service.user_room_key(waiter.id))
+    assert not await matching_service.redis.exists(matching_service.user_room_key(searcher.id))
+
+
+@pytest.mark.asyncio
+async def test_batch_matching_pairs_leftovers_across_shards(matching_service):
+    users = [make_user() for _ in range(101)]
+    for user in users:
+        await matching_service.enqueue_and_match(user, match_open=False)
+
+    matches = await matching_service.match_batch(1000)
+
+    matched = Counter(user_id for user1_id, user2_id, _ in matches for user_id in (user1_id, user2_id))
+    assert all(count == 1 for count in matched.values())
+    assert len(matched) >= len(users) - SHARDS
+    for user1_id, user2_id, room_id in matches:
+        assert await matching_service.get_user_room_info(user1_id) == (room_id, user2_id)
+
+    keys, _, _ = await matching_service.sweep_orphans()
+    assert keys == 0
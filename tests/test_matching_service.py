@@ -0,0 +1,255 @@
+import asyncio
+import uuid
+from collections import Counter
+
+import pytest
+import pytest_asyncio
+
+from tanin.core.database import get_redis_client
+from tanin.schemas.chat_schema import PartnerLeftEvent
+from tanin.websocket.matcher import BatchMatcher, matched_events
+from tanin.websocket.matching_service import MatchingService
+from tests.conftest import FakeWebSocket, clear_matching_keys, make_user
+
+
+@pytest_asyncio.fixture
+async def matching_service():
+    redis_client = get_redis_client()
+    service = MatchingService(redis_client)
+    await clear_matching_keys(redis_client)
+    yield service
+    await clear_matching_keys(redis_client)
+    await redis_client.aclose()
+
+
+@pytest.mark.asyncio
+async def test_concurrent_searchers_are_paired_exactly_once(backend):
+    _, matching_service = backend
+    users = [make_user() for _ in range(200)]
+
+    matches = await asyncio.gather(*(matching_service.enqueue_and_match(user) for user in users))
+    matches = [match for match in matches if match]
+
+    matched = Counter(user_id for user1_id, user2_id, _ in matches for user_id in (user1_id, user2_id))
+    assert len(matches) == len(users) // 2
+    assert set(matched) == {user.id for user in users} and set(matched.values()) == {1}
+    for user1_id, user2_id, room_id in matches:
+        assert await matching_service.get_user_room_info(user1_id) == (room_id, user2_id)
+        assert await matching_service.get_user_room_info(user2_id) == (room_id, user1_id)
+    # Already in a room, so not enqueued again
+    assert await matching_service.enqueue_and_match(users[0]) is None
+    assert await matching_service.match_batch(10) == []
+
+
+@pytest.mark.asyncio
+async def test_longest_waiting_user_is_matched_first(backend):
+    _, matching_service = backend
+    oldest, newer, searcher = make_user(), make_user(), make_user()
+    await matching_service.enqueue_and_match(oldest, match_open=False)
+    await asyncio.sleep(0.01)
+    await matching_service.enqueue_and_match(newer, match_open=False)
+    # Searching again keeps the original place in the queue
+    await matching_service.enqueue_and_match(oldest, match_open=False)
+
+    partner_id, user_id, _ = await matching_service.enqueue_and_match(searcher)
+    assert (partner_id, user_id) == (oldest.id, searcher.id)
+    assert matching_service.time_to_match.count >= 2
+
+
+@pytest.mark.asyncio
+async def test_tags_are_matched_first_then_fall_back(backend):
+    _, matching_service = backend
+    matching_service.tag_fallback_ms = 50
+    english, vietnamese, another_english, untagged = make_user(), make_user(), make_user(), make_user()
+
+    assert await matching_service.enqueue_and_match(english, ["en", "music"]) is None
+    assert await matching_service.enqueue_and_match(vietnamese, ["vi"]) is None
+    partner_id, _, _ = await matching_service.enqueue_and_match(another_english, ["en"])
+    assert partner_id == english.id
+
+    assert await matching_service.enqueue_and_match(untagged) is None
+    await asyncio.sleep(0.1)
+    match = await matching_service.enqueue_and_match(vietnamese, ["vi"])
+    assert match is not None and match[0] == untagged.id
+
+
+@pytest.mark.asyncio
+async def test_fallback_pairs_waiters_without_another_search(backend):
+    manager, matching_service = backend
+    matching_service.tag_fallback_ms = 50
+    tagged, untagged = make_user(), make_user()
+
+    # Both arrive inside the window and then only wait, as they do in inline mode
+    assert await matching_service.enqueue_and_match(tagged, ["vi"]) is None
+    assert await matching_service.enqueue_and_match(untagged) is None
+    matcher = BatchMatcher(None, manager, matching_service)
+    assert await matcher.run_once() == 0
+    await asyncio.sleep(0.1)
+
+    assert await matcher.run_once() == 1
+    assert (await matching_service.get_user_room_info(tagged.id))[1] == untagged.id
+
+
+@pytest.mark.asyncio
+async def test_batch_pairs_the_open_pool_in_order(backend):
+    _, matching_service = backend
+    users = [make_user() for _ in range(5)]
+    for user in users:
+        assert await matching_service.enqueue_and_match(user, match_open=False) is None
+        await asyncio.sleep(0.002)
+    await matching_service.remove_from_pool(users[0].id)
+
+    matches = await matching_service.match_batch(10)
+    assert [(user1_id, user2_id) for user1_id, user2_id, _ in matches] == [
+        (users[1].id, users[2].id), (users[3].id, users[4].id)
+    ]
+    assert await matching_service.match_batch(10) == []
+
+
+@pytest.mark.asyncio
+async def test_video_readiness_and_leave_are_atomic(backend):
+    _, matching_service = backend
+    users = [make_user() for _ in range(20)]
+    rooms = [match for match in [await matching_service.enqueue_and_match(user) for user in users] if match]
+
+    ready = await asyncio.gather(*(
+        matching_service.set_user_ready_for_video(room_id, user_id)
+        for user1_id, user2_id, room_id in rooms for user_id in (user1_id, user2_id)
+    ))
+    assert all(sorted(ready[i:i + 2]) == [False, True] for i in range(0, len(ready), 2))
+    assert await matching_service.set_user_ready_for_video(rooms[0][2], make_user().id) is None
+
+    left = await asyncio.gather(*(
+        matching_service.leave_room(user_id) for user1_id, user2_id, _ in rooms for user_id in (user1_id, user2_id)
+    ))
+    for (user1_id, user2_id, _), results in zip(rooms, zip(left[::2], left[1::2])):
+        assert [partner_id for partner_id in results if partner_id] in ([user1_id], [user2_id])
+        assert await matching_service.get_user_room_info(user1_id) is None
+        assert await matching_service.get_user_room_info(user2_id) is None
+
+
+@pytest.mark.asyncio
+async def test_evicted_users_leave_their_partners_behind(backend):
+    _, matching_service = backend
+    users = [make_user() for _ in range(6)]
+    rooms = [match for match in [await matching_service.enqueue_and_match(user) for user in users] if match]
+
+    # Both members of the first room are evicted, only one of the second
+    partners = await matching_service.evict_users([rooms[0][0], rooms[0][1], rooms[1][0]])
+    assert partners == [rooms[1][1]]
+    assert await matching_service.get_user_room_info(rooms[1][1]) is None
+    assert await matching_service.get_user_room_info(rooms[2][0]) == (rooms[2][2], rooms[2][1])
+
+
+@pytest.mark.asyncio
+async def test_rooms_expire_unless_refreshed(backend):
+    _, matching_service = backend
+    users = [make_user() for _ in range(4)]
+    rooms = [match for match in [await matching_service.enqueue_and_match(user) for user in users] if match]
+    refreshed, expired = rooms
+
+    for _ in range(3):
+        await asyncio.sleep(0.5)
+        await matching_service.refresh_rooms([(refreshed[2], refreshed[0]), (refreshed[2], refreshed[1])])
+
+    assert await matching_service.get_user_room_info(refreshed[0]) == (refreshed[2], refreshed[1])
+    assert await matching_service.get_user_room_info(expired[0]) is None
+    # Members of an expired room may search again
+    searcher = next(user for user in users if user.id == expired[0])
+    assert await matching_service.enqueue_and_match(make_user()) is None
+    assert await matching_service.enqueue_and_match(searcher) is not None
+
+
+@pytest.mark.asyncio
+async def test_matched_connections_relay_to_each_other(backend):
+    manager, matching_service = backend
+    user, partner = make_user(), make_user()
+    websockets = {user.id: FakeWebSocket(), partner.id: FakeWebSocket()}
+    connections = [await manager.connect(websockets[user_id], user_id) for user_id in websockets]
+
+    await matching_service.enqueue_and_match(partner)
+    match = await matching_service.enqueue_and_match(user)
+    await manager.broadcast_events(matched_events(*match))
+    await manager.broadcast_event_to_user(PartnerLeftEvent(), partner.id)
+    await asyncio.sleep(0.01)
+
+    assert connections[0].partner_id == partner.id and connections[0].room_id == match[2]
+    assert connections[1].room_id is None
+    assert ['"event_type":"matched"' in sent for sent in websockets[partner.id].sent] == [True, False]
+    for user_id in websockets:
+        await manager.disconnect(user_id)
+    assert not manager.active_connections
+
+
+# Redis only: what the scripts leave behind in the keyspace
+
+
+@pytest.mark.asyncio
+async def test_matching_leaves_no_pool_or_room_keys_behind(matching_service):
+    redis_client = matching_service.redis
+    english, vietnamese, another_english = make_user(), make_user(), make_user()
+
+    await matching_service.enqueue_and_match(english, ["en", "music"])
+    await matching_service.enqueue_and_match(vietnamese, ["vi"])
+    await matching_service.enqueue_and_match(another_english, ["en"])
+    music_bucket = f"{matching_service.shard_prefix(matching_service.TAG_BUCKET_KEY_PREFIX, 0)}music"
+    assert not await redis_client.exists(music_bucket)
+    assert await redis_client.zrange(matching_service.pool_keys(0)[1], 0, -1) == [str(vietnamese.id)]
+    assert await redis_client.zcard(matching_service.pool_keys(0)[0]) == 0
+
+    partner_id = await matching_service.leave_room(english.id)
+    assert partner_id == another_english.id
+    assert not await redis_client.exists(
+        matching_service.user_room_key(english.id), matching_service.user_room_key(another_english.id)
+    )
+
+
+@pytest.mark.asyncio
+async def test_rooms_expire_and_orphans_are_swept(matching_service):
+    redis_client = matching_service.redis
+    user1, user2 = make_user(), make_user()
+    await matching_service.enqueue_and_match(user1)
+    _, _, room_id = await matching_service.enqueue_and_match(user2)
+    room_key = matching_service.room_key(room_id)
+    assert 0 < await redis_client.ttl(room_key) <= matching_service.room_ttl
+    assert 0 < await redis_client.ttl(matching_service.user_room_key(user1.id)) <= matching_service.room_ttl
+
+    # Leaked without a TTL: a pointer to a room that is gone, and a room nobody points at
+    orphan_user, leaked_room = uuid.uuid4(), uuid.uuid4()
+    await redis_client.set(matching_service.user_room_key(orphan_user), str(uuid.uuid4()))
+    await redis_client.hset(
+        matching_service.room_key(leaked_room), mapping={"user1": str(uuid.uuid4()), "user2": str(uuid.uuid4())}
+    )
+
+    keys, reclaimed, orphaned_users = await matching_service.sweep_orphans(scan_count=10)
+
+    assert keys == 2 and reclaimed > 0
+    assert orphaned_users == [orphan_user]
+    assert await matching_service.get_user_room_info(user1.id) == (room_id, user2.id)
+    assert not await redis_client.exists(matching_service.room_key(leaked_room))
+
+
+@pytest.mark.asyncio
+async def test_unsharded_keys_survive_the_sweep_until_reclaimed(matching_service):
+    redis_client = matching_service.redis
+    user1, user2 = make_user(), make_user()
+    await matching_service.enqueue_and_match(user1)
+    _, _, room_id = await matching_service.enqueue_and_match(user2)
+
+    # A room, its pointer and the waiting pool as written before sharding, by nodes that may still run
+    legacy_user, legacy_room = uuid.uuid4(), uuid.uuid4()
+    await redis_client.hset(f"tanin:room:{legacy_room}", mapping={"user1": str(legacy_user), "user2": str(uuid.uuid4())})
+    await redis_client.set(f"tanin:user_room:{legacy_user}", str(legacy_room), ex=600)
+    await redis_client.sadd("tanin:waiting_pool", str(uuid.uuid4()))
+
+    assert await matching_service.sweep_orphans(scan_count=10) == (0, 0, [])
+    assert await redis_client.exists(f"tanin:room:{legacy_room}", f"tanin:user_room:{legacy_user}") == 2
+
+    keys, reclaimed, users = await matching_service.reclaim_unsharded_keys(scan_count=10)
+
+    assert keys == 3 and reclaimed > 0
+    assert users == [legacy_user]
+    assert not await redis_client.exists("tanin:waiting_pool")
+    for pattern in ("tanin:room:*", "tanin:user_room:*"):
+        assert [key async for key in redis_client.scan_iter(match=pattern) if "{" not in key] == []
+    assert await matching_service.get_user_room_info(user1.id) == (room_id, user2.id)
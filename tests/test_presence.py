@@ -0,0 +1,100 @@
+import asyncio
+import uuid
+
+import pytest
+import pytest_asyncio
+
+from tanin.core.database import get_redis_client
+from tanin.websocket.connection_manager import ConnectionManager
+from tanin.websocket.matcher import matched_events
+from tanin.websocket.matching_service import MatchingService
+from tanin.websocket.presence import PresenceRegistry
+from tanin.websocket.reaper import PresenceReaper
+from tests.conftest import FakeWebSocket, clear_matching_keys, make_user
+
+# Unique per run so leftovers of an earlier run never look like crashed nodes
+DEAD_NODE = f"dead-{uuid.uuid4()}"
+LIVE_NODE = f"live-{uuid.uuid4()}"
+
+
+@pytest_asyncio.fixture
+async def cluster():
+    redis_client = get_redis_client()
+    binary_redis = get_redis_client(decode_responses=False)
+    await clear_matching_keys(redis_client)
+    manager = ConnectionManager(binary_redis, node_id=LIVE_NODE, user_ttl=60)
+    matching_service = MatchingService(redis_client)
+    dead = PresenceRegistry(binary_redis, DEAD_NODE, node_timeout=1, user_ttl=60)
+    yield manager, matching_service, dead
+    for user_id in list(manager.active_connections):
+        await manager.disconnect(user_id)
+    for node in (DEAD_NODE, LIVE_NODE):
+        for user_id in await redis_client.smembers(f"tanin:node_users:{node}"):
+            await redis_client.delete(f"tanin:user_node:{user_id}")
+        await redis_client.srem("tanin:nodes", node)
+        await redis_client.delete(f"tanin:node_alive:{node}", f"tanin:node_users:{node}", f"tanin:reaper_lock:{node}")
+    await clear_matching_keys(redis_client)
+    await binary_redis.aclose()
+    await redis_client.aclose()
+
+
+@pytest.mark.asyncio
+async def test_registered_pointers_expire_unless_refreshed(cluster):
+    manager, _, _ = cluster
+    user = make_user()
+    await manager.connect(FakeWebSocket(), user.id)
+    key = manager.presence.user_node_key(user.id)
+    assert 0 < await manager.redis.ttl(key) <= 60
+
+    await manager.redis.expire(key, 5)
+    await PresenceReaper(manager, None).refresh_local_users()
+    assert await manager.redis.ttl(key) > 5
+
+    await manager.disconnect(user.id)
+    assert not await manager.redis.exists(key)
+
+
+@pytest.mark.asyncio
+async def test_users_reconnected_elsewhere_are_not_orphans(cluster):
+    manager, _, dead = cluster
+    stranded, moved = make_user(), make_user()
+    for user in (stranded, moved):
+        await dead.register_user(user.id)
+    await manager.connect(FakeWebSocket(), moved.id)
+
+    assert await dead.collect_orphans(DEAD_NODE, batch_size=1) == [stranded.id]
+
+    await dead.forget_node(DEAD_NODE, [stranded.id, moved.id], batch_size=1)
+    assert not await dead.is_online(stranded.id)
+    assert await manager.presence.is_online(moved.id)
+    await manager.disconnect(moved.id)
+
+
+@pytest.mark.asyncio
+async def test_reaper_cleans_up_after_a_crashed_node(cluster):
+    manager, matching_service, dead = cluster
+    await dead.heartbeat()
+    stranded = [make_user() for _ in range(5)]
+    for user in stranded:
+        await dead.register_user(user.id)
+
+    # One stranded user was in a room with someone on the surviving node
+    partner, partner_websocket = make_user(), FakeWebSocket()
+    await manager.connect(partner_websocket, partner.id)
+    await matching_service.enqueue_and_match(partner)
+    await manager.broadcast_events(matched_events(*await matching_service.enqueue_and_match(stranded[0])))
+    await asyncio.sleep(1.1)
+
+    reaper = PresenceReaper(manager, matching_service, notify_batch_size=2)
+    await manager.presence.heartbeat()
+    assert await reaper.reap_dead_nodes() == 5
+    await asyncio.sleep(0.01)
+
+    assert '"event_type":"partner_left"' in partner_websocket.sent[-1]
+    assert await matching_service.get_user_room_info(partner.id) is None
+    for user in stranded:
+        assert not await dead.is_online(user.id)
+    assert DEAD_NODE not in await manager.presence.find_dead_nodes()
+    assert not await manager.redis.exists(f"tanin:node_users:{DEAD_NODE}")
+    # A second reaper finds nothing left to do
+    assert await reaper.reap_dead_nodes() == 0
@@ -0,0 +1,87 @@
+import asyncio
+
+import pytest
+
+from tanin.websocket.matcher import matched_events
+from tanin.websocket.reconnect import ReconnectGrace
+from tests.conftest import FakeWebSocket, make_user
+
+
+async def connected_pair(manager, matching_service):
+    user, partner = make_user(), make_user()
+    partner_socket = FakeWebSocket()
+    await manager.connect(FakeWebSocket(), user.id)
+    await manager.connect(partner_socket, partner.id)
+    await matching_service.enqueue_and_match(partner)
+    match = await matching_service.enqueue_and_match(user)
+    await manager.broadcast_events(matched_events(*match))
+    return user, partner, partner_socket, match[2]
+
+
+@pytest.mark.asyncio
+async def test_reconnect_within_grace_resumes_room(backend):
+    manager, matching_service = backend
+    grace = ReconnectGrace(manager, matching_service, grace_seconds=0.2)
+    user, partner, partner_socket, room_id = await connected_pair(manager, matching_service)
+
+    await manager.disconnect(user.id)
+    await grace.depart(user.id, room_id)
+    await asyncio.sleep(0.05)
+
+    websocket = FakeWebSocket()
+    connection = await manager.connect(websocket, user.id)
+    assert await grace.resume(connection) == (room_id, partner.id)
+    await asyncio.sleep(0.3)
+
+    assert (connection.room_id, connection.partner_id) == (room_id, partner.id)
+    assert await matching_service.get_user_room_info(partner.id) == (room_id, user.id)
+    assert any('"event_type":"room_resumed"' in sent for sent in websocket.sent)
+    assert not any('"event_type":"partner_left"' in sent for sent in partner_socket.sent)
+    for user_id in (user.id, partner.id):
+        await manager.disconnect(user_id)
+
+
+@pytest.mark.asyncio
+async def test_partner_is_told_only_when_grace_expires(backend):
+    manager, matching_service = backend
+    grace = ReconnectGrace(manager, matching_service, grace_seconds=0.2)
+    user, partner, partner_socket, room_id = await connected_pair(manager, matching_service)
+
+    await manager.disconnect(user.id)
+    await grace.depart(user.id, room_id)
+    await asyncio.sleep(0.1)
+    assert not any('"event_type":"partner_left"' in sent for sent in partner_socket.sent)
+
+    await asyncio.sleep(0.2)
+    assert any('"event_type":"partner_left"' in sent for sent in partner_socket.sent)
+    assert await matching_service.get_user_room_info(partner.id) is None
+    assert not grace.pending
+    await manager.disconnect(partner.id)
+
+
+@pytest.mark.asyncio
+async def test_only_the_latest_departure_closes_the_room(backend):
+    manager, matching_service = backend
+    # Two nodes sharing the same state, each running its own grace timers
+    node_a = ReconnectGrace(manager, matching_service, grace_seconds=0.3)
+    node_b = ReconnectGrace(manager, matching_service, grace_seconds=0.3)
+    user, partner, partner_socket, room_id = await connected_pair(manager, matching_service)
+
+    await manager.disconnect(user.id)
+    await node_a.depart(user.id, room_id)
+    await asyncio.sleep(0.1)
+    connection = await manager.connect(FakeWebSocket(), user.id)
+    assert await node_b.resume(connection) == (room_id, partner.id)
+    await asyncio.sleep(0.05)
+    await manager.disconnect(user.id)
+    await node_b.depart(user.id, room_id)
+
+    # Node A's timer runs out first, but node B's departure is the one that counts
+    await asyncio.sleep(0.25)
+    assert not any('"event_type":"partner_left"' in sent for sent in partner_socket.sent)
+    assert await matching_service.get_user_room_info(partner.id) == (room_id, user.id)
+
+    await asyncio.sleep(0.15)
+    assert any('"event_type":"partner_left"' in sent for sent in partner_socket.sent)
+    assert await matching_service.get_user_room_info(partner.id) is None
+    await manager.disconnect(partner.id)
@@ -0,0 +1,71 @@
+import uuid
+
+import pytest
+import pytest_asyncio
+
+from tanin.core.database import get_redis_client
+from tanin.schemas.chat_schema import ChatMessage, NewTextMessageEvent, PartnerLeftEvent, RoomClosedEvent
+from tanin.schemas.user_schema import ActiveUser
+from tanin.websocket.connection_manager import ConnectionManager
+from tanin.websocket.endpoints import relay_to_partner
+from tanin.websocket.matcher import matched_events
+from tanin.websocket.matching_service import MatchingService
+from tests.conftest import FakeWebSocket, clear_matching_keys, count_commands, make_user
+
+
+def text_event(sender: ActiveUser) -> NewTextMessageEvent:
+    return NewTextMessageEvent(message=ChatMessage(id=uuid.uuid4(), sender_id=sender.id, content="hi"))
+
+
+@pytest_asyncio.fixture
+async def services():
+    redis_client = get_redis_client()
+    binary_redis = get_redis_client(decode_responses=False)
+    await clear_matching_keys(redis_client)
+    yield ConnectionManager(binary_redis), MatchingService(redis_client)
+    await clear_matching_keys(redis_client)
+    await binary_redis.aclose()
+    await redis_client.aclose()
+
+
+async def matched_connection(manager, matching_service):
+    # Only the sender is connected here, so every relay to the partner has to go through Redis
+    user, partner = make_user(), make_user()
+    connection = await manager.connect(FakeWebSocket(), user.id)
+    await matching_service.enqueue_and_match(partner)
+    match = await matching_service.enqueue_and_match(user)
+    await manager.broadcast_events(matched_events(*match))
+    return user, partner, connection
+
+
+@pytest.mark.asyncio
+async def test_relay_needs_no_room_lookup(services):
+    manager, matching_service = services
+    user, partner, connection = await matched_connection(manager, matching_service)
+    assert connection.partner_id == partner.id
+
+    manager_commands = count_commands(manager.redis)
+    matching_commands = count_commands(matching_service.redis)
+
+    for _ in range(10):
+        assert await relay_to_partner(connection, manager, matching_service, text_event(user))
+
+    # One PUBLISH per relayed message and no room lookup
+    assert manager_commands == ["PUBLISH"] * 10
+    assert matching_commands == []
+    await manager.disconnect(user.id)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("event", [PartnerLeftEvent(), RoomClosedEvent()])
+async def test_room_end_invalidates_cached_room(services, event):
+    manager, matching_service = services
+    user, partner, connection = await matched_connection(manager, matching_service)
+
+    await matching_service.leave_room(partner.id)
+    await manager.send_personal_event(event, user.id)
+    assert connection.room_id is None and connection.partner_id is None
+
+    # With the cache cleared the relay falls back to Redis, which no longer knows the room
+    assert not await relay_to_partner(connection, manager, matching_service, text_event(user))
+    await manager.disconnect(user.id)
@@ -0,0 +1,105 @@
+import asyncio
+import json
+import uuid
+
+import pytest
+import pytest_asyncio
+
+from tanin.core.database import get_redis_client
+from tanin.schemas.chat_schema import ErrorEvent
+from tanin.websocket.matcher import matched_events
+from tanin.websocket.stream_manager import StreamConnectionManager
+from tests.conftest import FakeWebSocket
+
+
+def event(i: int) -> ErrorEvent:
+    return ErrorEvent(message=str(i))
+
+
+def received(websocket: FakeWebSocket) -> list:
+    return [json.loads(sent)["message"] for sent in websocket.sent]
+
+
+@pytest_asyncio.fixture
+async def manager():
+    redis_client = get_redis_client(decode_responses=False)
+    manager = StreamConnectionManager(redis_client, node_id=uuid.uuid4().hex, block_ms=50)
+    listener = asyncio.create_task(manager.listen())
+    await asyncio.sleep(0.01)
+    yield manager
+    listener.cancel()
+    for user_id in list(manager.active_connections):
+        await manager.disconnect(user_id)
+    async for key in redis_client.scan_iter(match=b"tanin:stream:*"):
+        await redis_client.delete(key)
+    await redis_client.aclose()
+
+
+async def offline_backlog(manager, user_id, count: int) -> list:
+    # Published while the user has no socket, so only their own stream keeps them
+    for i in range(count):
+        await manager.broadcast_event_to_user(event(i), user_id)
+    entries = await manager.redis.xrange(f"{manager.USER_STREAM_KEY_PREFIX}{user_id}")
+    return [stream_id.decode() for stream_id, _ in entries]
+
+
+@pytest.mark.asyncio
+async def test_replay_resumes_after_last_event_then_goes_live(manager):
+    user_id = uuid.uuid4()
+    ids = await offline_backlog(manager, user_id, 4)
+
+    websocket = FakeWebSocket()
+    await manager.connect(websocket, user_id, last_event_id=ids[1])
+    await manager.broadcast_event_to_user(event(4), user_id)
+    await asyncio.sleep(0.2)
+
+    assert received(websocket) == ["2", "3", "4"]
+    assert [json.loads(sent)["event_id"] for sent in websocket.sent[:2]] == ids[2:]
+
+
+@pytest.mark.asyncio
+async def test_live_entries_during_replay_follow_the_backlog_once(manager, monkeypatch):
+    user_id = uuid.uuid4()
+    ids = await offline_backlog(manager, user_id, 3)
+    xrange = manager.redis.xrange
+
+    async def xrange_racing_live_delivery(*args, **kwargs):
+        # While the backlog is read, the live path delivers a new entry and one the backlog also holds
+        missed = await xrange(*args, **kwargs)
+        connection = manager.active_connections[user_id]
+        manager._deliver(connection, b"9999999999999-0", event(3).model_dump_json().encode())
+        manager._deliver(connection, ids[2].encode(), event(2).model_dump_json().encode())
+        return missed
+
+    monkeypatch.setattr(manager.redis, "xrange", xrange_racing_live_delivery)
+    websocket = FakeWebSocket()
+    connection = await manager.connect(websocket, user_id, last_event_id=ids[0])
+    await asyncio.sleep(0.01)
+
+    assert received(websocket) == ["1", "2", "3"]
+    assert connection.replay_buffer is None
+
+
+@pytest.mark.asyncio
+async def test_entries_are_delivered_once_and_in_order(manager):
+    user_id = uuid.uuid4()
+    websocket = FakeWebSocket()
+    connection = await manager.connect(websocket, user_id)
+
+    for stream_id, i in ((b"100-0", 0), (b"100-1", 1), (b"100-1", 1), (b"99-5", 9), (b"101-0", 2)):
+        manager._deliver(connection, stream_id, event(i).model_dump_json().encode())
+    await asyncio.sleep(0.01)
+
+    assert received(websocket) == ["0", "1", "2"]
+    assert connection.last_event_id == b"101-0"
+
+
+@pytest.mark.asyncio
+async def test_replayed_match_binds_the_room(manager):
+    user_id, partner_id, room_id = uuid.uuid4(), uuid.uuid4(), uuid.uuid4()
+    await manager.broadcast_event_to_user(ErrorEvent(message="before"), user_id)
+    entries = await manager.redis.xrange(f"{manager.USER_STREAM_KEY_PREFIX}{user_id}")
+    await manager.broadcast_event_to_user(matched_events(user_id, partner_id, room_id)[0][0], user_id)
+
+    connection = await manager.connect(FakeWebSocket(), user_id, last_event_id=entries[0][0].decode())
+    assert (connection.room_id, connection.partner_id) == (room_id, partner_id)
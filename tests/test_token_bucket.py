@@ -0,0 +1,134 @@
+import asyncio
+import uuid
+
+import httpx
+import pytest
+import pytest_asyncio
+from fastapi import FastAPI
+from fastapi.responses import StreamingResponse
+
+from tanin.core.database import get_redis_client
+from tanin.middlewares import process_time
+from tanin.middlewares.process_time import ProcessTimeMiddleware
+from tanin.middlewares.token_bucket import TwoTierTokenBucketManager, GcraRateLimiter, RateLimitMiddleware
+from tests.conftest import count_commands
+
+
+@pytest_asyncio.fixture
+async def redis_client():
+    redis_client = get_redis_client()
+    yield redis_client
+    async for key in redis_client.scan_iter(match="rate_limit:*"):
+        await redis_client.delete(key)
+    await redis_client.aclose()
+
+
+async def admitted(manager, ip: str, requests: int) -> int:
+    return sum([await manager.consume(user_id=None, ip=ip) for _ in range(requests)])
+
+
+@pytest.mark.asyncio
+async def test_local_admission_needs_no_redis(redis_client):
+    manager = TwoTierTokenBucketManager(redis_client, capacity=10, refill_rate=0.001, max_unsynced=10)
+    commands = count_commands(redis_client)
+    ip = str(uuid.uuid4())
+
+    assert await admitted(manager, ip, 15) == 10
+    assert commands == []
+
+    await manager.sync()
+    tokens = await redis_client.hget(manager.bucket_key(None, ip), "tokens")
+    assert float(tokens) < 1
+
+
+@pytest.mark.asyncio
+async def test_over_admission_is_bounded_per_node(redis_client):
+    # Two nodes sharing one client, each may admit max_unsynced requests Redis has not seen
+    nodes = [TwoTierTokenBucketManager(redis_client, capacity=10, refill_rate=0.001, max_unsynced=3) for _ in range(2)]
+    ip = str(uuid.uuid4())
+
+    total = 0
+    for _ in range(5):
+        for node in nodes:
+            total += await admitted(node, ip, 4)
+    assert 10 <= total <= 10 + 2 * 3
+
+    # Once synced, neither node admits more
+    for node in nodes:
+        await node.sync()
+    assert sum([await admitted(node, ip, 3) for node in nodes]) == 0
+
+
+@pytest.mark.asyncio
+async def test_concurrent_syncs_charge_each_admission_once(redis_client):
+    manager = TwoTierTokenBucketManager(redis_client, capacity=100, refill_rate=0.001, max_unsynced=5)
+    ip = str(uuid.uuid4())
+    assert await admitted(manager, ip, 5) == 5
+
+    # Every one of these is over the unsynced allowance and syncs inline, overlapping a background sync
+    results = await asyncio.gather(manager.sync(), *(manager.check(user_id=None, ip=ip) for _ in range(10)))
+    assert all(allowed for allowed, _ in results[1:])
+    await manager.sync()
+
+    bucket = manager.buckets[manager.bucket_key(None, ip)]
+    assert (bucket.unsynced, bucket.in_flight) == (0, 0)
+    tokens = float(await redis_client.hget(manager.bucket_key(None, ip), "tokens"))
+    assert 85 <= tokens < 85.1
+
+
+@pytest.mark.asyncio
+async def test_gcra_keeps_one_timestamp_and_reports_retry_after(redis_client):
+    limiter = GcraRateLimiter(redis_client, capacity=3, refill_rate=5)
+    await limiter.preload()
+    ip = str(uuid.uuid4())
+
+    results = [await limiter.check(user_id=None, ip=ip) for _ in range(4)]
+    assert [allowed for allowed, _ in results] == [True, True, True, False]
+    assert 0.15 < results[-1][1] <= 0.2
+    assert await redis_client.type(limiter.bucket_key(None, ip)) == "string"
+
+    # Fractional refills are not lost: one token is back after 1/refill_rate seconds
+    await asyncio.sleep(results[-1][1])
+    assert await limiter.consume(user_id=None, ip=ip)
+    assert not await limiter.consume(user_id=None, ip=ip)
+
+
+@pytest.mark.asyncio
+async def test_rejections_carry_retry_after(redis_client):
+    app = FastAPI()
+    app.add_middleware(RateLimitMiddleware)
+    app.state.token_bucket_manager = GcraRateLimiter(redis_client, capacity=1, refill_rate=0.1)
+
+    @app.get("/")
+    async def hello():
+        return {}
+
+    transport = httpx.ASGITransport(app=app, client=(str(uuid.uuid4()), 40000))
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        assert (await client.get("/")).status_code == 200
+        response = await client.get("/")
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "10"
+
+
+@pytest.mark.asyncio
+async def test_streaming_responses_pass_through_middleware(redis_client, monkeypatch):
+    logged = []
+    monkeypatch.setattr(process_time.log, "info", logged.append)
+    app = FastAPI()
+    app.add_middleware(RateLimitMiddleware)
+    app.add_middleware(ProcessTimeMiddleware)
+    app.state.token_bucket_manager = GcraRateLimiter(redis_client, capacity=5, refill_rate=1)
+
+    @app.get("/stream")
+    async def stream():
+        async def chunks():
+            for i in range(3):
+                yield f"{i}\n"
+        return StreamingResponse(chunks())
+
+    transport = httpx.ASGITransport(app=app, client=(str(uuid.uuid4()), 40000))
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        response = await client.get("/stream")
+    assert response.text == "0\n1\n2\n"
+    assert len(logged) == 1 and logged[0].startswith("GET /stream took ")
@@ -0,0 +1,68 @@
+import time
+import uuid
+from datetime import timedelta
+
+import httpx
+import jwt
+import pytest
+from fastapi import FastAPI, HTTPException, Request
+
+from tanin.middlewares.token_bucket import RateLimitMiddleware
+from tanin.utils import helper
+from tanin.utils.helper import TokenClaimsCache, create_jwt_token
+
+
+def count_decodes(monkeypatch):
+    calls = []
+    decode = jwt.decode
+    monkeypatch.setattr(helper.jwt, "decode", lambda *args, **kwargs: calls.append(1) or decode(*args, **kwargs))
+    return calls
+
+
+def test_claims_are_verified_once_and_expire_with_the_token(monkeypatch):
+    cache = TokenClaimsCache(maxsize=2, ttl_seconds=60)
+    decodes = count_decodes(monkeypatch)
+    user_id = uuid.uuid4()
+    token = create_jwt_token({"sub": str(user_id)}, timedelta(seconds=1))
+
+    assert [cache.verify(token).sub for _ in range(3)] == [user_id] * 3
+    assert len(decodes) == 1
+
+    # Bounded: the least recently used token is evicted
+    for _ in range(2):
+        cache.verify(create_jwt_token({"sub": str(uuid.uuid4())}))
+    assert cache.get(token) is None
+
+    # An entry never outlives the token's exp, and the expired token is then rejected
+    cache.verify(token)
+    time.sleep(1.1)
+    assert cache.get(token) is None
+    with pytest.raises(HTTPException):
+        cache.verify(token)
+    with pytest.raises(HTTPException):
+        cache.verify("not-a-token")
+
+
+@pytest.mark.asyncio
+async def test_middleware_claims_are_reused_downstream(monkeypatch):
+    class AdmitAll:
+        async def check(self, user_id, ip, amount=1):
+            return True, None
+
+    monkeypatch.setattr(helper, "token_claims_cache", TokenClaimsCache())
+    decodes = count_decodes(monkeypatch)
+    app = FastAPI()
+    app.add_middleware(RateLimitMiddleware)
+    app.state.token_bucket_manager = AdmitAll()
+
+    @app.get("/")
+    async def whoami(request: Request):
+        return {"sub": str(request.state.token_claims.sub)}
+
+    user_id = uuid.uuid4()
+    headers = {"Authorization": f"Bearer {create_jwt_token({'sub': str(user_id)})}"}
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        for _ in range(2):
+            assert (await client.get("/", headers=headers)).json() == {"sub": str(user_id)}
+    assert len(decodes) == 1